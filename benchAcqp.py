@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the parser on synthetic data (see synthBruker), to give a
+reproducible baseline before and after a performance change. Runs offline
+with the standard library only (timeit and tracemalloc); the regex baseline
+also needs dateutil, as the original reader did.
+
+Measured for every scan kind and ParaVision version:
+    readParameters/<pv>/<kind>   Acqp.readParameters on the acqp and method texts
+    regexBaseline/<pv>/<kind>    the same texts read by the original reader:
+                                 one regex per field, built from the paramRE
+                                 patterns and compiled at each call
+    readScan/<pv>/<kind>         readScan on the files (memory-mapped)
+and for each generated study:
+    study/<pv>                   summarize_studies end to end (CSV output)
+    memory/<pv>                  peak Python memory of the same (tracemalloc;
+                                 memory-mapped file pages are not counted)
+
+Times are the best of --repeat runs, per call. Before readParameters and
+readScan are timed, the values they parse are checked against the ones
+synthBruker wrote. Results can be saved with --json, together with the
+generator version of the data, and compared against a saved baseline with
+--compare. A case that fails (e.g. a file layout the parser does not handle,
+or values that do not match) is reported with its error instead of a time.
+
+Usage:
+    python benchAcqp.py [--data DIR] [--repeat N] [--json FILE] [--compare BASELINE]
+
+"""
+
+import os
+import sys
+import re
+import json
+import timeit
+import shutil
+import platform
+import argparse
+import tempfile
+import tracemalloc
+import contextlib
+import synthBruker
+import paramRE as paRE
+import py_acqp
+
+
+# Best and mean time per call of fn, with the number of calls per run chosen
+# by timeit so that a run takes at least 0.2 s
+def timeCall(fn, repeat):
+    timer = timeit.Timer(fn)
+    number, _ = timer.autorange()
+    runs = [t / number for t in timer.repeat(repeat, number)]
+    return {'seconds': min(runs), 'mean': sum(runs) / len(runs), 'number': number}
+
+
+def peakMemory(fn):
+    tracemalloc.start()
+    try:
+        fn()
+        return {'peakBytes': tracemalloc.get_traced_memory()[1]}
+    finally:
+        tracemalloc.stop()
+
+
+# The fields of the reader this parser replaced, in the order it read them:
+# (key, file, paramRE pattern builder, parameter, required). The save time,
+# and the PV version after the imaging fields, are read separately.
+regexFields = [
+    ('PulseProg', 'acqp', paRE.regExAngleText, '##$PULPROG', True),
+    ('RepTime', 'acqp', paRE.regExFloatArray, '##$ACQ_repetition_time', True),
+    ('nAverages', 'method', paRE.regExOneFloat, '##$PVM_NAverages', True),
+    ('acqProtocol', 'acqp', paRE.regExAngleText, '##$ACQ_protocol_name', False),
+    ('nRepetitions', 'method', paRE.regExOneFloat, '##$PVM_NRepetitions', False),
+    ('SaveTime', 'method', None, '##OWNER', True),
+    ('refPower', 'method', paRE.regExOneFloat, '##$PVM_RefPowCh1', False),
+    ('ReceiverGain', 'acqp', paRE.regExOneFloat, '##$RG', True),
+    ('EchoTime', 'acqp', paRE.regExFloatArray, '##$ACQ_echo_time', True),
+    ('RecovTime', 'acqp', paRE.regExFloatArray, '##$ACQ_recov_time', True),
+    ('nEchoes', 'acqp', paRE.regExOneFloat, '##$NECHOES', True),
+    ('nSlices', 'method', paRE.regExFloatArray, '##$PVM_SPackArrNSlices', True),
+    ('nSlicePacks', 'method', paRE.regExOneFloat, '##$PVM_NSPacks', True),
+    ('FOV', 'method', paRE.regExFloatArray, '##$PVM_Fov', True),
+    ('Matrix', 'method', paRE.regExFloatArray, '##$PVM_Matrix', True),
+    ('SliceThick', 'method', paRE.regExOneFloat, '##$PVM_SliceThick', True),
+    ('SliceSep', 'method', paRE.regExFloatArray, '##$PVM_SPackArrSliceGap', True),
+    ('SliceList', 'method', paRE.regExFloatArray, '##$PVM_ObjOrderList', True),
+    ('SliceOffset', 'method', paRE.regExFloatArray, '##$PVM_SliceOffset', True),
+    ('SlicePackOffset', 'method', paRE.regExFloatArray, '##$PVM_SPackArrSliceOffset', True),
+    ('ReadOffset', 'method', paRE.regExFloatArray, '##$PVM_ReadOffset', True),
+    ('PhaseOffset', 'method', paRE.regExFloatArray, '##$PVM_Phase1Offset', True),
+    ('ImageOrient', 'method', paRE.regExTextArray, '##$PVM_SPackArrSliceOrient', True),
+    ('nEvolutionCycles', 'method', paRE.regExOneFloat, '##$PVM_NEvolutionCycles', False),
+    ('FlipAngle', 'acqp', paRE.regExOneFloat, '##$ACQ_flip_angle', True),
+    ('BasicFreq', 'acqp', paRE.regExOneFloat, '##$BF1', True),
+    ('SpecWidth', 'acqp', paRE.regExOneFloat, '##$SW_h', True),
+    ('ExcitationPulse', 'method', paRE.regExOneLineAngleText, '##$ExcPulse1Enum', False),
+    ('RefocusingPulse', 'method', paRE.regExOneLineAngleText, '##$RefPulse1Enum', False),
+    ('ReadOutDir', 'method', paRE.regExTextArray, '##$PVM_SPackArrReadOrient', True),
+    ('RareFactor', 'method', paRE.regExOneFloat, '##$PVM_RareFactor', False),
+    ('FatSat', 'method', paRE.regExOneLineText, '##$PVM_FatSupOnOff', False),
+    ('Gating', 'method', paRE.regExOneLineText, '##$PVM_TriggerModule', False),
+    ('ByteOrder', 'acqp', paRE.regExOneLineText, '##$BYTORDA', True),
+    ('FlowDir', 'method', paRE.regExOneLineText, '##$FlowEncodingDirection', False),
+    ('Venc', 'method', paRE.regExOneFloat, '##$FlowRange', False),
+]
+
+
+# The reader this parser replaced: for every field a regex is built from the
+# paramRE patterns, compiled and searched over the whole acqp or method text,
+# and the save time is parsed with dateutil. Like the original, it stops after
+# the save time for singlepulse scans, raises AttributeError when a required
+# field is missing; it fails on the PV5 save time layout and on some PV360
+# @n*(value) arrays, which it does not know.
+def regexParameters(acqpText, methodText):
+    from dateutil import parser
+    texts = {'acqp': acqpText, 'method': methodText}
+    parameters = {}
+    for key, source, pattern, paramName, required in regexFields:
+        if key == 'SaveTime':
+            saveTimeRegex = re.compile(r'\#\#OWNER\=(?:\w+)\s\$\$\s([ -0-9+.-:]+)')
+            parameters[key] = parser.parse(saveTimeRegex.search(methodText).group(1))
+            if 'singlepulse' in parameters['PulseProg'].lower():
+                return parameters
+            continue
+        match = re.compile(pattern(paramName)).search(texts[source])
+        if match is None and not required:
+            print(key + ' not found, leaving blank')
+            parameters[key] = ''
+        else:
+            parameters[key] = match.group(1).replace('\n', '')
+    pvVerRegex = re.compile(re.escape('##$ACQ_sw_version = ') + paRE.numInParentheses + r'\s'
+                            + r'\<(PV (\d+)\.\d+\.*\d*)\>')
+    match = pvVerRegex.search(acqpText)
+    parameters['PVver'] = match.group(1) if match is not None else ''
+    parameters['Major PV ver'] = match.group(2) if match is not None else ''
+    return parameters
+
+
+# Raise ValueError naming the fields of a parsed scan whose typed values differ
+# from those synthBruker wrote. The imaging fields of non-imaging scans are
+# not read by the parser and are not compared.
+def checkValues(curAcqp, expected):
+    typed = curAcqp.typedParameters()
+    imaging = 'singlepulse' not in typed['PulseProg'].lower()
+    wrong = []
+    for key, value in expected.items():
+        if paRE.scanFields[key].imaging and not imaging:
+            continue
+        parsed = typed.get(key)
+        if hasattr(parsed, 'tolist'):
+            parsed = parsed.tolist()
+        if parsed != (list(value) if isinstance(value, (list, tuple)) else value):
+            wrong.append('%s=%r (wrote %r)' % (key, parsed, value))
+    if wrong:
+        raise ValueError('parsed values differ: ' + ', '.join(wrong))
+
+
+# Check the scan returned by read, then time read
+def timeChecked(read, expected, repeat):
+    checkValues(read(), expected)
+    return timeCall(read, repeat)
+
+
+# Run one benchmark, recording the error rather than stopping on a failure.
+# Progress messages and warnings printed by the parser are discarded.
+def runCase(results, name, measure):
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull), \
+            contextlib.redirect_stderr(devnull):
+        try:
+            results[name] = measure()
+        except Exception as err:
+            results[name] = {'error': repr(err)}
+    print(formatResult(name, results[name]))
+
+
+def formatResult(name, result):
+    if 'error' in result:
+        return '%-34s %s' % (name, result['error'])
+    if 'peakBytes' in result:
+        return '%-34s %10.1f KiB peak' % (name, result['peakBytes'] / 1024)
+    return '%-34s %10.1f us  (mean %.1f us, %d calls/run)' % (
+        name, result['seconds'] * 1e6, result['mean'] * 1e6, result['number'])
+
+
+# One study per ParaVision version, holding every scan kind, with the field
+# values written for each scan
+def writeData(root):
+    studies = {}
+    kinds = synthBruker.studyKinds(len(synthBruker.scanKinds))
+    for pv in sorted(synthBruker.pvVersions):
+        expected = {}
+        studies[pv] = (synthBruker.writeStudy(root, 'bench_PV' + pv, kinds, pv, expected=expected),
+                       kinds, expected)
+    return studies
+
+
+def runBenchmarks(root, repeat):
+    results = {}
+    for pv, (curDir, kinds, expected) in writeData(root).items():
+        fs, studyDir = py_acqp.findStudyDir(curDir)
+        for i, kind in enumerate(kinds):
+            scanNum = str(i + 1)
+            texts = [fs.read(fs.join(studyDir, scanNum, name)).decode('utf-8', 'replace')
+                     for name in ('acqp', 'method')]
+
+            def readParameters():
+                curAcqp = py_acqp.Acqp(scanNum)
+                curAcqp.readParameters(*texts)
+                return curAcqp
+            runCase(results, 'readParameters/PV%s/%s' % (pv, kind),
+                    lambda: timeChecked(readParameters, expected[scanNum], repeat))
+            runCase(results, 'regexBaseline/PV%s/%s' % (pv, kind),
+                    lambda: timeCall(lambda: regexParameters(*texts), repeat))
+            runCase(results, 'readScan/PV%s/%s' % (pv, kind),
+                    lambda: timeChecked(lambda: py_acqp.readScan(studyDir, scanNum, fs),
+                                        expected[scanNum], repeat))
+
+        def summarize():
+            result = py_acqp.summarize_studies([curDir])[curDir]
+            if isinstance(result, Exception):
+                raise result
+        runCase(results, 'study/PV%s' % pv, lambda: timeCall(summarize, repeat))
+        runCase(results, 'memory/PV%s' % pv, lambda: peakMemory(summarize))
+    return results
+
+
+def environment():
+    return {'python': platform.python_version(), 'implementation': platform.python_implementation(),
+            'platform': platform.platform(), 'machine': platform.machine(),
+            'parserVersion': paRE.parserVersion, 'generatorVersion': synthBruker.generatorVersion}
+
+
+# Speed of readParameters relative to the regex baseline on the same texts
+# (above 1 is faster)
+def compareRegex(results):
+    print('\nSpeed of readParameters relative to the regex baseline (above 1 is faster):')
+    for name, result in results.items():
+        if not name.startswith('readParameters/'):
+            continue
+        old = results.get('regexBaseline/' + name.split('/', 1)[1])
+        if old is None or 'error' in result or 'error' in old:
+            continue
+        print('%-34s %6.2fx' % (name, old['seconds'] / result['seconds']))
+
+
+# Ratio of each time and memory peak to the baseline (below 1 is faster).
+# baseline is the content of a file saved by --json.
+def compare(results, baseline):
+    print('\nCompared to baseline:')
+    version = baseline['environment'].get('generatorVersion')
+    if version != synthBruker.generatorVersion:
+        print('Warning: the baseline was measured on data of generator version %s, this run on %s'
+              % (version, synthBruker.generatorVersion))
+    for name, result in results.items():
+        old = baseline['results'].get(name)
+        if old is None or 'error' in result or 'error' in old:
+            continue
+        key = 'peakBytes' if 'peakBytes' in result else 'seconds'
+        print('%-34s %6.2fx' % (name, result[key] / old[key]))
+
+
+def main(argv=None):
+    argParser = argparse.ArgumentParser(description='Benchmark the parser on synthetic Bruker data.')
+    argParser.add_argument('--data', metavar='DIR',
+                           help='write the synthetic studies here and keep them (default: a temporary directory)')
+    argParser.add_argument('--repeat', type=int, default=5, help='timing runs per case (default 5)')
+    argParser.add_argument('--json', metavar='FILE', help='save the results')
+    argParser.add_argument('--compare', metavar='BASELINE', help='compare with results saved by --json')
+    args = argParser.parse_args(argv)
+
+    root = args.data or tempfile.mkdtemp(prefix='benchAcqp')
+    try:
+        results = runBenchmarks(root, args.repeat)
+    finally:
+        if args.data is None:
+            shutil.rmtree(root)
+
+    compareRegex(results)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'environment': environment(), 'results': results}, f, indent=1)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+Checkpoints of batch runs over many studies, so that a long archive sweep
+that was stopped, or that ran into unreadable scans, can be resumed without
+redoing the studies it already finished.
+
+The checkpoint is a JSON lines file with one line per study, appended as
+each study finishes: the absolute paths of the study and of the files
+written for it, and the errors of its scans or of the study as a whole. Every line is flushed to
+disk as it is written, so a run that is killed loses at most the study in
+progress; a torn last line is ignored. On resume a study is skipped if it
+finished without errors and its files are still there. Studies that failed,
+had failed scans or never finished are run again; with a scan cache only
+their failed and new scans are parsed again.
+
+writeManifest writes the error manifest of a run: one CSV row per study or
+scan that could not be read, with the exception class and message.
+
+"""
+
+import os
+import csv
+import json
+
+
+class Checkpoint:
+    def __init__(self, path):
+        self.path = path
+        # Study path -> last entry recorded for it
+        self.studies = {}
+        text = ''
+        try:
+            with open(path) as f:
+                text = f.read()
+        except FileNotFoundError:
+            pass
+        for line in text.splitlines():
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            self.studies[entry['study']] = entry
+        self.file = open(path, 'a')
+        if text and not text.endswith('\n'):
+            # Start clear of a line torn by a killed run
+            self.file.write('\n')
+
+    # Files written for a study that finished cleanly in an earlier run, or
+    # None if the study has to be run (again)
+    def finished(self, curDir):
+        entry = self.studies.get(os.path.abspath(curDir))
+        if entry is None or entry['errors'] or not all(os.path.exists(p) for p in entry['outputs']):
+            return None
+        return entry['outputs']
+
+    def record(self, curDir, outputs, errors):
+        entry = {'study': os.path.abspath(curDir), 'outputs': [os.path.abspath(p) for p in outputs],
+                 'errors': errors}
+        self.studies[entry['study']] = entry
+        self.file.write(json.dumps(entry) + '\n')
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+
+# Write the errors of a run (runReport.RunReport.errors) to a CSV file
+def writeManifest(path, errors):
+    with open(path + '.tmp', 'w') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(['Study', 'Scan', 'ErrorType', 'Error'])
+        for error in errors:
+            writer.writerow([error['study'], error['scan'], error['errorType'], error['error']])
+    os.replace(path + '.tmp', path)
+    return path
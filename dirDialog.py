@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+"""
+Multi directory chooser used by py_acqp when it is run with --gui (or with no
+study paths). This is kept in its own file so that PyQt5 is only imported
+when the dialog is actually wanted.
+
+"""
+
+import sys
+from PyQt5.QtWidgets import (QFileDialog, QAbstractItemView, QListView,
+                             QTreeView, QApplication, QDialog)
+from PyQt5.QtCore import QCoreApplication
+
+
+class GetExistingDirectories(QFileDialog):
+    def __init__(self, *args):
+        super(GetExistingDirectories, self).__init__(*args)
+        self.setOption(self.DontUseNativeDialog, True)
+        self.setFileMode(self.Directory)
+        self.setOption(self.ShowDirsOnly, True)
+        self.findChildren(QListView)[0].setSelectionMode(QAbstractItemView.ExtendedSelection)
+        self.findChildren(QTreeView)[0].setSelectionMode(QAbstractItemView.ExtendedSelection)
+
+
+# Open the dialog and return the selected directories (empty if cancelled)
+def chooseDirectories():
+    targetDirs = []
+    qapp = QCoreApplication.instance()
+    if qapp is None:
+        qapp = QApplication(sys.argv)
+    dlg = GetExistingDirectories()
+    if dlg.exec_() == QDialog.Accepted:
+        targetDirs = dlg.selectedFiles()
+    return targetDirs
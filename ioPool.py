@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+"""
+Concurrent file loading for studies on network mounts (NFS/SMB), where every
+directory listing and file open costs a round trip to the server.
+
+boundedMap runs the listings and reads on a thread pool, keeping at most
+maxInFlight of them outstanding so that a study with thousands of scans does
+not queue thousands of requests (and hold their file contents) at once. The
+results come back in order, so the parsing and output stages downstream see
+exactly what they would see with the built-in map. The threads only do I/O:
+the files are read with plain reads, which release the GIL while they wait on
+the server, and the texts are parsed by the consumer.
+
+"""
+
+import collections
+import concurrent.futures
+
+defaultInFlight = 32
+
+
+def ioExecutor(threads):
+    return concurrent.futures.ThreadPoolExecutor(max_workers=threads,
+                                                 thread_name_prefix='py_acqp-io')
+
+
+# Like executor.map, but lazy: calls are submitted as the results are
+# consumed, with no more than maxInFlight submitted ahead of the consumer.
+# Pending calls are cancelled if the consumer stops early.
+def boundedMap(executor, fn, *iterables, maxInFlight=defaultInFlight):
+    pending = collections.deque()
+    try:
+        for args in zip(*iterables):
+            if len(pending) >= maxInFlight:
+                yield pending.popleft().result()
+            pending.append(executor.submit(fn, *args))
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
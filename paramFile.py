@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""
+This file contains a single-pass reader for the JCAMP-DX style parameter
+files (acqp, method, subject, ...) that ParaVision writes for every scan.
+
+ParamFileMap reads the few dozen registry fields of a scan: nothing is
+indexed up front; a parameter is found with one plain search of the file
+(or of its memory map) for its ##NAME= line and decoded from its own slice
+of the file when it is asked for. parseParamText, for readers that want
+every record (see paramStore), splits the text into its ##NAME= records in
+a single regex pass and decodes a record when it is first looked up. Both
+understand the ( n ) / ( n, m ) size headers, values that wrap over several
+lines, <...> strings and the $$ comment lines that follow some of the
+header records (e.g. the save time after ##OWNER).
+
+"""
+
+import os
+import re
+import mmap
+import collections.abc
+
+# Size headers are always written with spaces inside the parentheses, which
+# distinguishes them from struct values such as (1, 5400, 90, Yes)
+sizeHeader = re.compile(r'\(\s(\d+(?:,\s*\d+)*)\s\)$')
+
+# PV360 writes runs of repeated values as @n*(value)
+repeatRun = re.compile(r'@(\d+)\*\(([^)]*)\)')
+
+
+# Dictionary of parameter values keyed by parameter name (without the leading
+# ## or ##$), over the raw text of each record. A record is decoded into its
+# value, its array shape from the size header and its $$ comment lines when
+# it is first asked for.
+class ParamDict(collections.abc.Mapping):
+    def __init__(self, texts=None):
+        self.texts = texts if texts is not None else {}
+        self.records = {}
+
+    # Decode one record into its value, shape and $$ comment lines
+    def record(self, name):
+        if name not in self.records:
+            self.records[name] = splitRecord(self.texts[name])
+        return self.records[name]
+
+    def __getitem__(self, name):
+        return self.record(name)[0]
+
+    def __contains__(self, name):
+        return name in self.texts
+
+    def get(self, name, default=None):
+        return self.record(name)[0] if name in self.texts else default
+
+    def __iter__(self):
+        return iter(self.texts)
+
+    def __len__(self):
+        return len(self.texts)
+
+    def shape(self, name):
+        return self.record(name)[1] if name in self.texts else None
+
+    def commentLines(self, name):
+        return self.record(name)[2] if name in self.texts else []
+
+
+# Turn the text lines of one record into its value string and declared shape.
+# Lines are joined with single spaces, a size header is split off, and a lone
+# <...> string has its angle brackets removed.
+def recordValue(lines):
+    first = lines[0].strip()
+    shape = None
+    match = sizeHeader.match(first)
+    if match is not None:
+        shape = tuple(int(n) for n in match.group(1).split(','))
+        lines = lines[1:]
+    else:
+        lines = [first] + lines[1:]
+    value = ' '.join(line.strip() for line in lines).strip()
+    if value.startswith('<') and value.endswith('>') and value.count('<') == 1:
+        value = value[1:-1]
+    return value, shape
+
+
+# Decode a numeric value string. Scalars (no size header) become Python
+# numbers; arrays are converted in bulk into a NumPy array of the declared
+# shape. NumPy is only imported when an array is decoded. Raises ValueError
+# if the text does not hold the declared number of values, or if a value of
+# an int field is not a whole number (rather than truncating it).
+def decodeNumbers(value, shape, dtype=float):
+    if '@' in value:
+        value = repeatRun.sub(lambda m: ' '.join([m.group(2).strip()] * int(m.group(1))), value)
+    if shape is None:
+        if dtype is not int:
+            return dtype(value)
+        number = float(value)
+        if not number.is_integer():
+            raise ValueError('Not a whole number: ' + value)
+        return int(number)
+    import numpy as np
+    values = np.fromstring(value, dtype=float, sep=' ')
+    if dtype is int and not (np.isfinite(values).all() and (values == np.trunc(values)).all()):
+        raise ValueError('Not all whole numbers: ' + value)
+    return values.astype(dtype).reshape(shape)
+
+
+# Start of a ##NAME= or ##$NAME= record and its name. Splitting the text on
+# it leaves the text of each record (the rest of the ##NAME= line and the
+# lines that follow) between the names. A record with no = is named by its
+# whole first line.
+recordStart = re.compile(r'\n##\$*([^=\n]*)=?')
+
+
+# Value string, declared shape and $$ comment lines of one record, from its
+# text after the =
+def splitRecord(text):
+    first, newline, rest = text.partition('\n')
+    if not newline:
+        value = text.strip()
+        if value[:1] not in ('(', '<'):
+            return value, None, []
+    elif '\n' not in rest and not rest.startswith('$$'):
+        # A size header and one line of values, as most arrays are written
+        match = sizeHeader.match(first.strip())
+        if match is not None:
+            value = rest.strip()
+            if value.startswith('<') and value.endswith('>') and value.count('<') == 1:
+                value = value[1:-1]
+            return value, tuple(map(int, match.group(1).split(','))), []
+    lines = text.split('\n')
+    comments = []
+    if '$$' in text:
+        comments = [line[2:].strip() for line in lines[1:] if line.startswith('$$')]
+        if comments:
+            lines = lines[:1] + [line for line in lines[1:] if not line.startswith('$$')]
+    value, shape = recordValue(lines)
+    return value, shape, comments
+
+
+# Collect every record of the text with one regex split; the records are
+# decoded as they are looked up. Text before the first record is ignored.
+def parseParamText(text):
+    parts = recordStart.split('\n' + text)
+    return ParamDict(dict(zip(parts[1::2], parts[2::2])))
+
+
+# NAME= as bytes, built once per parameter name
+keyCache = {}
+
+
+def recordKey(name):
+    key = keyCache.get(name)
+    if key is None:
+        key = keyCache[name] = name.encode('ascii', 'replace') + b'='
+    return key
+
+
+# Memory-mapped parameter file. The file is never read into a Python string
+# as a whole; a lookup finds the ##NAME= or ##$NAME= line of the record asked
+# for with mmap.find and decodes only the bytes of that record, so reading a
+# few fields near the top of a file (e.g. the save time after ##OWNER) does
+# not touch the rest of it. Supports the same get/[]/in/commentLines lookups
+# as ParamDict, so registry fields can be read from either. fromBytes wraps a
+# file that is already in memory (e.g. a member read from an archive) in the
+# same interface.
+class ParamFileMap:
+    def __init__(self, path, data=None):
+        self.path = path
+        if data is None:
+            with open(path, 'rb') as f:
+                if os.fstat(f.fileno()).st_size > 0:
+                    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                else:
+                    data = b''
+        self.data = data
+        # Parameter name -> decoded record, or None if the file has none
+        self.records = {}
+
+    @classmethod
+    def fromBytes(cls, data, path=None):
+        return cls(path, data)
+
+    # Value, shape and $$ comment lines of one record, or None if the file
+    # has no record by that name
+    def lookup(self, name):
+        try:
+            return self.records[name]
+        except KeyError:
+            pass
+        data = self.data
+        key = recordKey(name)
+        found = None
+        # One search for NAME=, checking that it starts a ##NAME= or ##$NAME=
+        # line, so that a missing record costs a single pass over the file
+        pos = data.find(key)
+        while pos >= 0:
+            head = pos - 1 if data[pos - 1:pos] == b'$' else pos
+            if head >= 2 and data[head - 2:head] == b'##' and \
+                    (head == 2 or data[head - 3:head - 2] == b'\n'):
+                start = pos + len(key)
+                end = data.find(b'\n##', start)
+                found = splitRecord(data[start:end if end >= 0 else len(data)].decode('utf-8', 'replace'))
+                break
+            pos = data.find(key, pos + 1)
+        self.records[name] = found
+        return found
+
+    # Decode one record into its value, shape and $$ comment lines
+    def record(self, name):
+        found = self.lookup(name)
+        if found is None:
+            raise KeyError(name)
+        return found
+
+    def __contains__(self, name):
+        return self.lookup(name) is not None
+
+    def __getitem__(self, name):
+        return self.record(name)[0]
+
+    def get(self, name, default=None):
+        found = self.lookup(name)
+        return found[0] if found is not None else default
+
+    def shape(self, name):
+        found = self.lookup(name)
+        return found[1] if found is not None else None
+
+    def commentLines(self, name):
+        found = self.lookup(name)
+        return found[2] if found is not None else []
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.data = b''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
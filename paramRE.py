@@ -9,9 +9,16 @@ This file contains helper code for a Bruker ParaVision 6 MRI data parameter
 generator. It defines regular expressions to identify common text structures
 in the parameter files.
 
+It also holds the field registry: for each logical field we report (RepTime,
+EchoTime, SUBJECT_id, ...) the file it comes from, the parameter name, a
+pattern compiled once at import time and a converter for the value. Adding a
+field to the summary is a one-line entry in scanFields or subjectFields.
+
 """
 
 import re
+import datetime
+import paramFile
 
 numInParentheses='\(\s\d+\s\)'
 numsInParentheses='\(\s(?:\d+\,*\s*)+\s\)'
@@ -24,6 +31,11 @@ textArray='([\w\s\n]+)'
 listOfFloats='((?:-*\d+\.*\d*[\s\n]*)+)'
 oneFloat='(-*\d+\.*\d*)'
 
+# Save time stamp from the $$ comment after ##OWNER, and the ParaVision version
+# string from ACQ_sw_version (e.g. PV 6.0.1 or PV-360.1.1)
+saveTime='([ -0-9+.-:]+)'
+pvVersion='(PV[ -]?(\d+)\.\d+(?:\.\d+)*)'
+
 # These are helper functions to create regular expressions for standard 
 # patterns we see in the ACQP and method files
 def regExOneLineAngleText(paramName):
@@ -51,4 +63,224 @@ def regExNextLine(paramName):
     return re.escape(paramName)+'='+text+'\n'+text 
 
 def regExComment(paramName):
-    return re.escape(paramName)+'='+numsInParentheses+'\n'+commentTextInAngles
\ No newline at end of file
+    return re.escape(paramName)+'='+numsInParentheses+'\n'+commentTextInAngles
+
+
+saveTimeRegex = re.compile(saveTime)
+pvVersionRegex = re.compile(pvVersion)
+
+# The fixed layouts ParaVision writes the save time in, at the start of the
+# $$ line after ##OWNER (the owner follows):
+#   PV6, PV360  2018-01-24 10:44:26.123 +0100  nmrsu
+#   PV5         Wed Jan 24 10:44:26 2018 CET (UT+1h)  nmrsu
+isoSaveTimeRegex = re.compile(r'\s*(\d{4})-(\d\d)-(\d\d)[ T](\d\d):(\d\d):(\d\d)(?:[.,](\d+))?'
+                              r'(?:\s*(?:([+-])(\d\d):?(\d\d)|(Z))(?![\d:]))?')
+pv5SaveTimeRegex = re.compile(r'\s*[A-Z][a-z]{2} ([A-Z][a-z]{2}) +(\d{1,2}) (\d\d):(\d\d):(\d\d) (\d{4})'
+                              r'(?: +[A-Za-z]+)?(?: +\(UT(?:([+-])(\d+(?:\.\d+)?)h?)?\))?')
+months = {name: i+1 for i, name in enumerate(('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+                                               'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'))}
+
+# One timezone object per UTC offset, shared by all the save times that have it
+timeZones = {}
+
+def timeZone(minutes):
+    if minutes not in timeZones:
+        timeZones[minutes] = datetime.timezone(datetime.timedelta(minutes=minutes))
+    return timeZones[minutes]
+
+
+# Decode a save time written in one of the fixed layouts, or return None.
+# Fields out of range (a month 13, an offset of a day or more) also give
+# None, leaving the value to the dateutil fallback of toSaveTime.
+def decodeSaveTime(value):
+    try:
+        return decodeFixedSaveTime(value)
+    except ValueError:
+        return None
+
+def decodeFixedSaveTime(value):
+    match = isoSaveTimeRegex.match(value)
+    if match is not None:
+        year, month, day, hour, minute, second, fraction, sign, tzHours, tzMinutes, utc = match.groups()
+        tz = None
+        if sign is not None:
+            minutes = int(tzHours)*60 + int(tzMinutes)
+            tz = timeZone(-minutes if sign == '-' else minutes)
+        elif utc is not None:
+            tz = timeZone(0)
+        microsecond = int(fraction[:6].ljust(6, '0')) if fraction else 0
+        return datetime.datetime(int(year), int(month), int(day), int(hour), int(minute),
+                                 int(second), microsecond, tz)
+    match = pv5SaveTimeRegex.match(value)
+    if match is not None and match.group(1) in months:
+        month, day, hour, minute, second, year, sign, tzHours = match.groups()
+        tz = None
+        if sign is not None:
+            minutes = round(float(tzHours)*60)
+            tz = timeZone(-minutes if sign == '-' else minutes)
+        elif match.group(0).rstrip().endswith('(UT)'):
+            tz = timeZone(0)
+        return datetime.datetime(int(year), months[month], int(day), int(hour), int(minute),
+                                 int(second), 0, tz)
+    return None
+
+
+# Converters applied to the value string of a field. Returning None means the
+# value could not be interpreted and the field is treated as missing.
+# toSaveTime takes the whole $$ line; layouts other than the fixed ones fall
+# back to dateutil, which is only imported then.
+def toSaveTime(value):
+    decoded = decodeSaveTime(value)
+    if decoded is not None:
+        return decoded
+    match = saveTimeRegex.match(value)
+    if match is None:
+        return None
+    from dateutil import parser
+    try:
+        saveTime = parser.parse(match.group(1))
+        # dateutil accepts offsets of a day or more, which only fail when used
+        saveTime.utcoffset()
+    except (ValueError, OverflowError):
+        return None
+    return saveTime
+
+# Naive UTC datetime for a save time; times without an offset are taken as
+# UTC. These sort correctly across offsets.
+def toUTC(saveTime):
+    if isinstance(saveTime, datetime.datetime) and saveTime.tzinfo is not None:
+        return saveTime.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return saveTime
+
+# Decode the save times of a whole study at once, e.g. to order its scans.
+# Repeated lines are decoded only once. With utc, times are returned as by
+# toUTC. Blank or undecodable values give None.
+def toSaveTimes(values, utc=False):
+    decoded = {}
+    for value in values:
+        if value not in decoded:
+            saveTime = toSaveTime(value) if value else None
+            decoded[value] = toUTC(saveTime) if utc else saveTime
+    return [decoded[value] for value in values]
+
+def toPVver(value):
+    match = pvVersionRegex.search(value)
+    return match.group(1) if match is not None else None
+
+def toMajorPVver(value):
+    match = pvVersionRegex.search(value)
+    return match.group(2) if match is not None else None
+
+
+# One registry entry. source is the parameter file ('acqp', 'method' or
+# 'subject'), paramName the record name without ##$. required fields raise
+# KeyError when missing, the others are left blank. imaging fields are not
+# read for singlepulse scans. comment fields take their value from the first
+# $$ comment line after the record (used for the save time after ##OWNER).
+# dtype (float or int) marks numeric fields for Acqp.typedParameters.
+# protocol fields define the acquisition protocol, as opposed to values that
+# change from scan to scan (save time, positioning, adjustments); they are
+# the ones fingerprinted by protocols.py.
+class Field:
+    def __init__(self, source, paramName, convert=None, required=False,
+                 imaging=True, comment=False, dtype=None, protocol=False):
+        self.source = source
+        self.paramName = paramName
+        self.convert = convert
+        self.required = required
+        self.imaging = imaging
+        self.comment = comment
+        self.dtype = dtype
+        self.protocol = protocol
+        if comment:
+            self.pattern = re.compile(r'^##' + re.escape(paramName) + r'=.*\n\$\$(.*)', re.M)
+        else:
+            self.pattern = re.compile(r'^##\$?' + re.escape(paramName) + r'=(.*(?:\n(?!##|\$\$).*)*)', re.M)
+
+    # Read the field from a paramFile.ParamDict or paramFile.ParamFileMap
+    def read(self, params):
+        return self.finish(self.rawValue(params))
+
+    # The value string of the field, before conversion, or None if missing
+    def rawValue(self, params):
+        if self.comment:
+            comments = params.commentLines(self.paramName)
+            return comments[0] if comments else None
+        return params.get(self.paramName)
+
+    # Find the field directly in the raw text of a parameter file
+    def search(self, text):
+        match = self.pattern.search(text)
+        if match is None:
+            value = None
+        elif self.comment:
+            value = match.group(1).strip()
+        else:
+            value = paramFile.recordValue(match.group(1).split('\n'))[0]
+        return self.finish(value)
+
+    def finish(self, value):
+        if value is not None and self.convert is not None:
+            value = self.convert(value)
+        if value is None and self.required:
+            raise KeyError(self.paramName)
+        return value
+
+
+# Bump parserVersion whenever paramFile or the registry below changes what
+# ends up in Acqp.parameters (or Acqp.shapes), so that cached scans are
+# parsed again.
+parserVersion = 2
+
+# Scan fields in the order they are read. Everything after SaveTime is only
+# read for imaging (non-singlepulse) scans.
+scanFields = {
+    'PulseProg':        Field('acqp', 'PULPROG', required=True, imaging=False, protocol=True),
+    'RepTime':          Field('acqp', 'ACQ_repetition_time', required=True, imaging=False, dtype=float, protocol=True),
+    'nAverages':        Field('method', 'PVM_NAverages', required=True, imaging=False, dtype=int, protocol=True),
+    'acqProtocol':      Field('acqp', 'ACQ_protocol_name', imaging=False, protocol=True),
+    'nRepetitions':     Field('method', 'PVM_NRepetitions', imaging=False, dtype=int, protocol=True),
+    'SaveTime':         Field('method', 'OWNER', toSaveTime, required=True, imaging=False, comment=True),
+    'refPower':         Field('method', 'PVM_RefPowCh1', dtype=float),
+    'ReceiverGain':     Field('acqp', 'RG', required=True, dtype=float),
+    'EchoTime':         Field('acqp', 'ACQ_echo_time', required=True, dtype=float, protocol=True),
+    'RecovTime':        Field('acqp', 'ACQ_recov_time', required=True, dtype=float, protocol=True),
+    'nEchoes':          Field('acqp', 'NECHOES', required=True, dtype=int, protocol=True),
+    'nSlices':          Field('method', 'PVM_SPackArrNSlices', required=True, dtype=int, protocol=True),
+    'nSlicePacks':      Field('method', 'PVM_NSPacks', required=True, dtype=int, protocol=True),
+    'FOV':              Field('method', 'PVM_Fov', required=True, dtype=float, protocol=True),
+    'Matrix':           Field('method', 'PVM_Matrix', required=True, dtype=int, protocol=True),
+    'SliceThick':       Field('method', 'PVM_SliceThick', required=True, dtype=float, protocol=True),
+    'SliceSep':         Field('method', 'PVM_SPackArrSliceGap', required=True, dtype=float, protocol=True),
+    'SliceList':        Field('method', 'PVM_ObjOrderList', required=True, dtype=int),
+    'SliceOffset':      Field('method', 'PVM_SliceOffset', required=True, dtype=float),
+    'SlicePackOffset':  Field('method', 'PVM_SPackArrSliceOffset', required=True, dtype=float),
+    'ReadOffset':       Field('method', 'PVM_ReadOffset', required=True, dtype=float),
+    'PhaseOffset':      Field('method', 'PVM_Phase1Offset', required=True, dtype=float),
+    'ImageOrient':      Field('method', 'PVM_SPackArrSliceOrient', required=True, protocol=True),
+    'nEvolutionCycles': Field('method', 'PVM_NEvolutionCycles', dtype=int, protocol=True),
+    'FlipAngle':        Field('acqp', 'ACQ_flip_angle', required=True, dtype=float, protocol=True),
+    'BasicFreq':        Field('acqp', 'BF1', required=True, dtype=float),
+    'SpecWidth':        Field('acqp', 'SW_h', required=True, dtype=float, protocol=True),
+    'ExcitationPulse':  Field('method', 'ExcPulse1Enum', protocol=True),
+    'RefocusingPulse':  Field('method', 'RefPulse1Enum', protocol=True),
+    'ReadOutDir':       Field('method', 'PVM_SPackArrReadOrient', required=True, protocol=True),
+    'RareFactor':       Field('method', 'PVM_RareFactor', dtype=int, protocol=True),
+    'FatSat':           Field('method', 'PVM_FatSupOnOff', protocol=True),
+    'Gating':           Field('method', 'PVM_TriggerModule', protocol=True),
+    'ByteOrder':        Field('acqp', 'BYTORDA', required=True),
+    'FlowDir':          Field('method', 'FlowEncodingDirection', protocol=True),
+    'Venc':             Field('method', 'FlowRange', dtype=float, protocol=True),
+    'PVver':            Field('acqp', 'ACQ_sw_version', toPVver),
+    'Major PV ver':     Field('acqp', 'ACQ_sw_version', toMajorPVver),
+}
+
+# Study fields read from the subject file
+subjectFields = {
+    'SUBJECT_id':         Field('subject', 'SUBJECT_id', required=True),
+    'SUBJECT_study_name': Field('subject', 'SUBJECT_study_name', required=True),
+    'SUBJECT_sex':        Field('subject', 'SUBJECT_sex'),
+    'SUBJECT_weight':     Field('subject', 'SUBJECT_weight'),
+    'SUBJECT_remarks':    Field('subject', 'SUBJECT_remarks'),
+    'SUBJECT_comment':    Field('subject', 'SUBJECT_comment'),
+}
\ No newline at end of file
@@ -0,0 +1,423 @@
+# -*- coding: utf-8 -*-
+"""
+All-parameters store: every ## record of the acqp and method files of every
+scan (and optionally of its pdata/1/reco and visu_pars files) extracted in one
+pass over an archive and kept in one compressed columnar file, so that a field
+that is not in the registry yet can be looked up from the store instead of
+rereading the raw data.
+
+The store is in long format, one row per record:
+    Study    study path
+    Scan     scan number
+    Source   acqp, method, reco or visu_pars
+    Name     record name, without the leading ## or ##$
+    Value    value string, as paramFile.recordValue gives it
+    Shape    declared ( n ) / ( n, m ) shape as 'n' or 'n,m', blank for scalars
+    Comment  the $$ comment lines after the record, joined with newlines
+
+The format follows the file extension, as for studyExport:
+    .parquet  one Parquet file with dictionary-encoded Study, Source, Name and
+              Shape columns, compressed with zstd (needs pyarrow). Lookups
+              only read the row groups and columns of the names asked for.
+    .npz      one compressed NumPy archive: params/<column> holds the codes of
+              the Study, Source, Name and Shape columns into the studies,
+              sources, names and shapes arrays and the scan numbers; the text
+              columns are stored as params/<column>.bytes (UTF-8) with
+              params/<column>.offsets, so that row i is
+              bytes[offsets[i]:offsets[i+1]]
+
+lookup reads any registry field (paramRE.Field, including comment fields
+such as the save time) for every scan of the store, with the field's
+conversion applied.
+
+Usage:
+    python paramStore.py build STORE [--reco] [-j WORKERS] study [study ...]
+    python paramStore.py names STORE
+    python paramStore.py query STORE FIELD [FIELD ...]
+
+FIELD is a registry field (e.g. FlipAngle) or SOURCE:NAME for any other
+record (e.g. method:PVM_DwEffBval).
+
+"""
+
+import os
+import sys
+import csv
+import glob
+import argparse
+import itertools
+import functools
+import concurrent.futures
+import numpy as np
+import paramRE as paRE
+import paramFile
+import studyFS
+import runReport
+import py_acqp
+
+# Parameter files of a scan, relative to its directory
+sourcePaths = {'acqp': 'acqp', 'method': 'method',
+               'reco': 'pdata/1/reco', 'visu_pars': 'pdata/1/visu_pars'}
+sources = list(sourcePaths)
+scanSources = ('acqp', 'method')
+recoSources = ('reco', 'visu_pars')
+
+textColumns = ('Value', 'Comment')
+
+# Every parameter file starts with ##TITLE, so loading it along with the names
+# asked for keeps every scan in the store
+titleName = 'TITLE'
+
+
+def shapeText(shape):
+    return '' if shape is None else ','.join(str(n) for n in shape)
+
+
+# Every record of the parameter files of one scan, as (source, name, value,
+# shape, comment) tuples. The reco sources are optional; scans that were not
+# reconstructed are stored without them. Module-level so that it can be run
+# in worker processes.
+def readScanRecords(studyDir, scanNum, fs=studyFS.localFS, scanFiles=scanSources):
+    records = []
+    for source in scanFiles:
+        path = fs.join(studyDir, scanNum, *sourcePaths[source].split('/'))
+        if source in recoSources and not fs.isfile(path):
+            continue
+        params = paramFile.parseParamText(fs.read(path).decode('utf-8', 'replace'))
+        for name, value in params.items():
+            records.append((source, name, value, shapeText(params.shape(name)),
+                            '\n'.join(params.commentLines(name))))
+    return records
+
+
+# Pack strings into one UTF-8 byte array and the length of each
+def packText(strings):
+    encoded = [s.encode('utf-8') for s in strings]
+    lengths = np.array([len(b) for b in encoded], dtype=np.int64)
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), lengths
+
+
+def lengthOffsets(lengths):
+    return np.concatenate(([0], np.cumsum(lengths, dtype=np.int64)))
+
+
+# The parameter records of a set of scans, held as columns (see the module
+# docstring). Codes index studies, sources, names and shapes; the text
+# columns are (bytes, offsets) pairs.
+class ParamStore:
+    def __init__(self, studies, names, shapes, columns):
+        self.studies = list(studies)
+        self.names = list(names)
+        self.shapes = list(shapes)
+        self.nameCodes = {name: code for code, name in enumerate(self.names)}
+        self.columns = columns
+
+    def __len__(self):
+        return len(self.columns['Scan'])
+
+    def text(self, column, row):
+        data, offsets = self.columns[column]
+        return data[offsets[row]:offsets[row + 1]].tobytes().decode('utf-8')
+
+    # Store restricted to the given rows (an index array)
+    def take(self, rows):
+        columns = {key: values[rows] for key, values in self.columns.items() if key not in textColumns}
+        for key in textColumns:
+            data, offsets = self.columns[key]
+            starts = offsets[rows]
+            lengths = offsets[rows + 1] - starts
+            newOffsets = lengthOffsets(lengths)
+            gather = np.repeat(starts - newOffsets[:-1], lengths) + np.arange(newOffsets[-1])
+            columns[key] = (data[gather], newOffsets)
+        return ParamStore(self.studies, self.names, self.shapes, columns)
+
+    # Store holding only the records of the given names (and the ##TITLE
+    # records that keep every scan listed)
+    def select(self, names):
+        codes = [self.nameCodes[name] for name in set(names) | {titleName} if name in self.nameCodes]
+        return self.take(np.flatnonzero(np.isin(self.columns['Name'], codes)))
+
+    # (study index, scan number) of every scan, and the scan of every record
+    def scans(self):
+        keys = (self.columns['Study'].astype(np.int64) << 32) | self.columns['Scan'].astype(np.int64)
+        scanKeys, inverse = np.unique(keys, return_inverse=True)
+        return [(int(k >> 32), int(k & 0xffffffff)) for k in scanKeys], inverse
+
+    # Values of registry fields (column -> paRE.Field) for every scan, as one
+    # dict per scan with Study and ScanNumber first. Fields a scan does not
+    # have are left blank, as in Acqp.
+    def lookup(self, fields):
+        scans, inverse = self.scans()
+        rows = [{'Study': self.studies[study], 'ScanNumber': str(scan)} for study, scan in scans]
+        for column, field in fields.items():
+            for row in rows:
+                row[column] = ''
+            if field.paramName not in self.nameCodes or field.source not in sources:
+                continue
+            mask = ((self.columns['Name'] == self.nameCodes[field.paramName])
+                    & (self.columns['Source'] == sources.index(field.source)))
+            for i in np.flatnonzero(mask):
+                if field.comment:
+                    value = self.text('Comment', i).split('\n')[0] or None
+                else:
+                    value = self.text('Value', i)
+                if value is not None and field.convert is not None:
+                    value = field.convert(value)
+                rows[inverse[i]][column] = '' if value is None else value
+        return rows
+
+    # Number of scans holding each record, as ((source, name), count) pairs
+    def nameCounts(self):
+        pairs = self.columns['Source'].astype(np.int64) * len(self.names) + self.columns['Name']
+        values, counts = np.unique(pairs, return_counts=True)
+        return [((sources[v // len(self.names)], self.names[v % len(self.names)]), int(c))
+                for v, c in zip(values, counts)]
+
+    def write(self, path):
+        if path.endswith('.parquet'):
+            return writeParquet(path, self)
+        if path.endswith('.npz'):
+            return writeNpz(path, self)
+        raise ValueError('Store file must end in .parquet or .npz: ' + path)
+
+
+# Collects the records of scans, one study at a time, into a ParamStore
+class StoreBuilder:
+    def __init__(self):
+        self.studies = []
+        self.names = {}
+        self.shapes = {'': 0}
+        self.chunks = []
+
+    def code(self, codes, key):
+        if key not in codes:
+            codes[key] = len(codes)
+        return codes[key]
+
+    # scans is a list of (scan number, records) pairs, records as returned by
+    # readScanRecords
+    def addStudy(self, studyPath, scans):
+        studyIndex = len(self.studies)
+        self.studies.append(os.path.abspath(studyPath))
+        records = [(int(scanNum),) + record for scanNum, scanRecords in scans for record in scanRecords]
+        chunk = {'Study': np.full(len(records), studyIndex, dtype=np.int32),
+                 'Scan': np.array([r[0] for r in records], dtype=np.int32),
+                 'Source': np.array([sources.index(r[1]) for r in records], dtype=np.uint8),
+                 'Name': np.array([self.code(self.names, r[2]) for r in records], dtype=np.int32),
+                 'Shape': np.array([self.code(self.shapes, r[4]) for r in records], dtype=np.int32),
+                 'Value': packText(r[3] for r in records),
+                 'Comment': packText(r[5] for r in records)}
+        self.chunks.append(chunk)
+
+    def store(self):
+        columns = {}
+        for key in ('Study', 'Scan', 'Source', 'Name', 'Shape'):
+            columns[key] = (np.concatenate([c[key] for c in self.chunks]) if self.chunks
+                            else np.empty(0, np.int32))
+        for key in textColumns:
+            data = [c[key][0] for c in self.chunks]
+            lengths = [c[key][1] for c in self.chunks]
+            columns[key] = (np.concatenate(data) if data else np.empty(0, np.uint8),
+                            lengthOffsets(np.concatenate(lengths) if lengths else np.empty(0, np.int64)))
+        return ParamStore(self.studies, self.names, self.shapes, columns)
+
+
+# Extract every record of the scans of each study and return the store. With
+# reco the pdata/1 reco and visu_pars files are included. With workers > 1
+# the scans are read in a process pool. A scan or study that cannot be read
+# is reported and left out.
+def buildStore(paths, workers=1, reco=False):
+    scanFiles = scanSources + recoSources if reco else scanSources
+    builder = StoreBuilder()
+    pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    mapScans = pool.map if pool is not None else map
+    try:
+        for curDir in paths:
+            try:
+                fs, studyDir = py_acqp.findStudyDir(curDir)
+                try:
+                    scanNums = py_acqp.listScans(studyDir, fs)
+                    results = mapScans(functools.partial(py_acqp.isolated, readScanRecords),
+                                       itertools.repeat(studyDir), scanNums, itertools.repeat(fs),
+                                       itertools.repeat(scanFiles))
+                    scans = []
+                    for d, records in zip(scanNums, results):
+                        if isinstance(records, Exception):
+                            print('Skipping scan ' + d + ' of ' + curDir + ': ' + runReport.errorText(records),
+                                  file=sys.stderr)
+                        else:
+                            scans.append((d, records))
+                finally:
+                    fs.close()
+            except Exception as err:
+                print('Skipping ' + curDir + ': ' + runReport.errorText(err), file=sys.stderr)
+                continue
+            builder.addStudy(curDir, scans)
+            print('%s: %d scans' % (curDir, len(scans)))
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    return builder.store()
+
+
+def writeNpz(path, store):
+    arrays = {'studies': np.array(store.studies, dtype=str), 'sources': np.array(sources, dtype=str),
+              'names': np.array(store.names, dtype=str), 'shapes': np.array(store.shapes, dtype=str)}
+    for key, values in store.columns.items():
+        if key in textColumns:
+            arrays['params/' + key + '.bytes'], arrays['params/' + key + '.offsets'] = values
+        else:
+            arrays['params/' + key] = values
+    tempPath = path[:-len('.npz')] + '.tmp.npz'
+    np.savez_compressed(tempPath, **arrays)
+    os.replace(tempPath, path)
+    return [path]
+
+
+def readNpz(path, names=None):
+    with np.load(path) as archive:
+        if list(archive['sources']) != sources:
+            raise ValueError('Unknown sources in ' + path)
+        columns = {}
+        for key in ('Study', 'Scan', 'Source', 'Name', 'Shape'):
+            columns[key] = archive['params/' + key]
+        for key in textColumns:
+            columns[key] = (archive['params/' + key + '.bytes'], archive['params/' + key + '.offsets'])
+        store = ParamStore(archive['studies'].tolist(), archive['names'].tolist(),
+                           archive['shapes'].tolist(), columns)
+    return store.select(names) if names is not None else store
+
+
+def dictionaryArray(codes, dictionary):
+    import pyarrow as pa
+    return pa.DictionaryArray.from_arrays(pa.array(codes), pa.array(dictionary, type=pa.string()))
+
+
+def textArray(data, offsets):
+    import pyarrow as pa
+    return pa.LargeStringArray.from_buffers(len(offsets) - 1, pa.py_buffer(offsets), pa.py_buffer(data))
+
+
+def writeParquet(path, store):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    columns = store.columns
+    table = pa.table({'Study': dictionaryArray(columns['Study'], store.studies),
+                      'Scan': pa.array(columns['Scan']),
+                      'Source': dictionaryArray(columns['Source'].astype(np.int32), sources),
+                      'Name': dictionaryArray(columns['Name'], store.names),
+                      'Value': textArray(*columns['Value']),
+                      'Shape': dictionaryArray(columns['Shape'], store.shapes),
+                      'Comment': textArray(*columns['Comment'])})
+    tempPath = path + '.tmp'
+    pq.write_table(table, tempPath, compression='zstd')
+    os.replace(tempPath, path)
+    return [path]
+
+
+# Codes and dictionary of a (possibly dictionary-encoded) string column
+def columnCodes(column):
+    import pyarrow as pa
+    if pa.types.is_dictionary(column.type):
+        column = column.cast(pa.string())
+    encoded = column.dictionary_encode().combine_chunks()
+    return encoded.indices.to_numpy(zero_copy_only=False).astype(np.int32), encoded.dictionary.to_pylist()
+
+
+def columnText(column):
+    import pyarrow as pa
+    array = column.cast(pa.large_string()).combine_chunks()
+    offsets = np.frombuffer(array.buffers()[1], dtype=np.int64)[array.offset:array.offset + len(array) + 1]
+    data = np.frombuffer(array.buffers()[2], dtype=np.uint8) if array.buffers()[2] is not None \
+        else np.empty(0, np.uint8)
+    return data[offsets[0]:offsets[-1]], offsets - offsets[0]
+
+
+def readParquet(path, names=None):
+    import pyarrow.parquet as pq
+    filters = [('Name', 'in', sorted(set(names) | {titleName}))] if names is not None else None
+    table = pq.read_table(path, filters=filters)
+    columns = {'Scan': table.column('Scan').to_numpy().astype(np.int32)}
+    studyCodes, studies = columnCodes(table.column('Study'))
+    sourceCodes, sourceNames = columnCodes(table.column('Source'))
+    columns['Study'] = studyCodes
+    columns['Source'] = np.array([sources.index(s) for s in sourceNames], dtype=np.uint8)[sourceCodes] \
+        if sourceNames else np.empty(0, np.uint8)
+    columns['Name'], names = columnCodes(table.column('Name'))
+    columns['Shape'], shapes = columnCodes(table.column('Shape'))
+    for key in textColumns:
+        columns[key] = columnText(table.column(key))
+    return ParamStore(studies, names, shapes, columns)
+
+
+# Load a store; with names, only the records of those names are loaded
+def loadStore(path, names=None):
+    if path.endswith('.parquet'):
+        return readParquet(path, names)
+    if path.endswith('.npz'):
+        return readNpz(path, names)
+    raise ValueError('Store file must end in .parquet or .npz: ' + path)
+
+
+# Registry field for a command line FIELD: a registry key, or SOURCE:NAME
+def parseField(spec):
+    if spec in paRE.scanFields:
+        return paRE.scanFields[spec]
+    source, sep, name = spec.partition(':')
+    if not sep or source not in sourcePaths:
+        raise ValueError('Not a registry field or SOURCE:NAME: ' + spec)
+    return paRE.Field(source, name.lstrip('$'))
+
+
+def main(argv=None):
+    argParser = argparse.ArgumentParser(description='Extract and query every parameter of every scan.')
+    commands = argParser.add_subparsers(dest='command', required=True)
+
+    build = commands.add_parser('build', help='extract all parameters of the studies into a store')
+    build.add_argument('store', help='store file (.parquet or .npz)')
+    build.add_argument('paths', nargs='+',
+                       help='study directories or .PVDatasets/.zip/.tar archives, or glob patterns')
+    build.add_argument('--reco', action='store_true',
+                       help='also extract the pdata/1 reco and visu_pars files')
+    build.add_argument('-j', '--workers', type=int, default=1,
+                       help='number of worker processes (default 1)')
+
+    names = commands.add_parser('names', help='list the records in the store, with their scan counts')
+    names.add_argument('store', help='store file (.parquet or .npz)')
+
+    query = commands.add_parser('query', help='print fields of every scan as CSV')
+    query.add_argument('store', help='store file (.parquet or .npz)')
+    query.add_argument('fields', nargs='+', help='registry field (e.g. FlipAngle) or SOURCE:NAME')
+    args = argParser.parse_args(argv)
+
+    writer = csv.writer(sys.stdout, lineterminator='\n')
+    if args.command == 'build':
+        paths = [m for p in args.paths for m in sorted(glob.glob(p))
+                 if os.path.isdir(m) or studyFS.isArchive(m)]
+        store = buildStore(paths, workers=args.workers, reco=args.reco)
+        for path in store.write(args.store):
+            print(path)
+        return 0
+
+    if args.command == 'names':
+        writer.writerow(['Source', 'Name', 'Scans'])
+        for (source, name), count in loadStore(args.store).nameCounts():
+            writer.writerow([source, name, count])
+        return 0
+
+    try:
+        fields = {spec: parseField(spec) for spec in args.fields}
+    except ValueError as err:
+        print(err, file=sys.stderr)
+        return 1
+    store = loadStore(args.store, [field.paramName for field in fields.values()])
+    rows = store.lookup(fields)
+    dictWriter = csv.DictWriter(sys.stdout, lineterminator='\n',
+                                fieldnames=['Study', 'ScanNumber'] + list(fields))
+    dictWriter.writeheader()
+    dictWriter.writerows(rows)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+Protocol fingerprints, so that the many scans that repeat the same protocol
+are stored once and compared by a hash lookup instead of field by field.
+
+The fingerprint of a scan is a SHA-1 over the protocol fields of the
+registry (paramRE.scanFields entries with protocol=True: pulse program,
+TR, TE, FOV, matrix, slice settings, pulses, ...), with numeric values
+normalized so that e.g. '2500', '2500.0' and PV360's '@2*(30)' / '30 30'
+give the same fingerprint. Save times, slice positions, reference power,
+receiver gain and frequency are left out, since they change from scan to
+scan. The first 12 hex digits are the protocol ID, which is stable across
+runs and archives.
+
+ProtocolTable interns the protocols of a set of scans: one row per distinct
+protocol with its fields and scan count, and one row per scan holding only
+its protocol ID and the fields that are not part of the protocol.
+deviations(protocolID) lists the scans that carry the same protocol name but
+a different fingerprint, with the fields that differ; the difference is
+worked out once per distinct protocol, not per scan.
+
+Usage, on a scanIndex file:
+    python protocols.py INDEX [--out BASE] [--deviations PROTOCOL_ID]
+
+"""
+
+import sys
+import csv
+import hashlib
+import argparse
+import paramRE as paRE
+import paramFile
+
+protocolFields = [key for key, field in paRE.scanFields.items() if field.protocol]
+
+
+def canonicalNumber(number):
+    return str(int(number)) if number.is_integer() else repr(number)
+
+
+# Value of a field as it enters the fingerprint: numbers are written in one
+# form (runs expanded, 2500 == 2500.0), text has its whitespace collapsed
+def canonicalValue(key, value):
+    if value is None:
+        return ''
+    if not isinstance(value, str):
+        value = str(value)
+    field = paRE.scanFields.get(key)
+    if field is not None and field.dtype is not None and value:
+        if '@' in value:
+            value = paramFile.repeatRun.sub(lambda m: ' '.join([m.group(2).strip()] * int(m.group(1))),
+                                            value)
+        try:
+            return ' '.join(canonicalNumber(float(v)) for v in value.split())
+        except ValueError:
+            pass
+    return ' '.join(value.split())
+
+
+def protocolValues(parameters):
+    return {key: canonicalValue(key, parameters.get(key)) for key in protocolFields}
+
+
+# SHA-1 of the canonical protocol field values
+def fingerprintValues(values):
+    text = '\n'.join(key + '=' + values[key] for key in protocolFields)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def fingerprint(parameters):
+    return fingerprintValues(protocolValues(parameters))
+
+
+def protocolID(parameters):
+    return fingerprint(parameters)[:12]
+
+
+# Fields whose values differ between two protocols, as key -> (value in a,
+# value in b)
+def diffProtocols(a, b):
+    return {key: (a[key], b[key]) for key in protocolFields if a[key] != b[key]}
+
+
+class ProtocolTable:
+    def __init__(self):
+        # Protocol ID -> canonical protocol field values
+        self.protocols = {}
+        self.counts = {}
+        # One (study, parameters without the protocol fields, protocol ID)
+        # per scan
+        self.scans = []
+
+    # Add one scan, given its Acqp.parameters (or a scanIndex row), and
+    # return its protocol ID
+    def add(self, study, parameters):
+        values = protocolValues(parameters)
+        pid = fingerprintValues(values)[:12]
+        if pid not in self.protocols:
+            self.protocols[pid] = values
+            self.counts[pid] = 0
+        self.counts[pid] += 1
+        self.scans.append((study, {key: value for key, value in parameters.items()
+                                   if key not in values}, pid))
+        return pid
+
+    # Pass the scans of a study through, adding each one to the table
+    def collect(self, study, scans):
+        for curAcqp in scans:
+            self.add(study, curAcqp.parameters)
+            yield curAcqp
+
+    # Scans with the same protocol name (acqProtocol) as protocol pid but a
+    # different fingerprint, as (study, scan parameters, their protocol ID,
+    # differing fields) tuples
+    def deviations(self, pid):
+        reference = self.protocols[pid]
+        diffs = {other: diffProtocols(reference, values) for other, values in self.protocols.items()
+                 if other != pid and values['acqProtocol'] == reference['acqProtocol']}
+        return [(study, parameters, other, diffs[other])
+                for study, parameters, other in self.scans if other in diffs]
+
+    # Write BASE_protocols.csv (one row per protocol) and BASE_scans.csv (one
+    # row per scan with its protocol ID and the remaining columns); returns
+    # the paths written
+    def write(self, base, scanColumns):
+        paths = [base + '_protocols.csv', base + '_scans.csv']
+        with open(paths[0], 'w') as f:
+            writer = csv.writer(f, lineterminator='\n')
+            writer.writerow(['ProtocolID', 'Scans'] + protocolFields)
+            for pid, values in sorted(self.protocols.items(), key=lambda item: -self.counts[item[0]]):
+                writer.writerow([pid, self.counts[pid]] + [values[key] for key in protocolFields])
+        columns = [c for c in scanColumns if c not in protocolFields]
+        with open(paths[1], 'w') as f:
+            writer = csv.writer(f, lineterminator='\n')
+            writer.writerow(['Study', 'ProtocolID'] + columns)
+            for study, parameters, pid in self.scans:
+                writer.writerow([study, pid] + [parameters.get(c, '') for c in columns])
+        return paths
+
+
+def main(argv=None):
+    import scanIndex
+    argParser = argparse.ArgumentParser(description='Protocol table and deviations from a scan index.')
+    argParser.add_argument('index', help='SQLite index file (see scanIndex.py)')
+    argParser.add_argument('--out', metavar='BASE',
+                           help='write BASE_protocols.csv and BASE_scans.csv')
+    argParser.add_argument('--deviations', metavar='PROTOCOL_ID',
+                           help='list the scans named like this protocol that deviate from it')
+    args = argParser.parse_args(argv)
+
+    index = scanIndex.ScanIndex(args.index)
+    try:
+        table = ProtocolTable()
+        for row in index.query():
+            table.add(row['studyPath'], row)
+    finally:
+        index.close()
+
+    if args.out:
+        for path in table.write(args.out, scanIndex.scanColumns):
+            print(path)
+    if args.deviations:
+        if args.deviations not in table.protocols:
+            print('No protocol ' + args.deviations, file=sys.stderr)
+            return 1
+        writer = csv.writer(sys.stdout, lineterminator='\n')
+        writer.writerow(['Study', 'ScanNumber', 'ProtocolID', 'Field', 'Expected', 'Found'])
+        for study, parameters, pid, diff in table.deviations(args.deviations):
+            for key, (expected, found) in diff.items():
+                writer.writerow([study, parameters.get('ScanNumber'), pid, key, expected, found])
+    if not args.out and not args.deviations:
+        writer = csv.writer(sys.stdout, lineterminator='\n')
+        writer.writerow(['ProtocolID', 'Scans', 'acqProtocol', 'PulseProg'])
+        for pid, values in sorted(table.protocols.items(), key=lambda item: -table.counts[item[0]]):
+            writer.writerow([pid, table.counts[pid], values['acqProtocol'], values['PulseProg']])
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -7,13 +7,23 @@ Updated 10/11/2021
 
 This script creates .csv formatted parameter files for a Bruker PV6 MRI study, for easy reference.
 
-When run, the script opens a directory dialog and allows the user to select multiple directories.
+Study directories can be given on the command line (directly or as glob patterns):
+    python py_acqp.py [-j WORKERS] [--io-threads N] [-f csv|jsonl|stdout] [--cache FILE [--hash]]
+                      [--export FILE] [--protocols BASE] [--qa BASE] [--report] [--profile FILE]
+                      [--errors FILE] [--resume CHECKPOINT]
+                      [--gui] [study ...]
+When run without paths, or with --gui, the script opens a directory dialog and allows
+the user to select multiple directories. Importing this file has no side effects, and
+summarize_studies() can be called directly from other scripts.
 
 The current version assumes that data is organized in the following directory structure:
     [study directory] named for study name
         [subdirectory] 'Raw_Data'
             [sub-subdirectory] Bruker raw data folder and .study text file as 
                                unzipped from the .PVDatasets file exported from the scanner
+The .PVDatasets file (or a .zip/.tar archive of the study) can also be given directly, in
+which case the parameter files are read from the archive without unpacking it (see studyFS)
+and the .csv file is written next to the archive.
 
 It creates a .csv file in the study directory listing basic parameter information about each scan, 
 sorted by scan time.
@@ -25,496 +35,760 @@ formatting Bruker uses in its parameter files.
 
 """
 
-import re
-import csv
 import sys
 import os
 import os.path
-from PyQt5.QtWidgets import (QFileDialog, QAbstractItemView, QListView,
-                             QTreeView, QApplication, QDialog)
-from PyQt5.QtCore import QCoreApplication
-from dateutil import parser
+import time
+import glob
+import argparse
+import itertools
+import functools
+import concurrent.futures
 import paramRE as paRE
-
-# File paths for test driving the script. At some point a separate
-# testing script should be written and these should be removed.
-
-#acqpPath = 'D:\\Documents\\PythonScripts\\UnitTests\\acqp_multiTR'
-#acqpPath = 'D:\\Documents\\PythonScripts\\UnitTests\\acqp_multiTE'
-#acqpPath = 'D:\\Documents\\PythonScripts\\UnitTests\\acqp_longTR'
-
-#acqpFile = open(acqpPath)
-#acqpText = acqpFile.read()
-#acqpFile.close()
-
-
-#methodPath = 'D:\\Documents\\PythonScripts\\UnitTests\\method1'
-##methodPath = 'D:\\Documents\\PythonScripts\\UnitTests\\method_multi_slicePack'
-#methodFile = open(methodPath)
-#methodText = methodFile.read()
-#methodFile.close()
+import paramFile
+import scanCache
+import studySinks
+import studyFS
+import ioPool
+import runReport
+import scanRecord
+import checkpoint
 
 
 # This is the Acqp class that reads parameters for a single scan and stores them
-# in a dictionary.
+# in a dictionary-like record.
 class Acqp:
-    def __init__(self, scanNum):
-        # Define the dictionary structures for the apramters we want to read
-        self.parameters = {
-            'ScanNumber':scanNum,
-            'PulseProg':'',
-            'acqProtocol':'',
-            'refPower':'',
-            'ReceiverGain':'',
-            'RepTime':'',
-            'EchoTime':'',
-            'nEchoes':'',
-            'RecovTime':'',
-            'nSlices':'',
-            'nSlicePacks':'',
-            'FOV':'',
-            'Matrix':'',
-            'SliceThick':'',
-            'SliceSep':'',
-            'SliceList':'',
-            'SliceOffset':'',
-            'SlicePackOffset':'',
-            'ReadOffset':'',
-            'PhaseOffset':'',
-            'nAverages':'',
-            'ImageOrient':'',
-            'SlicepackVec':'',
-            'nEvolutionCycles':'',
-            'nRepetitions':'',
-            'EvolutionDelay':'',
-            'FlipAngle':'',
-            'IdealFAat':'',
-            'BasicFreq':'',
-            'SpecWidth':'',
-            'ExcitationPulse':'',
-            'RefocusingPulse':'',
-            'PulseShape':'',
-            'ReadOutDir':'',
-            'RareFactor':'',
-            'FatSat':'',
-            'Gating':'',
-            'wordType':'',
-            'rawWordType':'',
-            'ByteOrder':'',
-            'SaveTime':'',
-            'Filename':'',
-            'MusWt':'',
-            'subjOrientHF':'',
-            'subjOrientSP':'',
-            'PVver':'',
-            'Major PV ver':'',
-            'dwiBvals':'',
-            'dwiA0':'',
-            'FlowDir':'',
-            'Venc':'',
-        }
-
-        self.csvParameters = {
-            'ScanNumber':0,
-            'acqProtocol':'',
-            'refPower':'',
-            'ReceiverGain':'',
-            'RepTime':'',
-            'EchoTime':'',
-            'nEchoes':'',
-            'nSlices':'',
-            'FOV':'',
-            'Matrix':'',
-            'SliceThick':'',
-            'SliceSep':'',
-            'nAverages':'',
-            'ImageOrient':'',
-            'nEvolutionCycles':'',
-            'nRepetitions':'',
-            'SlicePackOffset':'',
-            'ReadOutDir':'',
-            'ReadOffset':'',
-            'PhaseOffset':'',
-            'RareFactor':'',
-            'ExcitationPulse':'',
-            'RefocusingPulse':'',
-            'SpecWidth':'',
-            'FatSat':'',
-            'Gating':'',
-            'FlipAngle':'',
-            'SaveTime':'',
-            'FlowDir':'',
-            'Venc':'',
-        }
-
-    def readParameters(self, acqpText, methodText):
-        # Create and search a regular expression for each parameter.
-        # Store the value in the parameter dictionary.
-
-        # Pulse Program
-        pulseProgRegex = re.compile(paRE.regExAngleText('##$PULPROG'))
-        self.parameters['PulseProg'] = pulseProgRegex.search(acqpText).group(1)
-
-        # Repetition time
-        pvRepTimeRegex = re.compile(paRE.regExFloatArray('##$ACQ_repetition_time'))
-        self.parameters['RepTime'] = pvRepTimeRegex.search(acqpText).group(1).replace('\n', '')
-
-        # nAverages
-        nAveragesRegex = re.compile(paRE.regExOneFloat('##$PVM_NAverages'))
-        self.parameters['nAverages'] = nAveragesRegex.search(methodText).group(1)
-
-        # Acquisition protocol
-        acqProtRegex = re.compile(paRE.regExAngleText('##$ACQ_protocol_name'))
-        match = acqProtRegex.search(acqpText)
-        if match is not None:
-            self.parameters['acqProtocol'] = match.group(1)
-        else:
-            print('acqProtocol not found, leaving blank')
-            self.parameters['acqProtocol'] = ''
-
-         # nRepetitions
-        nRepsRegex = re.compile(paRE.regExOneFloat('##$PVM_NRepetitions'))
-        match = nRepsRegex.search(methodText)
-        if match is not None:
-            self.parameters['nRepetitions'] = match.group(1)
-        else:
-            print('nRepetitions not found, leaving blank')
-            self.parameters['nRepetitions'] = ''
-
-        #'SaveTime':'',
-        saveTimeRegex = re.compile('\#\#OWNER\=(?:\w+)\s\$\$\s([ -0-9+.-:]+)')
-        self.parameters['SaveTime'] = parser.parse(saveTimeRegex.search(methodText).group(1))
+    __slots__ = ('parameters', 'shapes', 'timings', 'bytesRead', 'missing')
 
-        if 'singlepulse' in self.parameters['PulseProg'].lower():
-            return
-
-        # Reference power
-        refPowerRegex = re.compile(paRE.regExOneFloat('##$PVM_RefPowCh1'))
-        match = refPowerRegex.search(methodText)
-        if match is not None:
-            self.parameters['refPower'] = match.group(1)
-        else:
-            print('refPower not found, leaving blank')
-            self.parameters['refPower'] = ''
-            #print('Scan ', self.parameters['ScanNum'], ': refPower not found')
-
-        # Receiver Gain
-        refGainRegex = re.compile(paRE.regExOneFloat('##$RG'))
-        self.parameters['ReceiverGain'] = refGainRegex.search(acqpText).group(1)
-
-        # Echo time
-        #curRegexString=re.escape('##$echo=')+numInParentheses+'\s'+listOfFloats
-        pvEchoTimeRegex = re.compile(paRE.regExFloatArray('##$ACQ_echo_time'))
-        self.parameters['EchoTime'] = pvEchoTimeRegex.search(acqpText).group(1).replace('\n', '')
-
-        # Recovery time
-        pvRecovTimeRegex = re.compile(paRE.regExFloatArray('##$ACQ_recov_time'))
-        self.parameters['RecovTime'] = pvRecovTimeRegex.search(acqpText).group(1).replace('\n', '')
-
-        # Number of echoes
-        nEchoesRegex = re.compile(paRE.regExOneFloat('##$NECHOES'))
-        self.parameters['nEchoes'] = nEchoesRegex.search(acqpText).group(1)
-
-        # Number of slices
-        nSlicesRegex = re.compile(paRE.regExFloatArray('##$PVM_SPackArrNSlices'))
-        self.parameters['nSlices'] = nSlicesRegex.search(methodText).group(1).replace('\n', '')
-
-        # Number of slice packs
-        nSlicePacksRegex = re.compile(paRE.regExOneFloat('##$PVM_NSPacks'))
-        self.parameters['nSlicePacks'] = nSlicePacksRegex.search(methodText).group(1)
-
-        # Field of view
-        fovRegex = re.compile(paRE.regExFloatArray('##$PVM_Fov'))
-        self.parameters['FOV'] = fovRegex.search(methodText).group(1).replace('\n', '')
-
-        # Matrix
-        matrixRegex = re.compile(paRE.regExFloatArray('##$PVM_Matrix'))
-        self.parameters['Matrix'] = matrixRegex.search(methodText).group(1).replace('\n', '')
-
-        # SliceThick
-        sliceThickRegex = re.compile(paRE.regExOneFloat('##$PVM_SliceThick'))
-        self.parameters['SliceThick'] = sliceThickRegex.search(methodText).group(1)
-
-        # SliceSep
-        sliceSepRegex = re.compile(paRE.regExFloatArray('##$PVM_SPackArrSliceGap'))
-        self.parameters['SliceSep'] = sliceSepRegex.search(methodText).group(1).replace('\n', '')
-
-        # SliceList
-        sliceListRegex = re.compile(paRE.regExFloatArray('##$PVM_ObjOrderList'))
-        self.parameters['SliceList'] = sliceListRegex.search(methodText).group(1).replace('\n', '')
-
-        # SliceOffset
-        sliceOffsetRegex = re.compile(paRE.regExFloatArray('##$PVM_SliceOffset'))
-        self.parameters['SliceOffset'] = sliceOffsetRegex.search(methodText).group(1).replace('\n', '')
-
-        # SlicePackOffset
-        slicePackOffsetRegex = re.compile(paRE.regExFloatArray('##$PVM_SPackArrSliceOffset'))
-        self.parameters['SlicePackOffset'] = slicePackOffsetRegex.search(methodText).group(1).replace('\n', '')
-
-        # ReadOffset
-        readOffsetRegex = re.compile(paRE.regExFloatArray('##$PVM_ReadOffset'))
-        self.parameters['ReadOffset'] = readOffsetRegex.search(methodText).group(1).replace('\n', '')
-
-        # PhaseOffset
-        phaseOffsetRegex = re.compile(paRE.regExFloatArray('##$PVM_Phase1Offset'))
-        self.parameters['PhaseOffset'] = phaseOffsetRegex.search(methodText).group(1).replace('\n', '')
-
-        # ImageOrient
-        imageOrientRegex = re.compile(paRE.regExTextArray('##$PVM_SPackArrSliceOrient'))
-        self.parameters['ImageOrient'] = imageOrientRegex.search(methodText).group(1).replace('\n', '')
-
-        #'SlicepackVec':'',
-
-        # nEvolutionCycles
-        nEvolCycleRegex = re.compile(paRE.regExOneFloat('##$PVM_NEvolutionCycles'))
-        match = nEvolCycleRegex.search(methodText)
-        if match is not None:
-            self.parameters['nEvolutionCycles'] = match.group(1)
-        else:
-            print('nEvolutionCycles not found, leaving blank')
-            self.parameters['nEvolutionCycles'] = ''
-
-        #'EvolutionDelay':'',
-
-        #'FlipAngle'
-        flipAngleRegex = re.compile(paRE.regExOneFloat('##$ACQ_flip_angle'))
-        self.parameters['FlipAngle'] = flipAngleRegex.search(acqpText).group(1)
-
-        #'IdealFAat':'',
-
-        #'BasicFreq'
-        basicFreqRegex = re.compile(paRE.regExOneFloat('##$BF1'))
-        self.parameters['BasicFreq'] = basicFreqRegex.search(acqpText).group(1)
-
-        #'SpecWidth'
-        specWidthRegex = re.compile(paRE.regExOneFloat('##$SW_h'))
-        self.parameters['SpecWidth'] = specWidthRegex.search(acqpText).group(1)
-
-        #'ExcitationPulse':'',
-        excPulseRegex = re.compile(paRE.regExOneLineAngleText('##$ExcPulse1Enum'))
-        match = excPulseRegex.search(methodText)
-        if match is not None:
-            self.parameters['ExcitationPulse'] = match.group(1)
-        else:
-            self.parameters['ExcitationPulse'] = ''
+    def __init__(self, scanNum):
+        # Parameters we want to read, in a slotted record (see scanRecord)
+        self.parameters = scanRecord.ScanRecord(scanNum)
 
-        #RefocusingPulse
-        refPulseRegex = re.compile(paRE.regExOneLineAngleText('##$RefPulse1Enum'))
-        match = refPulseRegex.search(methodText)
-        if match is not None:
-            self.parameters['RefocusingPulse'] = match.group(1)
-        else:
-            print('RefocusingPulse not found, leaving blank')
-            self.parameters['RefocusingPulse'] = ''
-        #'PulseShape':'',
-
-        #ReadOutDir
-        readOutDirRegex = re.compile(paRE.regExTextArray('##$PVM_SPackArrReadOrient'))
-        self.parameters['ReadOutDir'] = readOutDirRegex.search(methodText).group(1).replace('\n', '')
-
-        #RareFactor
-        rareFactorRegex = re.compile(paRE.regExOneFloat('##$PVM_RareFactor'))
-        match = rareFactorRegex.search(methodText)
-        if match is not None:
-            self.parameters['RareFactor'] = match.group(1).replace('\n', '')
-        else:
-            print('nEvolutionCycles not found, leaving blank')
-            self.parameters['RareFactor'] = ''
-
-        #FatSat
-        fatSatRegex = re.compile(paRE.regExOneLineText('##$PVM_FatSupOnOff'))
-        match = fatSatRegex.search(methodText)
-        if match is not None:
-            self.parameters['FatSat'] = match.group(1).replace('\n', '')
-        else:
-            print('FatSat not found, leaving blank')
-            self.parameters['FatSat'] = ''
-
-        #'Gating':'',
-        gatingRegex = re.compile(paRE.regExOneLineText('##$PVM_TriggerModule'))
-        match = gatingRegex.search(methodText)
-        if match is not None:
-            self.parameters['Gating'] = match.group(1).replace('\n', '')
-        else:
-            print('Gating not found, leaving blank')
-            self.parameters['Gating'] = ''
-        #'wordType':'',
-        #'rawWordType':'',
-
-        #'ByteOrder':'',
-        byteOrderRegex = re.compile(paRE.regExOneLineText('##$BYTORDA'))
-        self.parameters['ByteOrder'] = byteOrderRegex.search(acqpText).group(1)
-
-        #'Filename':'',
-        #'MusWt':'',
-        #'subjOrientHF':'',
-        #'subjOrientSP':'',
-
-        #'dwiBvals':'',
-        #'dwiA0':'',
-
-        #FlowDir
-        flowDirRegex = re.compile(paRE.regExOneLineText('##$FlowEncodingDirection'))
-        match = flowDirRegex.search(methodText)
-        if match is not None:
-            self.parameters['FlowDir'] = match.group(1)
-        else:
-            print('FlowDir not found, leaving blank')
-            self.parameters['FlowDir'] = ''
-
-        #Venc
-        vEncRegex = re.compile(paRE.regExOneFloat('##$FlowRange'))
-        match = vEncRegex.search(methodText)
-        if match is not None:
-            self.parameters['Venc'] = match.group(1)
-        else:
-            print('Venc not found, leaving blank')
-            self.parameters['Venc'] = ''
-
-        # PV Version
-        curRegexString = re.escape('##$ACQ_sw_version = ')+paRE.numInParentheses+'\s'+ '\<(PV (\d+)\.\d+\.*\d*)\>'
-        pvVerRegex = re.compile(curRegexString)
-        pvVerSearch = pvVerRegex.search(acqpText)
-        if pvVerSearch is not None:
-            self.parameters['PVver'] = pvVerSearch.group(1)
-            self.parameters['Major PV ver'] = pvVerSearch.group(2)
-        else:
-            print('PVver not found, leaving blank')
-            self.parameters['PVver'] = ''
-            self.parameters['Major PV ver'] = ''
+        # Declared ( n ) / ( n, m ) shapes of the array fields (scalars have
+        # none), in a table shared with the scans that have the same shapes
+        # (see scanRecord.internShapes)
+        self.shapes = scanRecord.internShapes({})
 
-        for p in self.csvParameters.keys():
-            self.csvParameters[p] = self.parameters[p]
+        # Seconds spent per stage, bytes read and fields found missing while
+        # reading this scan, for the run report (see runReport). They are
+        # dropped by releaseStats once the scan has been accounted for.
+        self.timings = {}
+        self.bytesRead = 0
+        self.missing = ()
 
-# This is where we iterate over directories and compile parameters from all scans i
+    def readParameters(self, acqpText, methodText):
+        # Find only the records of the fields we want in each file (see
+        # paramFile.ParamFileMap) rather than splitting the whole file.
+        start = time.perf_counter()
+        params = {'acqp': paramFile.ParamFileMap.fromBytes(acqpText.encode('utf-8')),
+                  'method': paramFile.ParamFileMap.fromBytes(methodText.encode('utf-8'))}
+        self.timings['parse'] = time.perf_counter() - start
+        self.readFields(params)
+
+    # Look up every field in the registry and store its value in the
+    # parameter dictionary. params maps each source file name to a
+    # paramFile.ParamDict or paramFile.ParamFileMap.
+    def readFields(self, params):
+        start = time.perf_counter()
+        saveTimeSeconds = 0.0
+        shapes = dict(self.shapes)
+        # PulseProg is read first; the imaging fields are skipped for
+        # singlepulse scans
+        imaging = True
+        for key, field in paRE.scanFields.items():
+            if field.imaging and not imaging:
+                continue
+            if key == 'SaveTime':
+                fieldStart = time.perf_counter()
+                value = field.read(params[field.source])
+                saveTimeSeconds = time.perf_counter() - fieldStart
+            else:
+                value = field.read(params[field.source])
+            if key == 'PulseProg':
+                imaging = 'singlepulse' not in value.lower()
+            if value is None:
+                print(key + ' not found, leaving blank', file=sys.stderr)
+                self.missing += (key,)
+                value = ''
+            elif not field.comment:
+                shape = params[field.source].shape(field.paramName)
+                if shape is not None:
+                    shapes[key] = shape
+            self.parameters[key] = value
+        self.shapes = scanRecord.internShapes(shapes)
+
+        self.timings['saveTime'] = saveTimeSeconds
+        self.timings['parse'] = (self.timings.get('parse', 0.0)
+                                 + time.perf_counter() - start - saveTimeSeconds)
+
+    # Rebuild a scan from previously parsed parameters (e.g. from the cache)
+    @classmethod
+    def fromParameters(cls, scanNum, parameters, shapes=None):
+        curAcqp = cls(scanNum)
+        curAcqp.parameters.update(parameters)
+        curAcqp.shapes = scanRecord.internShapes({key: shape for key, shape in (shapes or {}).items()
+                                                  if shape is not None})
+        return curAcqp
+
+    # Drop the per-scan statistics once they are in the run report, so that
+    # scans held for a whole run (export, protocol and QA tables) carry only
+    # their parameters
+    def releaseStats(self):
+        self.timings = None
+        self.bytesRead = 0
+        self.missing = ()
+
+    # Pickle (for worker processes) so that the shapes table is shared again
+    # when unpickled
+    def __reduce__(self):
+        return (restoreAcqp, (self.parameters, self.shapes, self.timings, self.bytesRead, self.missing))
+
+    # Copy of the parameters with the numeric registry fields decoded: arrays
+    # become NumPy arrays of their declared shape and scalars Python numbers.
+    # Blank fields become None; values that do not decode are left as text.
+    def typedParameters(self):
+        typed = dict(self.parameters)
+        for key, field in paRE.scanFields.items():
+            value = typed.get(key)
+            if field.dtype is None or not isinstance(value, str):
+                continue
+            if value == '':
+                typed[key] = None
+                continue
+            try:
+                typed[key] = paramFile.decodeNumbers(value, self.shapes.get(key), field.dtype)
+            except ValueError:
+                print(key + ' could not be decoded, leaving as text', file=sys.stderr)
+        return typed
+
+    # The CSV columns, as a view over the parameters
+    @property
+    def csvParameters(self):
+        return self.parameters.csvView()
+
+    def __getitem__(self, key):
+        return self.parameters[key]
+
+
+def restoreAcqp(parameters, shapes, timings, bytesRead, missing):
+    curAcqp = Acqp.__new__(Acqp)
+    curAcqp.parameters = parameters
+    curAcqp.shapes = scanRecord.internShapes(shapes)
+    curAcqp.timings = timings
+    curAcqp.bytesRead = bytesRead
+    curAcqp.missing = missing
+    return curAcqp
+
+
+# Acqp counterpart that only reads what is asked for. lazyAcqp['SaveTime']
+# decodes that one record from the memory-mapped file it lives in, touching
+# no other file, and remembers the value. The parameters and csvParameters
+# mappings are still available; the first time either is used the scan is read
+# in full as for an Acqp. Mapped files stay open until release() is called
+# (or the scan is read in full).
+class LazyAcqp:
+    def __init__(self, studyDir, scanNum, fs=studyFS.localFS):
+        self.scanNum = scanNum
+        self.fs = fs
+        self.scanDir = fs.join(studyDir, scanNum)
+        self.files = {}
+        self.values = {'ScanNumber': scanNum}
+        self.acqp = None
+
+    def file(self, source):
+        if source not in self.files:
+            self.files[source] = self.fs.paramFile(self.fs.join(self.scanDir, source))
+        return self.files[source]
+
+    def __getitem__(self, key):
+        if self.acqp is not None:
+            return self.acqp.parameters[key]
+        if key not in self.values:
+            field = paRE.scanFields.get(key)
+            if field is None:
+                # Parameters that are never read stay blank, as in Acqp
+                return scanRecord.ScanRecord(self.scanNum)[key]
+            if field.imaging and 'singlepulse' in self['PulseProg'].lower():
+                value = ''
+            else:
+                value = field.read(self.file(field.source))
+                if value is None:
+                    value = ''
+            self.values[key] = value
+        return self.values[key]
+
+    def release(self):
+        for f in self.files.values():
+            f.close()
+        self.files = {}
+
+    # Read every field, as for an Acqp, and close the mapped files. Files
+    # already mapped (e.g. the method file, when the scan was ordered by its
+    # save time) are not opened again.
+    def eager(self):
+        if self.acqp is None:
+            curAcqp = Acqp(self.scanNum)
+            try:
+                start = time.perf_counter()
+                files = {'acqp': self.file('acqp'), 'method': self.file('method')}
+                curAcqp.timings['read'] = time.perf_counter() - start
+                curAcqp.bytesRead = sum(len(f.data) for f in files.values())
+                curAcqp.readFields(files)
+            finally:
+                self.release()
+            self.acqp = curAcqp
+        return self.acqp
+
+    @property
+    def parameters(self):
+        return self.eager().parameters
+
+    @property
+    def csvParameters(self):
+        return self.eager().csvParameters
+
+
+# This is where we iterate over directories and compile parameters from all scans
 # in a study into one CSV file
 
-### multi directory chooser code
-
-class GetExistingDirectories(QFileDialog):
-    def __init__(self, *args):
-        super(GetExistingDirectories, self).__init__(*args)
-        self.setOption(self.DontUseNativeDialog, True)
-        self.setFileMode(self.Directory)
-        self.setOption(self.ShowDirsOnly, True)
-        self.findChildren(QListView)[0].setSelectionMode(QAbstractItemView.ExtendedSelection)
-        self.findChildren(QTreeView)[0].setSelectionMode(QAbstractItemView.ExtendedSelection)
-
-
-qapp = QCoreApplication.instance()
-if qapp is None:
-    qapp = QApplication(sys.argv)
-dlg = GetExistingDirectories()
-if dlg.exec_() == QDialog.Accepted:
-    targetDirs = dlg.selectedFiles()
-
-### end multi directory chooser code
-
-for curDir in targetDirs:
-    acqpList = list()
-    studyDir_components = os.listdir(os.path.join(curDir, 'Raw_Data'))
+csvFieldnames = ['ScanNumber', 'acqProtocol',
+                 'RepTime', 'EchoTime', 'FlipAngle', 'RareFactor',
+                 'nEchoes', 'FOV', 'Matrix', 'nSlices', 'SliceThick',
+                 'SliceSep', 'nAverages', 'nEvolutionCycles', 'nRepetitions',
+                 'FatSat', 'Gating', 'ImageOrient', 'SlicePackOffset',
+                 'ReadOutDir', 'ReadOffset', 'PhaseOffset', 'ExcitationPulse',
+                 'RefocusingPulse', 'SpecWidth', 'refPower', 'ReceiverGain',
+                 'SaveTime', 'FlowDir', 'Venc']
+
+
+# Find the Bruker raw data folder of a study: <study>/Raw_Data/<folder> for a
+# directory, or the folder inside an exported archive. Returns the studyFS
+# file system to read it through and the folder's path.
+def findStudyDir(curDir):
+    fs, rawDir = studyFS.openStudy(curDir)
+    studyDir = None
+    studyDir_components = fs.listdir(rawDir)
     for c in studyDir_components:
-        if os.path.isdir(os.path.join(curDir, 'Raw_Data', c)):
-            studyDir = os.path.join(curDir, 'Raw_Data', c)
-        #if os.path.isfile(os.path.join(curDir, 'Raw_Data', c)):
-            #subjectPath = os.path.join(curDir, 'Raw_Data', c)
-
-    scanDirs = os.listdir(studyDir)
-
-
-    curCsvFile = os.path.join(curDir, os.path.basename(curDir)+'_acqp.csv')
-    print(curCsvFile)
-    with open(curCsvFile, 'w') as csvfile:
-        fieldnames = ['ScanNumber', 'acqProtocol',
-                      'RepTime', 'EchoTime', 'FlipAngle', 'RareFactor',
-                      'nEchoes', 'FOV', 'Matrix', 'nSlices', 'SliceThick',
-                      'SliceSep', 'nAverages', 'nEvolutionCycles', 'nRepetitions',
-                      'FatSat', 'Gating', 'ImageOrient', 'SlicePackOffset',
-                      'ReadOutDir', 'ReadOffset', 'PhaseOffset', 'ExcitationPulse',
-                      'RefocusingPulse', 'SpecWidth', 'refPower', 'ReceiverGain',
-                      'SaveTime', 'FlowDir', 'Venc']
-        writer = csv.DictWriter(csvfile, lineterminator='\n', fieldnames=fieldnames)
-        writer.writeheader()
-
-        for d in scanDirs:
-            if d.isnumeric():
-                methodPath = os.path.join(studyDir, d, 'method')
-                methodFile = open(methodPath)
-                methodText = methodFile.read()
-                methodFile.close()
-
-                acqpPath = os.path.join(studyDir, d, 'acqp')
-                acqpFile = open(acqpPath)
-                acqpText = acqpFile.read()
-                acqpFile.close()
-
-                curAcqp = Acqp(d)
-                curAcqp.readParameters(acqpText, methodText)
-                writer.writerow(curAcqp.csvParameters)
-
-                acqpList.append(curAcqp)
-
-        minTime = acqpList[0].parameters['SaveTime']
-        maxTime = acqpList[-1].parameters['SaveTime']
-        for scan in acqpList:
-            if scan.parameters['SaveTime'] < minTime:
-                minTime = scan.parameters['SaveTime']
-            elif scan.parameters['SaveTime'] > maxTime:
-                maxTime = scan.parameters['SaveTime']
-
-        writer2 = csv.writer(csvfile, lineterminator='\n', delimiter=',')
-        writer2.writerow('')
-        writer2.writerow(['Start date:', minTime.date(), 'Start time:', minTime.strftime('%H:%M')])
-        writer2.writerow(['Finish date:', maxTime.date(), 'Finish time:', maxTime.strftime('%H:%M')])
-        elapsedTime = (maxTime-minTime).total_seconds()/60
-        writer2.writerow(['Elapsed time:', str.format("{0:.1f}", elapsedTime), 'min'])
-        writer2.writerow('')
-        writer2.writerow('')
-        writer2.writerow(['STUDY INFORMATION'])
-        writer2.writerow('')
-
-        subjectPath = os.path.join(studyDir, 'subject')
-        subjectFile = open(subjectPath)
-        subjectText = subjectFile.read()
-        subjectFile.close()
-
-        subjectIDRegex = re.compile(paRE.regExAngleText('##$SUBJECT_id'))
-        writer2.writerow(['Subject ID:', '', subjectIDRegex.search(subjectText).group(1).replace('\n', '')])
-
-        studyNameRegex = re.compile(paRE.regExAngleText('##$SUBJECT_study_name'))
-        writer2.writerow(['Study Name:', '', studyNameRegex.search(subjectText).group(1).replace('\n', '')])
-
-        sexRegex = re.compile(paRE.regExAngleText('##$SUBJECT_sex'))
-        match = sexRegex.search(subjectText)
-        if match is not None:
-            writer2.writerow(['Sex:', '', match.group(1).replace('\n', '')])
-        else:
-            print('No sex specified\n')
-            writer2.writerow('')
-
-        weightRegex = re.compile(paRE.regExOneFloat('##$SUBJECT_weight'))
-        match = weightRegex.search(subjectText)
-        if match is not None:
-            writer2.writerow(['Weight:', '', match.group(1).replace('\n', '')])
+        if fs.isdir(fs.join(rawDir, c)):
+            studyDir = fs.join(rawDir, c)
+    if studyDir is None:
+        raise FileNotFoundError('No Bruker data folder in ' + fs.key(rawDir))
+    return fs, studyDir
+
+
+# Numbered scan directories of a study, in scan order
+def listScans(studyDir, fs=studyFS.localFS):
+    return sorted((d for d in fs.listdir(studyDir) if d.isnumeric() and fs.isdir(fs.join(studyDir, d))),
+                  key=int)
+
+
+# Read the acqp and method files of one scan. Local files are memory-mapped
+# and only the records of the registry fields are decoded. lazyScan is the
+# LazyAcqp of the scan if it was already opened (see orderBySaveTime), whose
+# mapped files are then used. This is a module-level function so that it can
+# be run in worker processes.
+def readScan(studyDir, scanNum, fs=studyFS.localFS, lazyScan=None):
+    if lazyScan is None:
+        lazyScan = LazyAcqp(studyDir, scanNum, fs)
+    return lazyScan.eager()
+
+
+# Call fn, returning the exception it raises rather than raising it, so that
+# one unreadable scan mapped over a pool only fails itself and not the rest of
+# the map. Module-level so that it can be run in worker processes.
+def isolated(fn, *args):
+    try:
+        return fn(*args)
+    except Exception as err:
+        return err
+
+
+# Raw contents of the acqp and method files of one scan, and the seconds it
+# took to read them. Run on the I/O threads (see ioPool), with the parsing
+# left to parseScanFiles.
+def readScanFiles(studyDir, scanNum, fs=studyFS.localFS):
+    start = time.perf_counter()
+    acqpData = fs.read(fs.join(studyDir, scanNum, 'acqp'))
+    methodData = fs.read(fs.join(studyDir, scanNum, 'method'))
+    return acqpData, methodData, time.perf_counter() - start
+
+
+def parseScanFiles(scanNum, acqpData, methodData, readSeconds=0.0):
+    curAcqp = Acqp(scanNum)
+    curAcqp.timings['read'] = readSeconds
+    curAcqp.bytesRead = len(acqpData) + len(methodData)
+    curAcqp.readFields({'acqp': paramFile.ParamFileMap.fromBytes(acqpData),
+                        'method': paramFile.ParamFileMap.fromBytes(methodData)})
+    return curAcqp
+
+
+# Undecoded save time line of one scan, read from the bytes of its method
+# file, for use on the I/O threads
+def readSaveTimeLine(studyDir, scanNum, fs=studyFS.localFS):
+    field = paRE.scanFields['SaveTime']
+    data = fs.read(fs.join(studyDir, scanNum, field.source))
+    return field.rawValue(paramFile.ParamFileMap.fromBytes(data))
+
+
+def readSubject(studyDir, fs=studyFS.localFS):
+    subjectText = fs.read(fs.join(studyDir, 'subject')).decode('utf-8', 'replace')
+
+    return {key: field.search(subjectText) for key, field in paRE.subjectFields.items()}
+
+
+# Most scans of a study whose method file orderBySaveTime keeps mapped
+maxLazyScans = 256
+
+
+# Scan numbers in order of save time. Only the ##OWNER record of each method
+# file is read, through LazyAcqp; scans in known (e.g. from the cache) are not
+# read at all. With mapIO (an ioPool.boundedMap) the method files are read
+# concurrently on the I/O threads instead. The save times of the study are
+# decoded in one batch and compared in UTC. A scan whose save time cannot be
+# read raises, unless errors (a dict) is given: the scan is then left out and
+# its exception stored in errors under its scan number. Given lazyScans (a
+# dict), the LazyAcqp of every scan that was read is kept there under its scan
+# number, with its method file still mapped for readScan; the caller releases
+# them. Each mapped file holds a file descriptor, so at most maxLazyScans are
+# kept.
+def orderBySaveTime(studyDir, scanNums, known=None, fs=studyFS.localFS, mapIO=None, errors=None,
+                    lazyScans=None):
+    known = known or {}
+    field = paRE.scanFields['SaveTime']
+    toRead = [d for d in scanNums if d not in known]
+    if mapIO is not None:
+        lines = list(mapIO(functools.partial(isolated, readSaveTimeLine), itertools.repeat(studyDir),
+                           toRead, itertools.repeat(fs)))
+    else:
+        lines = []
+        for d in toRead:
+            lazyScan = LazyAcqp(studyDir, d, fs)
+            try:
+                lines.append(field.rawValue(lazyScan.file(field.source)))
+            except Exception as err:
+                lines.append(err)
+            if (lazyScans is not None and len(lazyScans) < maxLazyScans
+                    and not isinstance(lines[-1], Exception)):
+                lazyScans[d] = lazyScan
+            else:
+                lazyScan.release()
+    failed = {d: line for d, line in zip(toRead, lines) if isinstance(line, Exception)}
+    toDecode = [d for d in toRead if d not in failed]
+    decoded = paRE.toSaveTimes([line for d, line in zip(toRead, lines) if d not in failed], utc=True)
+    saveTimes = dict(zip(toDecode, decoded))
+    for d in toDecode:
+        if saveTimes[d] is None:
+            failed[d] = KeyError(field.paramName)
+    if failed:
+        if errors is None:
+            raise failed[min(failed, key=int)]
+        errors.update(failed)
+    saveTimes.update((d, paRE.toUTC(known[d]['SaveTime'])) for d in scanNums if d in known)
+    return sorted((d for d in scanNums if d not in failed), key=lambda d: (saveTimes[d], int(d)))
+
+
+# Stream for the progress messages of a run (the files written, ...):
+# standard output, unless the CSV rows are written there. Warnings and errors
+# always go to standard error.
+def messageStream(outputs):
+    return sys.stderr if 'stdout' in outputs else sys.stdout
+
+
+# Open the sinks for one study: 'csv' is the <study>_acqp.csv file, 'jsonl' a
+# <study>_acqp.jsonl file next to it and 'stdout' CSV rows on standard output
+def openSinks(curDir, outputs):
+    sinks = []
+    base = studyFS.outputBase(curDir)
+    try:
+        for output in outputs:
+            if output == 'csv':
+                sinks.append(studySinks.CsvSink(base+'.csv', csvFieldnames))
+            elif output == 'jsonl':
+                sinks.append(studySinks.JsonLinesSink(base+'.jsonl', curDir))
+            elif output == 'stdout':
+                sinks.append(studySinks.stdoutSink(csvFieldnames))
+            else:
+                raise ValueError('Unknown output format: ' + output)
+    except Exception:
+        for sink in sinks:
+            sink.abort()
+        raise
+    for sink in sinks:
+        if sink.path is not None:
+            print(sink.path, file=messageStream(outputs))
+    return sinks
+
+
+# Stream the scans of a study to the sinks, one scan at a time, accumulating
+# the start/finish/elapsed summary as we go. Time spent in the sinks is added
+# to report as the write stage.
+def writeStudy(sinks, scans, subject, report=None):
+    if report is None:
+        report = runReport.RunReport()
+    stats = studySinks.TimingStats()
+    for curAcqp in scans:
+        stats.add(curAcqp.parameters['SaveTime'])
+        with report.stage('write'):
+            for sink in sinks:
+                sink.writeScan(curAcqp)
+    with report.stage('write'):
+        for sink in sinks:
+            sink.finish(stats, subject)
+
+
+# Write the run report of a study next to its CSV file
+def writeStudyReport(curDir, studyReport):
+    return studyReport.write(studyFS.outputBase(curDir) + '_report.json')
+
+
+# Write the <study>_acqp.csv file of a list of scans: the scan rows followed
+# by the timing and study information summary. The file replaces the old one
+# only once it is complete (see studySinks).
+def writeStudyCsv(curDir, acqpList, subject):
+    sink = studySinks.CsvSink(studyFS.outputBase(curDir) + '.csv', csvFieldnames)
+    try:
+        writeStudy([sink], acqpList, subject)
+    except BaseException:
+        sink.abort()
+        raise
+    sink.close()
+    return sink.path
+
+
+# Look up the scans of a study in the cache. Returns the Acqp objects of the
+# scans with a valid entry, and the cache key and file stamp of every scan,
+# which are stored with the newly parsed ones. The files are stamped through
+# mapIO, so that they can be stat'ed on the I/O threads. A scan whose files
+# cannot be stamped (e.g. a missing method file) has no stamp; it is left to
+# be read, which fails or succeeds for that scan alone, and is not cached.
+def cachedScans(cache, studyDir, scanNums, fs=studyFS.localFS, mapIO=map):
+    cached = {}
+    stamps = {}
+    scanDirs = [fs.join(studyDir, d) for d in scanNums]
+    for d, scanDir, stamp in zip(scanNums, scanDirs,
+                                 mapIO(functools.partial(isolated, cache.stamp), scanDirs,
+                                       itertools.repeat(fs))):
+        if isinstance(stamp, Exception):
+            continue
+        stamps[d] = (fs.key(scanDir), stamp)
+        entry = cache.lookup(*stamps[d])
+        if entry is not None:
+            cached[d] = Acqp.fromParameters(d, *entry)
+    return cached, stamps
+
+
+# Find the Raw_Data folder of a study and list its scans. A failure is
+# returned rather than raised, so that when this is mapped over all studies
+# on the I/O threads it only skips its own study.
+def discoverStudy(curDir, report=None):
+    if report is None:
+        report = runReport.RunReport()
+    try:
+        with report.clock(), report.stage('listdir'):
+            fs, studyDir = findStudyDir(curDir)
+            return fs, studyDir, listScans(studyDir, fs)
+    except Exception as err:
+        return err
+
+
+# Scans of a study in output order, each taken either from the cache or from
+# the lazily evaluated parse results. Newly parsed scans are stored in the
+# cache as they go past, and every scan is accounted for in report. Parse
+# results that are exceptions (see isolated) are reported and skipped.
+def studyScans(scanNums, cached, parsed, cache=None, stamps=None, report=None):
+    if report is None:
+        report = runReport.RunReport()
+    for d in scanNums:
+        if d in cached:
+            report.addScan(cached[d], cached=True)
+            cached[d].releaseStats()
+            yield cached[d]
         else:
-            print('No weight specified\n')
-
-        remarkRegex = re.compile(paRE.regExComment('##$SUBJECT_remarks'))
-        match = remarkRegex.search(subjectText)
-        if match is not None:
-            writer2.writerow(['Subject Comments:', '', match.group(0).replace('\n', '')])
-        else:
-            print('No subject comments specified\n')
-            writer2.writerow(['Subject Comments:'])
-
-        commentRegex = re.compile(paRE.regExComment('##$SUBJECT_comment'))
-        match = commentRegex.search(subjectText)
-        if match is not None:
-            writer2.writerow(['Study Comments:', '', match.group(0).replace('\n', '')])
-        else:
-            print('No study comments specified\n')
-            writer2.writerow(['Study Comments:'])
-
-#pprint.pprint(firstAcqp.parameters)
-#pprint.pprint(firstAcqp.csvParameters)
-            
\ No newline at end of file
+            curAcqp = next(parsed)
+            if isinstance(curAcqp, Exception):
+                print('Skipping scan ' + d + ' of ' + str(report.name) + ': ' + runReport.errorText(curAcqp),
+                      file=sys.stderr)
+                report.addError(d, curAcqp)
+                continue
+            if cache is not None and d in stamps:
+                cache.store(*stamps[d], curAcqp.parameters, curAcqp.shapes)
+            report.addScan(curAcqp)
+            curAcqp.releaseStats()
+            yield curAcqp
+
+
+# Summarize each study directory. Studies are read and written one at a time;
+# scans are ordered by save time and streamed to the output sinks (see
+# openSinks) as they are parsed. With workers > 1 the scans are parsed in a
+# process pool, with at most max(maxInFlight, 2 * workers) of them submitted
+# ahead of the output (see ioPool.boundedMap). A study that fails is reported
+# and skipped without stopping the others. With cachePath, parsed scans are
+# kept in a scanCache.ScanCache file and only new or modified scans are parsed
+# again. With exportPath, all scans of the studies that succeeded are also
+# written to one columnar file (see studyExport); these are held in memory
+# until the end, and a path that cannot be written raises ValueError before
+# any study is read. With protocolsBase, the scans are also interned into a table
+# of distinct protocols (see protocols.ProtocolTable), written at the end to
+# <protocolsBase>_protocols.csv and <protocolsBase>_scans.csv. With qaBase,
+# the QA statistics of the scans (see qaStats) are written at the end to the
+# <qaBase>_qa_*.csv tables. With ioThreads > 1 the directory listings, file
+# stamps and reads of the acqp, method and subject files are issued
+# concurrently on that many threads, with at most maxInFlight outstanding (see
+# ioPool); this is meant for network mounts with a high per-file latency.
+# Worker processes (workers > 1) still read their own scans. Every study is
+# timed stage by stage (see runReport); with writeReports its report is
+# written next to its CSV file, and the totals of the run are added to report
+# if one is given. A scan that cannot be read is skipped and listed in the
+# report's errors, without failing its study; output files only replace the
+# old ones once their study is complete (see studySinks). With errorsPath the
+# errors of the run are written there as a CSV manifest. With checkpointPath
+# each finished study is recorded in that checkpoint file, and the studies it
+# already holds as finished without errors are not run again (see checkpoint);
+# their scans are then not in the export, protocol or QA tables either.
+# Returns a dict mapping each study directory to the list of files written for
+# it, or to the exception that stopped it.
+def summarize_studies(paths, workers=1, cachePath=None, useHash=False, exportPath=None,
+                      outputs=('csv',), ioThreads=1, maxInFlight=ioPool.defaultInFlight,
+                      writeReports=False, report=None, protocolsBase=None,
+                      errorsPath=None, checkpointPath=None, qaBase=None):
+    runStart = time.perf_counter()
+    messages = messageStream(outputs)
+    if exportPath is not None:
+        import studyExport
+        studyExport.checkExportPath(exportPath)
+    if report is None:
+        report = runReport.RunReport()
+    results = {}
+    progress = None
+    if checkpointPath is not None:
+        progress = checkpoint.Checkpoint(checkpointPath)
+        for curDir in paths:
+            done = progress.finished(curDir)
+            if done is not None:
+                results[curDir] = done
+        if results:
+            print('Resuming: %d of %d studies already done' % (len(results), len(paths)), file=messages)
+        paths = [curDir for curDir in paths if curDir not in results]
+    exported = []
+    protocolTable = None
+    if protocolsBase is not None:
+        import protocols
+        protocolTable = protocols.ProtocolTable()
+    qaTable = None
+    if qaBase is not None:
+        import qaStats
+        qaTable = qaStats.QAStats()
+    pool = None
+    mapScans = map
+    if workers > 1:
+        pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+        mapScans = functools.partial(ioPool.boundedMap, pool, maxInFlight=max(maxInFlight, 2 * workers))
+    io = None
+    mapIO = map
+    if ioThreads > 1:
+        io = ioPool.ioExecutor(ioThreads)
+        mapIO = functools.partial(ioPool.boundedMap, io, maxInFlight=maxInFlight)
+    cache = None
+    if cachePath is not None:
+        cache = scanCache.ScanCache(cachePath, useHash)
+
+    try:
+        # One study at a time: only the scans of the study being written are
+        # submitted to the pool; with ioThreads > 1 the next studies are
+        # listed ahead on the I/O threads
+        studyReports = [runReport.RunReport(curDir) for curDir in paths]
+        for curDir, studyReport, found in zip(paths, studyReports,
+                                              mapIO(discoverStudy, paths, studyReports)):
+            fs = None
+            parsed = None
+            sinks = []
+            # Scans opened by the ordering pass, read from the same mapped
+            # files when they are parsed in this process
+            lazyScans = {} if pool is None and io is None else None
+            try:
+                if isinstance(found, Exception):
+                    raise found
+                fs, studyDir, scanNums = found
+                with studyReport.clock():
+                    cached, stamps = {}, {}
+                    if cache is not None:
+                        with studyReport.stage('stamp'):
+                            cached, stamps = cachedScans(cache, studyDir, scanNums, fs, mapIO)
+                    with studyReport.stage('order'):
+                        unordered = {}
+                        scanNums = orderBySaveTime(studyDir, scanNums, cached, fs,
+                                                   mapIO if io is not None else None, unordered,
+                                                   lazyScans)
+                    for d, err in sorted(unordered.items(), key=lambda item: int(item[0])):
+                        print('Skipping scan ' + d + ' of ' + curDir + ': ' + runReport.errorText(err),
+                              file=sys.stderr)
+                        studyReport.addError(d, err)
+                    toRead = [d for d in scanNums if d not in cached]
+                    subject = io.submit(readSubject, studyDir, fs) if io is not None else None
+                    if io is not None and pool is None:
+                        files = mapIO(functools.partial(isolated, readScanFiles), itertools.repeat(studyDir),
+                                      toRead, itertools.repeat(fs))
+                        parsed = (data if isinstance(data, Exception) else isolated(parseScanFiles, d, *data)
+                                  for d, data in zip(toRead, files))
+                    elif pool is None:
+                        parsed = (isolated(readScan, studyDir, d, fs, lazyScans.pop(d, None))
+                                  for d in toRead)
+                    else:
+                        parsed = iter(mapScans(functools.partial(isolated, readScan),
+                                               itertools.repeat(studyDir), toRead, itertools.repeat(fs)))
+                    with studyReport.stage('subject'):
+                        subject = subject.result() if subject is not None else readSubject(studyDir, fs)
+                    scans = studyScans(scanNums, cached, parsed, cache, stamps, studyReport)
+                    if protocolTable is not None:
+                        scans = protocolTable.collect(curDir, scans)
+                    if qaTable is not None:
+                        scans = qaTable.collect(curDir, scans)
+                    if exportPath is not None:
+                        scans = list(scans)
+                        exported.append((curDir, scans, subject))
+                    sinks = openSinks(curDir, outputs)
+                    writeStudy(sinks, scans, subject, studyReport)
+                    for sink in sinks:
+                        sink.close()
+                results[curDir] = [sink.path for sink in sinks if sink.path is not None]
+            except Exception as err:
+                print('Skipping ' + curDir + ': ' + runReport.errorText(err), file=sys.stderr)
+                results[curDir] = err
+                studyReport.error = err
+            finally:
+                # Files of a study that did not complete are dropped, and the
+                # reads still pending for it cancelled
+                for sink in sinks:
+                    sink.abort()
+                if hasattr(parsed, 'close'):
+                    parsed.close()
+                for lazyScan in (lazyScans or {}).values():
+                    lazyScan.release()
+                if cache is not None:
+                    cache.commit()
+                if fs is not None:
+                    fs.close()
+                report.merge(studyReport)
+                if writeReports and fs is not None:
+                    try:
+                        reportPath = writeStudyReport(curDir, studyReport)
+                        print(reportPath, file=messages)
+                        if isinstance(results.get(curDir), list):
+                            results[curDir].append(reportPath)
+                    except OSError as err:
+                        print('Could not write the report for ' + curDir + ': ' + runReport.errorText(err),
+                              file=sys.stderr)
+                # A study interrupted (e.g. by Ctrl-C) has no result and is
+                # not recorded, so that it is run again on resume
+                if progress is not None and curDir in results:
+                    if isinstance(results[curDir], Exception):
+                        progress.record(curDir, [], [{'scan': '', **runReport.errorFields(results[curDir])}])
+                    else:
+                        progress.record(curDir, results[curDir], studyReport.errors)
+
+        if exportPath is not None:
+            for path in studyExport.exportStudies(exportPath, exported):
+                print(path, file=messages)
+        if protocolTable is not None:
+            for path in protocolTable.write(protocolsBase, csvFieldnames):
+                print(path, file=messages)
+        if qaTable is not None:
+            for path in qaTable.write(qaBase):
+                print(path, file=messages)
+        if errorsPath is not None:
+            print(checkpoint.writeManifest(errorsPath, report.errors), file=messages)
+    finally:
+        if progress is not None:
+            progress.close()
+        if pool is not None:
+            pool.shutdown()
+        if io is not None:
+            io.shutdown(cancel_futures=True)
+        if cache is not None:
+            cache.close()
+        report.seconds += time.perf_counter() - runStart
+
+    return results
+
+
+# Command line entry point. Study paths may be given directly or as glob
+# patterns; the directory dialog is only imported and shown with --gui, or
+# when no paths are given.
+def main(argv=None):
+    argParser = argparse.ArgumentParser(
+        description='Summarize Bruker ParaVision studies into <study>_acqp.csv files.')
+    argParser.add_argument('paths', nargs='*',
+                           help='study directories or .PVDatasets/.zip/.tar archives, or glob patterns')
+    argParser.add_argument('--gui', action='store_true',
+                           help='choose study directories in a dialog')
+    argParser.add_argument('-j', '--workers', type=int, default=1,
+                           help='number of worker processes (default 1)')
+    argParser.add_argument('--io-threads', type=int, default=1, metavar='N',
+                           help='read files on N threads at once, for network mounts (default 1)')
+    argParser.add_argument('--max-in-flight', type=int, default=ioPool.defaultInFlight, metavar='N',
+                           help='most reads (with --io-threads) or scans (with -j) outstanding at once '
+                                '(default %(default)s)')
+    argParser.add_argument('--cache', metavar='FILE',
+                           help='SQLite cache of parsed scans; unchanged scans are not parsed again')
+    argParser.add_argument('--hash', action='store_true',
+                           help='also compare file contents (SHA-1) when validating cache entries')
+    argParser.add_argument('-f', '--format', action='append', choices=['csv', 'jsonl', 'stdout'],
+                           help='output for each study: csv (default), jsonl or stdout; may be repeated')
+    argParser.add_argument('--export', metavar='FILE',
+                           help='also write all scans to one columnar file (.parquet or .npz)')
+    argParser.add_argument('--protocols', metavar='BASE',
+                           help='also write the distinct protocols to BASE_protocols.csv and each scan '
+                                'with its protocol ID to BASE_scans.csv')
+    argParser.add_argument('--qa', metavar='BASE',
+                           help='also write QA statistics (reference power, frequency drift, daily '
+                                'throughput) per protocol and scanner to BASE_qa_*.csv')
+    argParser.add_argument('--report', action='store_true',
+                           help='write a JSON report of stage timings and counters next to each CSV file')
+    argParser.add_argument('--profile', metavar='FILE',
+                           help='run under cProfile and save the statistics to FILE')
+    argParser.add_argument('--errors', metavar='FILE',
+                           help='write the studies and scans that could not be read to a CSV file')
+    argParser.add_argument('--resume', metavar='CHECKPOINT',
+                           help='checkpoint file: skip the studies it lists as done, and record '
+                                'each study as it finishes')
+    args = argParser.parse_args(argv)
+    if args.export:
+        import studyExport
+        try:
+            studyExport.checkExportPath(args.export)
+        except ValueError as err:
+            argParser.error(str(err))
+
+    targetDirs = []
+    for pattern in args.paths:
+        matches = sorted(glob.glob(pattern))
+        if not matches:
+            print('No match for ' + pattern, file=sys.stderr)
+        targetDirs.extend(m for m in matches if os.path.isdir(m) or studyFS.isArchive(m))
+
+    if args.gui or not args.paths:
+        from dirDialog import chooseDirectories
+        targetDirs.extend(chooseDirectories())
+
+    report = runReport.RunReport('run')
+    run = functools.partial(summarize_studies, targetDirs, workers=args.workers,
+                            cachePath=args.cache, useHash=args.hash,
+                            exportPath=args.export, outputs=args.format or ['csv'],
+                            ioThreads=args.io_threads, maxInFlight=args.max_in_flight,
+                            writeReports=args.report, report=report, protocolsBase=args.protocols,
+                            errorsPath=args.errors, checkpointPath=args.resume, qaBase=args.qa)
+    if args.profile:
+        runReport.profileCall(args.profile, run)
+    else:
+        run()
+    if args.report:
+        print(report.summary(), file=messageStream(args.format or ['csv']))
+    if report.errors:
+        print('%d studies or scans could not be read%s' % (
+            len(report.errors), ', see ' + args.errors if args.errors else ''), file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,353 @@
+# -*- coding: utf-8 -*-
+"""
+Quality-assurance statistics across many studies: drift of the reference
+power, receiver gain, base frequency and spectral width from session to
+session, per protocol and per scanner, computed on NumPy arrays in one pass
+over the scans instead of study by study in a spreadsheet.
+
+Scans are added from their Acqp.parameters (or scanIndex rows) and grouped by
+protocol ID (see protocols) and by scanner. The scanner is taken to be the
+magnet, named by its nominal proton frequency ('300 MHz' for BF1 = 300.33);
+another key can be passed as scannerKey. Then, with scans in save time order
+within each scanner:
+
+    rolling means     mean of the last window scans of the scanner, for each
+                      of refPower, ReceiverGain, BasicFreq and SpecWidth
+    refPower flags    robust z-score of the reference power against the
+                      scanner's median and MAD above zThreshold
+    frequency flags   drift of BasicFreq from the mean of the scanner's
+                      previous window scans above maxDriftPPM (in ppm)
+    throughput        scans, studies and hours from first to last save time
+                      per scanner and day (local time where the save time
+                      carries its offset, UTC for scanIndex rows)
+
+write(BASE) writes the summary tables BASE_qa_protocols.csv,
+BASE_qa_scanners.csv, BASE_qa_daily.csv and BASE_qa_flags.csv (the flagged
+scans only), and with allScans BASE_qa_scans.csv with the rolling means and
+scores of every scan. Save times in the tables are in UTC.
+
+Usage, on a scanIndex file:
+    python qaStats.py INDEX --out BASE [--window N] [--z Z] [--max-drift PPM] [--all-scans]
+
+"""
+
+import sys
+import csv
+import datetime
+import argparse
+import numpy as np
+import paramRE as paRE
+import protocols
+
+metrics = ('refPower', 'ReceiverGain', 'BasicFreq', 'SpecWidth')
+
+epoch = datetime.datetime(1970, 1, 1)
+
+
+# Scanner of a scan: its nominal proton frequency in MHz
+def nominalScanner(parameters):
+    frequency = metricValue(parameters.get('BasicFreq'))
+    return 'unknown' if np.isnan(frequency) else '%d MHz' % round(frequency)
+
+
+# A metric as a float; the first value of an array, NaN if blank
+def metricValue(value):
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return float(value.split()[0])
+    except (AttributeError, IndexError, ValueError):
+        return np.nan
+
+
+def asDatetime(value):
+    if isinstance(value, str) and value:
+        try:
+            return datetime.datetime.fromisoformat(value)
+        except ValueError:
+            return None
+    return value if isinstance(value, datetime.datetime) else None
+
+
+def formatValue(value):
+    if isinstance(value, (float, np.floating)):
+        return '' if np.isnan(value) else '%.10g' % value
+    return value
+
+
+def formatTime(seconds):
+    if np.isnan(seconds):
+        return ''
+    return (epoch + datetime.timedelta(seconds=float(seconds))).isoformat(sep=' ', timespec='seconds')
+
+
+# Codes of the distinct labels, in sorted order of the labels
+def groupCodes(labels):
+    uniques, codes = np.unique(np.array(labels, dtype=str), return_inverse=True)
+    return list(uniques), codes.ravel()
+
+
+# Mean, sample standard deviation, minimum, maximum and count of the values of
+# each group, NaN ignored
+def groupStats(codes, values, nGroups):
+    valid = ~np.isnan(values)
+    c, v = codes[valid], values[valid]
+    n = np.bincount(c, minlength=nGroups)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.bincount(c, weights=v, minlength=nGroups) / n
+        deviation = v - mean[c]
+        sd = np.sqrt(np.bincount(c, weights=deviation * deviation, minlength=nGroups) / (n - 1))
+    sd[n < 2] = np.nan
+    low = np.full(nGroups, np.inf)
+    high = np.full(nGroups, -np.inf)
+    np.minimum.at(low, c, v)
+    np.maximum.at(high, c, v)
+    low[n == 0] = np.nan
+    high[n == 0] = np.nan
+    return {'Mean': mean, 'SD': sd, 'Min': low, 'Max': high}, n
+
+
+def groupMedian(codes, values, nGroups):
+    valid = ~np.isnan(values)
+    c, v = codes[valid], values[valid]
+    order = np.lexsort((v, c))
+    v = v[order]
+    n = np.bincount(c, minlength=nGroups)
+    starts = np.cumsum(n) - n
+    median = np.full(nGroups, np.nan)
+    has = n > 0
+    median[has] = (v[starts[has] + (n[has] - 1) // 2] + v[starts[has] + n[has] // 2]) / 2
+    return median
+
+
+# Robust z-score of each value within its group: distance from the group
+# median in units of 1.4826 MAD. Where the MAD is 0, values off the median
+# score infinity.
+def robustZ(codes, values, nGroups):
+    median = groupMedian(codes, values, nGroups)
+    deviation = values - median[codes]
+    mad = groupMedian(codes, np.abs(deviation), nGroups)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        z = deviation / (1.4826 * mad[codes])
+    z[(deviation == 0) & (mad[codes] == 0)] = 0.0
+    return z
+
+
+# Mean of the last window values of each value's group, in time order: up to
+# and including the value itself, or with previous only the ones before it.
+# NaN where there are none. Values are summed as differences from their group
+# median, so that BasicFreq keeps its precision over millions of scans.
+def rollingMean(codes, times, values, window, nGroups, previous=False):
+    order = np.lexsort((times, codes))
+    c = codes[order]
+    centre = groupMedian(codes, values, nGroups)
+    v = values[order] - centre[c]
+    valid = ~np.isnan(v)
+    sums = np.concatenate(([0.0], np.cumsum(np.where(valid, v, 0.0))))
+    counts = np.concatenate(([0], np.cumsum(valid)))
+    position = np.arange(len(v))
+    end = position if previous else position + 1
+    start = np.maximum(np.searchsorted(c, c, side='left'), end - window)
+    n = counts[end] - counts[start]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = (sums[end] - sums[start]) / n + centre[c]
+    result = np.empty(len(v))
+    result[order] = mean
+    return result
+
+
+class QAStats:
+    def __init__(self, scannerKey=nominalScanner, window=20, zThreshold=3.5, maxDriftPPM=1.0):
+        self.scannerKey = scannerKey
+        self.window = window
+        self.zThreshold = zThreshold
+        self.maxDriftPPM = maxDriftPPM
+        # One entry per scan, turned into arrays by compute()
+        self.studies = []
+        self.scanNums = []
+        self.times = []
+        self.days = []
+        self.protocolIDs = []
+        self.protocolNames = {}
+        # Protocol ID of each distinct set of raw protocol field values, so
+        # that repeated protocols are fingerprinted once
+        self.protocolCache = {}
+        self.scanners = []
+        self.values = {key: [] for key in metrics}
+        self.results = None
+
+    # Add one scan, given its Acqp.parameters (or a scanIndex row)
+    def add(self, study, parameters):
+        saveTime = asDatetime(parameters.get('SaveTime'))
+        utc = paRE.toUTC(saveTime)
+        self.studies.append(study)
+        self.scanNums.append(str(parameters.get('ScanNumber', '')))
+        self.times.append((utc - epoch).total_seconds() if utc is not None else np.nan)
+        self.days.append(saveTime.date().toordinal() if saveTime is not None else 0)
+        raw = tuple(parameters.get(key) for key in protocols.protocolFields)
+        pid = self.protocolCache.get(raw)
+        if pid is None:
+            pid = self.protocolCache[raw] = protocols.protocolID(parameters)
+        self.protocolIDs.append(pid)
+        self.protocolNames.setdefault(pid, (parameters.get('acqProtocol', ''), parameters.get('PulseProg', '')))
+        self.scanners.append(self.scannerKey(parameters))
+        for key in metrics:
+            self.values[key].append(metricValue(parameters.get(key)))
+        self.results = None
+
+    # Pass the scans of a study through, adding each one
+    def collect(self, study, scans):
+        for curAcqp in scans:
+            self.add(study, curAcqp.parameters)
+            yield curAcqp
+
+    # Per-scan arrays: group codes, rolling means, scores and flags
+    def compute(self):
+        if self.results is not None:
+            return self.results
+        r = {'times': np.array(self.times, dtype=float), 'days': np.array(self.days, dtype=np.int64)}
+        r['scannerLabels'], r['scanner'] = groupCodes(self.scanners)
+        r['protocolLabels'], r['protocol'] = groupCodes(self.protocolIDs)
+        r['studyLabels'], r['study'] = groupCodes(self.studies)
+        nScanners = len(r['scannerLabels'])
+        for key in metrics:
+            r[key] = np.array(self.values[key], dtype=float)
+            r[key + 'Rolling'] = rollingMean(r['scanner'], r['times'], r[key], self.window, nScanners)
+        r['refPowerZ'] = robustZ(r['scanner'], r['refPower'], nScanners)
+        previous = rollingMean(r['scanner'], r['times'], r['BasicFreq'], self.window, nScanners, previous=True)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            r['FreqDriftPPM'] = (r['BasicFreq'] - previous) / previous * 1e6
+        r['refPowerFlag'] = np.abs(r['refPowerZ']) > self.zThreshold
+        r['frequencyFlag'] = np.abs(r['FreqDriftPPM']) > self.maxDriftPPM
+        self.results = r
+        return r
+
+    # Rows of a per-group summary: scans, studies, first and last save time,
+    # metric statistics and flag counts for each group
+    def groupRows(self, codes, labels):
+        r = self.compute()
+        nGroups = len(labels)
+        scans = np.bincount(codes, minlength=nGroups)
+        studyPairs = np.unique(codes.astype(np.int64) * len(r['studyLabels']) + r['study'])
+        studies = np.bincount(studyPairs // len(r['studyLabels']), minlength=nGroups)
+        timeStats, _ = groupStats(codes, r['times'], nGroups)
+        columns = {'Scans': scans, 'Studies': studies,
+                   'First': [formatTime(t) for t in timeStats['Min']],
+                   'Last': [formatTime(t) for t in timeStats['Max']]}
+        for key in metrics:
+            stats, _ = groupStats(codes, r[key], nGroups)
+            for name in ('Mean', 'SD', 'Min', 'Max'):
+                columns[key + name] = stats[name]
+        drift = np.abs(r['FreqDriftPPM'])
+        maxDrift = np.full(nGroups, -np.inf)
+        np.fmax.at(maxDrift, codes, drift)
+        columns['MaxFreqDriftPPM'] = np.where(np.isfinite(maxDrift), maxDrift, np.nan)
+        columns['RefPowerFlags'] = np.bincount(codes, weights=r['refPowerFlag'], minlength=nGroups).astype(int)
+        columns['FrequencyFlags'] = np.bincount(codes, weights=r['frequencyFlag'], minlength=nGroups).astype(int)
+        return columns
+
+    def protocolSummary(self):
+        r = self.compute()
+        columns = {'ProtocolID': r['protocolLabels'],
+                   'acqProtocol': [self.protocolNames[pid][0] for pid in r['protocolLabels']],
+                   'PulseProg': [self.protocolNames[pid][1] for pid in r['protocolLabels']]}
+        columns.update(self.groupRows(r['protocol'], r['protocolLabels']))
+        return columns
+
+    def scannerSummary(self):
+        r = self.compute()
+        columns = {'Scanner': r['scannerLabels']}
+        columns.update(self.groupRows(r['scanner'], r['scannerLabels']))
+        return columns
+
+    # Scans, studies, first and last save time and the hours between them per
+    # scanner and day
+    def dailyThroughput(self):
+        r = self.compute()
+        keys = r['scanner'].astype(np.int64) * (1 << 32) + r['days']
+        dayKeys, codes, scans = np.unique(keys, return_inverse=True, return_counts=True)
+        codes = codes.ravel()
+        studyPairs = np.unique(codes.astype(np.int64) * len(r['studyLabels']) + r['study'])
+        studies = np.bincount(studyPairs // len(r['studyLabels']), minlength=len(dayKeys))
+        timeStats, _ = groupStats(codes, r['times'], len(dayKeys))
+        days = dayKeys & ((1 << 32) - 1)
+        return {'Scanner': [r['scannerLabels'][k >> 32] for k in dayKeys],
+                'Date': [datetime.date.fromordinal(int(d)).isoformat() if d > 0 else '' for d in days],
+                'Scans': scans, 'Studies': studies,
+                'First': [formatTime(t) for t in timeStats['Min']],
+                'Last': [formatTime(t) for t in timeStats['Max']],
+                'Hours': (timeStats['Max'] - timeStats['Min']) / 3600}
+
+    # Per-scan table, of the flagged scans only unless allScans
+    def scanTable(self, allScans=False):
+        r = self.compute()
+        flagged = r['refPowerFlag'] | r['frequencyFlag']
+        rows = np.arange(len(self.studies)) if allScans else np.flatnonzero(flagged)
+        rows = rows[np.lexsort((r['times'][rows], r['scanner'][rows]))]
+        columns = {'Study': [self.studies[i] for i in rows],
+                   'ScanNumber': [self.scanNums[i] for i in rows],
+                   'SaveTime': [formatTime(t) for t in r['times'][rows]],
+                   'Scanner': [r['scannerLabels'][c] for c in r['scanner'][rows]],
+                   'ProtocolID': [self.protocolIDs[i] for i in rows]}
+        for key in metrics:
+            columns[key] = r[key][rows]
+            columns[key + 'Rolling'] = r[key + 'Rolling'][rows]
+        columns['refPowerZ'] = r['refPowerZ'][rows]
+        columns['FreqDriftPPM'] = r['FreqDriftPPM'][rows]
+        columns['Flags'] = [' '.join(name for name, flag in (('refPower', r['refPowerFlag'][i]),
+                                                             ('frequency', r['frequencyFlag'][i])) if flag)
+                            for i in rows]
+        return columns
+
+    # Write the summary tables to BASE_qa_*.csv; returns the paths written
+    def write(self, base, allScans=False):
+        tables = [('_qa_protocols.csv', self.protocolSummary()),
+                  ('_qa_scanners.csv', self.scannerSummary()),
+                  ('_qa_daily.csv', self.dailyThroughput()),
+                  ('_qa_flags.csv', self.scanTable())]
+        if allScans:
+            tables.append(('_qa_scans.csv', self.scanTable(allScans=True)))
+        paths = []
+        for suffix, columns in tables:
+            paths.append(writeTable(base + suffix, columns))
+        return paths
+
+
+def writeTable(path, columns):
+    with open(path, 'w') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(list(columns))
+        for row in zip(*columns.values()):
+            writer.writerow([formatValue(value) for value in row])
+    return path
+
+
+def main(argv=None):
+    import scanIndex
+    argParser = argparse.ArgumentParser(description='QA statistics across the scans of a scan index.')
+    argParser.add_argument('index', help='SQLite index file (see scanIndex.py)')
+    argParser.add_argument('--out', metavar='BASE', required=True, help='write BASE_qa_*.csv')
+    argParser.add_argument('--window', type=int, default=20,
+                           help='scans per scanner in the rolling means (default 20)')
+    argParser.add_argument('--z', type=float, default=3.5,
+                           help='robust z-score above which reference power is flagged (default 3.5)')
+    argParser.add_argument('--max-drift', type=float, default=1.0, metavar='PPM',
+                           help='frequency drift above which a scan is flagged, in ppm (default 1)')
+    argParser.add_argument('--all-scans', action='store_true',
+                           help='also write every scan with its rolling means to BASE_qa_scans.csv')
+    args = argParser.parse_args(argv)
+
+    stats = QAStats(window=args.window, zThreshold=args.z, maxDriftPPM=args.max_drift)
+    index = scanIndex.ScanIndex(args.index)
+    try:
+        for row in index.query():
+            stats.add(row['studyPath'], row)
+    finally:
+        index.close()
+    for path in stats.write(args.out, args.all_scans):
+        print(path)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""
+Instrumentation of a summary run: time spent in each stage, bytes read,
+scans per second and how often each field was missing, kept per study and
+written as a JSON report next to the study's CSV file.
+
+Stages:
+    listdir   finding the Raw_Data folder and listing the scans
+    stamp     stamping the scan files and looking them up in the cache
+    order     reading the save times to order the scans
+    read      opening the acqp and method files (for memory-mapped files
+              the pages are only read as the records are indexed, which
+              then counts towards parse)
+    parse     tokenizing the files and extracting the registry fields
+    saveTime  decoding the save time (paramRE.toSaveTime)
+    subject   reading the subject file
+    write     writing the rows and summary to the output sinks
+
+read, parse and saveTime are measured per scan by Acqp (Acqp.timings), so
+they are also available when the scans are parsed in worker processes; they
+are then summed over the workers. The other stages are wall-clock time in
+the main process. profileCall runs a function under cProfile, for a closer
+look at a slow run.
+
+Scans and studies that could not be read are listed in errors, one
+{'study', 'scan', 'errorType', 'error'} entry each (scan is blank when the
+whole study failed), which is what the error manifest of a batch run is
+written from (see checkpoint). errorType is the name of the exception class
+and error its message, which for an OSError includes the file name.
+
+"""
+
+import os
+import time
+import json
+import cProfile
+import datetime
+import threading
+import contextlib
+import collections
+import paramRE as paRE
+
+stageNames = ('listdir', 'stamp', 'order', 'read', 'parse', 'saveTime', 'subject', 'write')
+
+
+# Exception class name and message of an error, as stored in errors
+def errorFields(err):
+    return {'errorType': type(err).__name__, 'error': str(err)}
+
+
+# One-line description of an error for progress messages
+def errorText(err):
+    return '%s: %s' % (type(err).__name__, err)
+
+
+class RunReport:
+    def __init__(self, name=None):
+        self.name = name
+        self.started = datetime.datetime.now().astimezone()
+        self.seconds = 0.0
+        self.stages = dict.fromkeys(stageNames, 0.0)
+        self.counts = {'scans': 0, 'parsed': 0, 'cached': 0, 'failedScans': 0, 'bytesRead': 0}
+        self.missing = collections.Counter()
+        self.errors = []
+        self.error = None
+        self.lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        with self.lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    # Time the body of a with statement as the given stage
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    # Time the body of a with statement as time spent on the study as a whole
+    @contextlib.contextmanager
+    def clock(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.seconds += time.perf_counter() - start
+
+    # Account for one scan of the study, taken from the cache or parsed
+    def addScan(self, curAcqp, cached=False):
+        with self.lock:
+            self.counts['scans'] += 1
+            self.counts['cached' if cached else 'parsed'] += 1
+            self.counts['bytesRead'] += curAcqp.bytesRead
+            for stage, seconds in curAcqp.timings.items():
+                self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+            self.missing.update(curAcqp.missing)
+
+    # Account for a scan that could not be read
+    def addError(self, scanNum, err):
+        with self.lock:
+            self.counts['failedScans'] += 1
+            self.errors.append({'study': self.name, 'scan': scanNum, **errorFields(err)})
+
+    # Add the totals of the report of one study to the run. The run keeps its
+    # own clock, since studies overlap when run in parallel.
+    def merge(self, other):
+        with self.lock:
+            self.counts['studies'] = self.counts.get('studies', 0) + 1
+            if other.error is not None:
+                self.counts['failed'] = self.counts.get('failed', 0) + 1
+                self.errors.append({'study': other.name, 'scan': '', **errorFields(other.error)})
+            self.errors.extend(other.errors)
+            for stage, seconds in other.stages.items():
+                self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+            for key, count in other.counts.items():
+                self.counts[key] = self.counts.get(key, 0) + count
+            self.missing.update(other.missing)
+
+    def scansPerSecond(self):
+        return self.counts['scans'] / self.seconds if self.seconds > 0 else None
+
+    def toDict(self):
+        return {'name': self.name, 'parserVersion': paRE.parserVersion,
+                'started': self.started.isoformat(), 'seconds': self.seconds,
+                'scansPerSecond': self.scansPerSecond(),
+                'stages': self.stages, 'counts': self.counts,
+                'missing': dict(sorted(self.missing.items())),
+                'errors': self.errors,
+                'error': errorFields(self.error) if self.error is not None else None}
+
+    # Write the report through a temporary file, so that an existing report
+    # is replaced whole or not at all
+    def write(self, path):
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.toDict(), f, indent=1)
+        os.replace(path + '.tmp', path)
+        return path
+
+    def summary(self):
+        rate = self.scansPerSecond()
+        stages = ', '.join('%s %.2f s' % (stage, seconds) for stage, seconds in self.stages.items()
+                           if seconds >= 0.005)
+        failed = ', %d failed' % self.counts['failedScans'] if self.counts['failedScans'] else ''
+        return '%d scans (%d parsed, %d cached%s) in %.2f s%s; %s' % (
+            self.counts['scans'], self.counts['parsed'], self.counts['cached'], failed, self.seconds,
+            ' (%.1f scans/s)' % rate if rate else '', stages or 'no stage over 5 ms')
+
+
+# Call fn under cProfile and save the statistics to path, for pstats or
+# snakeviz. Only the calling process is profiled.
+def profileCall(path, fn, *args, **kwargs):
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(fn, *args, **kwargs)
+    finally:
+        profiler.dump_stats(path)
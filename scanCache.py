@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent cache of parsed scan parameters, so that re-summarizing a study
+only parses the scans that changed since the last run.
+
+Entries live in a SQLite file and are keyed by scan directory (its
+studyFS key, so scans inside archives have their own entries). Each entry
+records a stamp of the scan's acqp and method files (modification time and
+size, plus a SHA-1 of the contents if useHash is set) and the parser version
+from paramRE. An entry is only used if both still match.
+
+"""
+
+import json
+import sqlite3
+import hashlib
+import datetime
+import paramRE as paRE
+import studyFS
+
+scanFiles = ('acqp', 'method')
+
+
+# Stamp of the files of one scan directory, as a string that is compared for
+# equality against the cached entry
+def scanStamp(scanDir, useHash=False, fs=studyFS.localFS):
+    parts = []
+    for name in scanFiles:
+        path = fs.join(scanDir, name)
+        parts.append(name + ':' + fs.stamp(path))
+        if useHash:
+            parts.append(hashlib.sha1(fs.read(path)).hexdigest())
+    return ';'.join(parts)
+
+
+# Acqp.parameters holds strings apart from the SaveTime datetime; the array
+# shapes are stored alongside
+def encodeParameters(parameters, shapes):
+    return json.dumps({'parameters': dict(parameters), 'shapes': shapes},
+                      default=lambda v: v.isoformat())
+
+def decodeParameters(text):
+    entry = json.loads(text)
+    parameters = entry['parameters']
+    if parameters.get('SaveTime'):
+        parameters['SaveTime'] = datetime.datetime.fromisoformat(parameters['SaveTime'])
+    shapes = {key: tuple(shape) if shape is not None else None
+              for key, shape in entry['shapes'].items()}
+    return parameters, shapes
+
+
+class ScanCache:
+    def __init__(self, path, useHash=False):
+        self.path = path
+        self.useHash = useHash
+        self.db = sqlite3.connect(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS scans ('
+                        'scanDir TEXT PRIMARY KEY, stamp TEXT, version INTEGER, parameters TEXT)')
+
+    def stamp(self, scanDir, fs=studyFS.localFS):
+        return scanStamp(scanDir, self.useHash, fs)
+
+    # Cached (parameters, shapes) for a scan, given its studyFS key, or None
+    # if there is no valid entry
+    def lookup(self, scanKey, stamp):
+        row = self.db.execute('SELECT stamp, version, parameters FROM scans WHERE scanDir = ?',
+                              (scanKey,)).fetchone()
+        if row is None or row[0] != stamp or row[1] != paRE.parserVersion:
+            return None
+        return decodeParameters(row[2])
+
+    def store(self, scanKey, stamp, parameters, shapes):
+        self.db.execute('INSERT OR REPLACE INTO scans VALUES (?, ?, ?, ?)',
+                        (scanKey, stamp, paRE.parserVersion,
+                         encodeParameters(parameters, shapes)))
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+"""
+Archive-wide scan index, so that questions such as "all RARE scans with
+TR > 2000 since March" can be answered without reading any raw files.
+
+The index is a SQLite file with one row per scan (every Acqp.parameters
+field) and one row per study (the subject fields). It has secondary indexes
+on PulseProg, acqProtocol, SaveTime, PVver and SUBJECT_id. Updating it only
+parses scans that are new or whose acqp/method files changed since they were
+indexed, so it can be rerun whenever new Raw_Data folders land.
+
+Usage:
+    python scanIndex.py update INDEX study [study ...]
+    python scanIndex.py query INDEX [--pulse 'RARE*'] [--min-tr 2000] [--since 2021-03-01] ...
+
+"""
+
+import os
+import sys
+import csv
+import glob
+import sqlite3
+import argparse
+import datetime
+import itertools
+import functools
+import concurrent.futures
+import paramRE as paRE
+import paramFile
+import scanCache
+import studyFS
+import runReport
+import py_acqp
+
+scanColumns = list(py_acqp.Acqp('0').parameters)
+subjectColumns = list(paRE.subjectFields)
+
+# Numeric ranges kept for range queries on array fields (e.g. multi-TR scans)
+rangeColumns = {'RepTime': ('RepTimeMin', 'RepTimeMax'),
+                'EchoTime': ('EchoTimeMin', 'EchoTimeMax')}
+
+indexedColumns = {'scans': ['PulseProg', 'acqProtocol', 'SaveTime', 'PVver'],
+                  'studies': ['SUBJECT_id']}
+
+
+def quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+# SaveTime is stored as ISO text in UTC so that it sorts and compares as text
+def timeText(value):
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+        return value.isoformat()
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    return value
+
+
+# Smallest and largest number of a field, with PV360 @n*(value) runs expanded
+def valueRange(value):
+    try:
+        values = paramFile.decodeNumbers(value, (-1,))
+    except ValueError:
+        return None, None
+    if values.size == 0:
+        return None, None
+    return float(values.min()), float(values.max())
+
+
+class ScanIndex:
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.row_factory = sqlite3.Row
+        self.createTables()
+
+    # Create the tables, adding columns for any fields that were added to
+    # the registry since the index was created
+    def createTables(self):
+        rangeNames = [name for pair in rangeColumns.values() for name in pair]
+        tables = {
+            'scans': [('scanDir', 'TEXT PRIMARY KEY'), ('studyPath', 'TEXT'),
+                      ('stamp', 'TEXT'), ('version', 'INTEGER')]
+                     + [(c, 'TEXT') for c in scanColumns]
+                     + [(c, 'REAL') for c in rangeNames],
+            'studies': [('studyPath', 'TEXT PRIMARY KEY'), ('studyDir', 'TEXT')]
+                       + [(c, 'TEXT') for c in subjectColumns],
+        }
+        for table, columns in tables.items():
+            self.db.execute('CREATE TABLE IF NOT EXISTS %s (%s)'
+                            % (table, ', '.join(quote(c) + ' ' + t for c, t in columns)))
+            existing = {row[1] for row in self.db.execute('PRAGMA table_info(%s)' % table)}
+            for c, t in columns:
+                if c not in existing:
+                    self.db.execute('ALTER TABLE %s ADD COLUMN %s %s' % (table, quote(c), t))
+            for name in indexedColumns[table]:
+                self.db.execute('CREATE INDEX IF NOT EXISTS %s ON %s (%s)'
+                                % (quote(table + '_' + name), table, quote(name)))
+        self.db.execute('CREATE INDEX IF NOT EXISTS scans_studyPath ON scans (studyPath)')
+        self.db.commit()
+
+    # Scans of a study whose stored stamp and parser version are still valid
+    def currentScans(self, studyPath, stamps):
+        current = set()
+        for row in self.db.execute('SELECT scanDir, stamp, version FROM scans WHERE studyPath = ?',
+                                   (studyPath,)):
+            if stamps.get(row['scanDir']) == row['stamp'] and row['version'] == paRE.parserVersion:
+                current.add(row['scanDir'])
+        return current
+
+    def insert(self, table, row):
+        self.db.execute('INSERT OR REPLACE INTO %s (%s) VALUES (%s)'
+                        % (table, ', '.join(quote(c) for c in row), ', '.join('?' * len(row))),
+                        list(row.values()))
+
+    def storeScan(self, studyPath, scanDir, stamp, curAcqp):
+        row = {'scanDir': scanDir, 'studyPath': studyPath, 'stamp': stamp,
+               'version': paRE.parserVersion}
+        for c in scanColumns:
+            row[c] = curAcqp.parameters[c]
+        row['SaveTime'] = timeText(row['SaveTime'])
+        for key, (low, high) in rangeColumns.items():
+            row[low], row[high] = valueRange(curAcqp.parameters[key])
+        self.insert('scans', row)
+
+    def storeStudy(self, studyPath, studyDir, subject):
+        row = {'studyPath': studyPath, 'studyDir': studyDir}
+        for c in subjectColumns:
+            row[c] = subject.get(c)
+        self.insert('studies', row)
+
+    def skipScan(self, curDir, scanNum, err):
+        print('Skipping scan ' + scanNum + ' of ' + curDir + ': ' + runReport.errorText(err),
+              file=sys.stderr)
+
+    # Bring the index up to date for the given study directories. Only new or
+    # modified scans are parsed; scans that disappeared are removed. A scan
+    # that cannot be read is reported and skipped without stopping its study.
+    # Returns a dict mapping each study directory to the number of scans
+    # parsed, or to the exception that stopped it.
+    def update(self, paths, workers=1):
+        results = {}
+        pool = None
+        if workers > 1:
+            pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+        mapScans = pool.map if pool is not None else map
+        try:
+            for curDir in paths:
+                studyPath = os.path.abspath(curDir)
+                fs = studyFS.localFS
+                try:
+                    fs, studyDir = py_acqp.findStudyDir(curDir)
+                    scanNums = py_acqp.listScans(studyDir, fs)
+                    scanDirs = {d: fs.key(fs.join(studyDir, d)) for d in scanNums}
+                    stampScan = functools.partial(scanCache.scanStamp, fs=fs)
+                    stamps = {}
+                    for d in scanNums:
+                        stamp = py_acqp.isolated(stampScan, fs.join(studyDir, d))
+                        if isinstance(stamp, Exception):
+                            self.skipScan(curDir, d, stamp)
+                        else:
+                            stamps[scanDirs[d]] = stamp
+                    current = self.currentScans(studyPath, stamps)
+                    toRead = [d for d in scanNums if scanDirs[d] in stamps and scanDirs[d] not in current]
+
+                    parsed = 0
+                    readScan = functools.partial(py_acqp.isolated, py_acqp.readScan)
+                    for d, curAcqp in zip(toRead, mapScans(readScan, itertools.repeat(studyDir),
+                                                           toRead, itertools.repeat(fs))):
+                        if isinstance(curAcqp, Exception):
+                            self.skipScan(curDir, d, curAcqp)
+                        else:
+                            self.storeScan(studyPath, scanDirs[d], stamps[scanDirs[d]], curAcqp)
+                            parsed += 1
+                    # Rows of scans that could not be read are left as they
+                    # are; their stamps no longer match, so the next update
+                    # tries them again
+                    listed = set(scanDirs.values())
+                    self.db.executemany('DELETE FROM scans WHERE studyPath = ? AND scanDir = ?',
+                                        [(studyPath, row['scanDir']) for row in
+                                         self.db.execute('SELECT scanDir FROM scans WHERE studyPath = ?',
+                                                         (studyPath,))
+                                         if row['scanDir'] not in listed])
+                    self.storeStudy(studyPath, fs.key(studyDir), py_acqp.readSubject(studyDir, fs))
+                    self.db.commit()
+                    results[curDir] = parsed
+                except Exception as err:
+                    self.db.rollback()
+                    print('Skipping ' + curDir + ': ' + runReport.errorText(err), file=sys.stderr)
+                    results[curDir] = err
+                finally:
+                    fs.close()
+        finally:
+            if pool is not None:
+                pool.shutdown()
+        return results
+
+    # Scans matching all of the given conditions, ordered by SaveTime, as
+    # dicts holding the scan parameters and the subject fields of the study.
+    # pulseProg, protocol, subject and pvVersion accept glob patterns
+    # ('RARE*'); since/until accept dates, datetimes or ISO strings (UTC);
+    # minTR/maxTR/minTE/maxTE select scans with any repetition or echo time
+    # within the limit.
+    def query(self, pulseProg=None, protocol=None, subject=None, pvVersion=None,
+              since=None, until=None, minTR=None, maxTR=None, minTE=None, maxTE=None):
+        conditions = []
+        args = []
+        for column, pattern in (('s.PulseProg', pulseProg), ('s.acqProtocol', protocol),
+                                ('t.SUBJECT_id', subject), ('s.PVver', pvVersion)):
+            if pattern is not None:
+                conditions.append(column + ' GLOB ?')
+                args.append(pattern)
+        for column, op, limit in (('s.SaveTime', '>=', timeText(since)),
+                                  ('s.SaveTime', '<=', timeText(until)),
+                                  ('s.RepTimeMax', '>=', minTR), ('s.RepTimeMin', '<=', maxTR),
+                                  ('s.EchoTimeMax', '>=', minTE), ('s.EchoTimeMin', '<=', maxTE)):
+            if limit is not None:
+                conditions.append(column + ' ' + op + ' ?')
+                args.append(limit)
+
+        sql = ('SELECT s.*, ' + ', '.join('t.' + quote(c) for c in subjectColumns)
+               + ' FROM scans s LEFT JOIN studies t ON s.studyPath = t.studyPath')
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY s.SaveTime, s.studyPath'
+        return [dict(row) for row in self.db.execute(sql, args)]
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+
+def main(argv=None):
+    argParser = argparse.ArgumentParser(description='Build and query an archive-wide scan index.')
+    commands = argParser.add_subparsers(dest='command', required=True)
+
+    update = commands.add_parser('update', help='add new or changed scans to the index')
+    update.add_argument('index', help='SQLite index file')
+    update.add_argument('paths', nargs='+',
+                        help='study directories or .PVDatasets/.zip/.tar archives, or glob patterns')
+    update.add_argument('-j', '--workers', type=int, default=1,
+                        help='number of worker processes (default 1)')
+
+    query = commands.add_parser('query', help='print matching scans as CSV')
+    query.add_argument('index', help='SQLite index file')
+    query.add_argument('--pulse', help="pulse program, glob pattern (e.g. 'RARE*')")
+    query.add_argument('--protocol', help='acquisition protocol, glob pattern')
+    query.add_argument('--subject', help='SUBJECT_id, glob pattern')
+    query.add_argument('--pv', help="ParaVision version, glob pattern (e.g. 'PV 6*')")
+    query.add_argument('--since', help='earliest save time (ISO date or time, UTC)')
+    query.add_argument('--until', help='latest save time (ISO date or time, UTC)')
+    query.add_argument('--min-tr', type=float)
+    query.add_argument('--max-tr', type=float)
+    query.add_argument('--min-te', type=float)
+    query.add_argument('--max-te', type=float)
+    query.add_argument('--columns', help='comma separated columns to print (default: CSV columns)')
+    args = argParser.parse_args(argv)
+
+    index = ScanIndex(args.index)
+    try:
+        if args.command == 'update':
+            paths = [m for p in args.paths for m in sorted(glob.glob(p))
+                     if os.path.isdir(m) or studyFS.isArchive(m)]
+            results = index.update(paths, workers=args.workers)
+            for curDir, result in results.items():
+                if not isinstance(result, Exception):
+                    print(curDir + ': ' + str(result) + ' scans parsed')
+            return 1 if any(isinstance(r, Exception) for r in results.values()) else 0
+
+        rows = index.query(pulseProg=args.pulse, protocol=args.protocol, subject=args.subject,
+                           pvVersion=args.pv, since=args.since, until=args.until,
+                           minTR=args.min_tr, maxTR=args.max_tr,
+                           minTE=args.min_te, maxTE=args.max_te)
+        columns = args.columns.split(',') if args.columns else ['studyPath'] + py_acqp.csvFieldnames
+        writer = csv.DictWriter(sys.stdout, lineterminator='\n', fieldnames=columns,
+                                extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(rows)
+        return 0
+    finally:
+        index.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+Compact in-memory form of the parameters of one scan, for holding the scans
+of many studies at once (an index run over an archive, or a QA pass over a
+million scans) in a few hundred bytes of overhead per scan instead of a few
+kilobytes.
+
+A ScanRecord behaves like the parameter dictionary Acqp used to hold (keys,
+[], get, items, update, dict(record)) but keeps its values in __slots__, one
+per parameter key, with no per-instance dictionary. The value strings of the
+enum-like fields (pulse program, orientation, read-out direction, fat
+suppression, gating) and of every other field that repeats from scan to scan
+(protocol settings, slice geometry, versions) are interned with sys.intern,
+so the many scans that share a protocol share one copy of each value. Only
+reference power, receiver gain, frequency and save time stay per scan.
+
+internShapes shares the table of declared array shapes (Acqp.shapes) the
+same way, and an Acqp drops its per-scan timings once they are in the run
+report (Acqp.releaseStats), so that a whole parsed scan is held in under
+1 kB.
+
+csvView() is a read-only view of the CSV columns over the record, which is
+what Acqp.csvParameters now returns; the CSV fields are no longer copied
+into a second dictionary.
+
+"""
+
+import sys
+import collections.abc
+import paramRE as paRE
+
+# Parameter keys, in the order Acqp has always listed them; fields added to
+# the registry later are appended
+parameterKeys = ('ScanNumber', 'PulseProg', 'acqProtocol', 'refPower', 'ReceiverGain', 'RepTime',
+                 'EchoTime', 'nEchoes', 'RecovTime', 'nSlices', 'nSlicePacks', 'FOV', 'Matrix',
+                 'SliceThick', 'SliceSep', 'SliceList', 'SliceOffset', 'SlicePackOffset',
+                 'ReadOffset', 'PhaseOffset', 'nAverages', 'ImageOrient', 'SlicepackVec',
+                 'nEvolutionCycles', 'nRepetitions', 'EvolutionDelay', 'FlipAngle', 'IdealFAat',
+                 'BasicFreq', 'SpecWidth', 'ExcitationPulse', 'RefocusingPulse', 'PulseShape',
+                 'ReadOutDir', 'RareFactor', 'FatSat', 'Gating', 'wordType', 'rawWordType',
+                 'ByteOrder', 'SaveTime', 'Filename', 'MusWt', 'subjOrientHF', 'subjOrientSP',
+                 'PVver', 'Major PV ver', 'dwiBvals', 'dwiA0', 'FlowDir', 'Venc')
+parameterKeys += tuple(key for key in paRE.scanFields if key not in parameterKeys)
+
+# Keys of Acqp.csvParameters
+csvKeys = ('ScanNumber', 'acqProtocol', 'refPower', 'ReceiverGain', 'RepTime', 'EchoTime', 'nEchoes',
+           'nSlices', 'FOV', 'Matrix', 'SliceThick', 'SliceSep', 'nAverages', 'ImageOrient',
+           'nEvolutionCycles', 'nRepetitions', 'SlicePackOffset', 'ReadOutDir', 'ReadOffset',
+           'PhaseOffset', 'RareFactor', 'ExcitationPulse', 'RefocusingPulse', 'SpecWidth', 'FatSat',
+           'Gating', 'FlipAngle', 'SaveTime', 'FlowDir', 'Venc')
+
+# Values measured afresh for every scan, which are not worth interning; the
+# text of every other field (the enum-like fields, the protocol fields, slice
+# geometry, ...) repeats from scan to scan
+measuredKeys = frozenset(('refPower', 'ReceiverGain', 'BasicFreq', 'SaveTime'))
+internedKeys = frozenset(key for key in parameterKeys if key not in measuredKeys)
+
+# Tables of declared array shapes (Acqp.shapes), one shared by all the scans
+# whose fields have the same shapes, as the scans of one protocol do. The
+# shared tables are not to be modified.
+shapeTables = {}
+
+
+def internShapes(shapes):
+    key = tuple(shapes.items())
+    table = shapeTables.get(key)
+    if table is None:
+        table = shapeTables[key] = dict(key)
+    return table
+
+
+# Slot of each key ('Major PV ver' is not an identifier)
+slotNames = {key: key.replace(' ', '_') for key in parameterKeys}
+csvKeySet = frozenset(csvKeys)
+
+
+class ScanRecord(collections.abc.MutableMapping):
+    __slots__ = tuple(slotNames.values())
+
+    def __init__(self, scanNum='', parameters=None):
+        for slot in self.__slots__:
+            setattr(self, slot, '')
+        self.ScanNumber = scanNum
+        if parameters is not None:
+            self.update(parameters)
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, slotNames[key])
+        except KeyError:
+            raise KeyError(key) from None
+
+    # Only the parameter keys can be set
+    def __setitem__(self, key, value):
+        if key in internedKeys and type(value) is str:
+            value = sys.intern(value)
+        try:
+            setattr(self, slotNames[key], value)
+        except KeyError:
+            raise KeyError(key) from None
+
+    def __delitem__(self, key):
+        raise TypeError('ScanRecord keys cannot be removed')
+
+    def __contains__(self, key):
+        return key in slotNames
+
+    def __iter__(self):
+        return iter(parameterKeys)
+
+    def __len__(self):
+        return len(parameterKeys)
+
+    def __repr__(self):
+        return 'ScanRecord(%r)' % dict(self)
+
+    # Pickle as the tuple of values, interning them again when unpickled
+    def __reduce__(self):
+        return (fromValues, (tuple(getattr(self, slot) for slot in self.__slots__),))
+
+    def csvView(self):
+        return CsvView(self)
+
+
+def fromValues(values):
+    record = ScanRecord()
+    for key, value in zip(parameterKeys, values):
+        record[key] = value
+    return record
+
+
+# The CSV columns of a ScanRecord, read through to the record
+class CsvView(collections.abc.Mapping):
+    __slots__ = ('record',)
+
+    def __init__(self, record):
+        self.record = record
+
+    def __getitem__(self, key):
+        if key not in csvKeySet:
+            raise KeyError(key)
+        return self.record[key]
+
+    def __iter__(self):
+        return iter(csvKeys)
+
+    def __len__(self):
+        return len(csvKeys)
+
+    def __repr__(self):
+        return 'CsvView(%r)' % dict(self)
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+Columnar export of all scans from a set of studies, as an alternative to
+globbing and re-reading the per-study CSV files.
+
+Two tables are written: one row per scan with a typed column for every
+Acqp.parameters field, and one row per study with the subject fields. Scan
+rows refer to their study through the StudyIndex column.
+
+The format follows the file extension:
+    .parquet  two Parquet files, <name>_scans.parquet and <name>_studies.parquet
+              (needs pyarrow)
+    .npz      one compressed NumPy archive with keys scans/<column> and
+              studies/<column> (needs only NumPy)
+
+Numeric fields are decoded with Acqp.typedParameters. Array fields (RepTime,
+FOV, SliceOffset, ...) become list columns in Parquet; in the .npz archive
+they are stored flattened as <column>.values together with <column>.offsets,
+so that scan i holds values[offsets[i]:offsets[i+1]]. Arrays of integer
+fields (Matrix, nSlices, SliceList, ...) keep int64 values; scalar integer
+columns with blanks are stored as floats with NaN. SaveTime is stored in UTC, with
+the original UTC offset in seconds in SaveTimeOffset.
+
+"""
+
+import os
+import datetime
+import importlib.util
+import numpy as np
+import paramRE as paRE
+
+
+# Build the scan and study tables as dicts of column name -> list of values.
+# studies is a list of (studyPath, acqpList, subject) tuples.
+def buildTables(studies):
+    scanTable = {'StudyIndex': []}
+    studyTable = {'StudyIndex': [], 'StudyPath': [], 'StudyName': []}
+    for key in paRE.subjectFields:
+        studyTable[key] = []
+
+    for studyIndex, (studyPath, acqpList, subject) in enumerate(studies):
+        studyTable['StudyIndex'].append(studyIndex)
+        studyTable['StudyPath'].append(os.path.abspath(studyPath))
+        studyTable['StudyName'].append(os.path.basename(os.path.normpath(studyPath)))
+        for key in paRE.subjectFields:
+            studyTable[key].append(subject.get(key) or '')
+
+        for curAcqp in acqpList:
+            scanTable['StudyIndex'].append(studyIndex)
+            for key, value in curAcqp.typedParameters().items():
+                scanTable.setdefault(key, []).append(value)
+
+    # SaveTime is kept in UTC with its offset alongside
+    saveTimes = scanTable.pop('SaveTime', [])
+    scanTable['SaveTime'] = [t.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+                             if isinstance(t, datetime.datetime) and t.tzinfo is not None else t
+                             for t in saveTimes]
+    scanTable['SaveTimeOffset'] = [int(t.utcoffset().total_seconds())
+                                   if isinstance(t, datetime.datetime) and t.tzinfo is not None else None
+                                   for t in saveTimes]
+    return scanTable, studyTable
+
+
+def isBlank(value):
+    return value is None or (isinstance(value, str) and value == '')
+
+
+# How a column is stored: 'array' (ragged numeric), 'float', 'int',
+# 'datetime' or 'str'
+def columnKind(key, values):
+    field = paRE.scanFields.get(key)
+    present = [v for v in values if not isBlank(v)]
+    if any(isinstance(v, np.ndarray) for v in present):
+        return 'array'
+    if any(isinstance(v, datetime.datetime) for v in present):
+        return 'datetime'
+    numeric = all(isinstance(v, (int, float, np.number)) and not isinstance(v, bool) for v in present)
+    if numeric and (present or (field is not None and field.dtype is not None)):
+        if field is not None and field.dtype is float:
+            return 'float'
+        return 'int' if all(isinstance(v, (int, np.integer)) for v in present) else 'float'
+    return 'str'
+
+
+# Element type of an array column: int64 if every value in it is an integer
+# (Matrix, nSlices, SliceList, ...), otherwise float
+def arrayDtype(values):
+    for v in values:
+        if isinstance(v, np.ndarray):
+            if not np.issubdtype(v.dtype, np.integer):
+                return float
+        elif not isBlank(v) and not (isinstance(v, (int, np.integer)) and not isinstance(v, bool)):
+            return float
+    return np.int64
+
+
+def npzColumns(prefix, table):
+    columns = {}
+    for key, values in table.items():
+        kind = columnKind(key, values)
+        name = prefix + '/' + key
+        if kind == 'array':
+            dtype = arrayDtype(values)
+            parts = [np.ravel(v).astype(dtype) if isinstance(v, np.ndarray) else
+                     np.array([v], dtype=dtype) if isinstance(v, (int, float)) else
+                     np.empty(0, dtype=dtype) for v in values]
+            columns[name + '.values'] = np.concatenate(parts) if parts else np.empty(0, dtype=dtype)
+            columns[name + '.offsets'] = np.concatenate(([0], np.cumsum([len(p) for p in parts])))
+        elif kind == 'datetime':
+            columns[name] = np.array([np.datetime64(v, 'us') if v is not None else np.datetime64('NaT')
+                                      for v in values], dtype='datetime64[us]')
+        elif kind == 'int' and None not in values:
+            columns[name] = np.array(values, dtype=np.int64)
+        elif kind in ('int', 'float'):
+            columns[name] = np.array([np.nan if isBlank(v) else v for v in values], dtype=float)
+        else:
+            columns[name] = np.array(['' if v is None else str(v) for v in values], dtype=str)
+    return columns
+
+
+def writeNpz(path, scanTable, studyTable):
+    columns = npzColumns('scans', scanTable)
+    columns.update(npzColumns('studies', studyTable))
+    np.savez_compressed(path, **columns)
+    return [path]
+
+
+def arrowTable(table):
+    import pyarrow as pa
+    arrays = {}
+    for key, values in table.items():
+        kind = columnKind(key, values)
+        if kind == 'array':
+            valueType = pa.int64() if arrayDtype(values) is np.int64 else pa.float64()
+            arrays[key] = pa.array([np.ravel(v).tolist() if isinstance(v, np.ndarray) else
+                                    [v] if isinstance(v, (int, float)) else None for v in values],
+                                   type=pa.list_(valueType))
+        elif kind == 'datetime':
+            arrays[key] = pa.array(values, type=pa.timestamp('us', tz='UTC'))
+        elif kind == 'int':
+            arrays[key] = pa.array(values, type=pa.int64())
+        elif kind == 'float':
+            arrays[key] = pa.array([None if isBlank(v) else v for v in values], type=pa.float64())
+        else:
+            arrays[key] = pa.array(['' if v is None else str(v) for v in values], type=pa.string())
+    return pa.table(arrays)
+
+
+def writeParquet(path, scanTable, studyTable):
+    import pyarrow.parquet as pq
+    stem = os.path.splitext(path)[0]
+    paths = [stem + '_scans.parquet', stem + '_studies.parquet']
+    pq.write_table(arrowTable(scanTable), paths[0])
+    pq.write_table(arrowTable(studyTable), paths[1])
+    return paths
+
+
+# Raise ValueError if path cannot be written by exportStudies (unknown
+# extension, or .parquet without pyarrow), so that a run can reject it before
+# any study is parsed
+def checkExportPath(path):
+    if path.endswith('.parquet'):
+        if importlib.util.find_spec('pyarrow') is None:
+            raise ValueError('Writing ' + path + ' needs pyarrow')
+    elif not path.endswith('.npz'):
+        raise ValueError('Export file must end in .parquet or .npz: ' + path)
+
+
+# Write the scan and study tables to path (.parquet or .npz) and return the
+# list of files written
+def exportStudies(path, studies):
+    checkExportPath(path)
+    scanTable, studyTable = buildTables(studies)
+    if path.endswith('.parquet'):
+        return writeParquet(path, scanTable, studyTable)
+    return writeNpz(path, scanTable, studyTable)
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""
+File system layer used to find and read the parameter files of a study, so
+that studies can be summarized straight from the archives exported by the
+scanner without unpacking them first.
+
+    LocalFS    ordinary directories, <study>/Raw_Data/<bruker folder>/<scan>
+    ZipFS      .PVDatasets and .zip archives
+    TarFS      .tar, .tar.gz/.tgz and .tar.bz2 archives
+
+All of them offer the same small interface (listdir, isdir, isfile, join,
+read, stamp, key, paramFile). Paths inside archives are member paths with '/'
+separators, '' being the top of the archive. Only the members that are asked
+for (acqp, method, subject) are read and decompressed. Archive file systems
+open their archive on first use and can be pickled, so they can be passed to
+worker processes. They may also be read from several threads at once (see
+ioPool); the archive is opened and read under a lock.
+
+"""
+
+import os
+import posixpath
+import zipfile
+import tarfile
+import threading
+import paramFile
+
+zipSuffixes = ('.pvdatasets', '.zip')
+tarSuffixes = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz')
+
+
+class LocalFS:
+    def listdir(self, path):
+        return os.listdir(path)
+
+    def isdir(self, path):
+        return os.path.isdir(path)
+
+    def isfile(self, path):
+        return os.path.isfile(path)
+
+    def join(self, *parts):
+        return os.path.join(*parts)
+
+    def read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    # Modification time and size of a file as a string, used to validate
+    # cached entries
+    def stamp(self, path):
+        st = os.stat(path)
+        return '%d:%d' % (st.st_mtime_ns, st.st_size)
+
+    # Unique name of a path, used as key in the cache and the index
+    def key(self, path):
+        return os.path.abspath(path)
+
+    def paramFile(self, path):
+        return paramFile.ParamFileMap(path)
+
+    def close(self):
+        pass
+
+
+localFS = LocalFS()
+
+
+# Common part of the archive file systems: a table of members and of the
+# directories they imply, built on first use
+class ArchiveFS:
+    def __init__(self, archivePath):
+        self.archivePath = archivePath
+        self.archive = None
+        self.lock = threading.RLock()
+
+    def __getstate__(self):
+        return {'archivePath': self.archivePath, 'archive': None}
+
+    def __setstate__(self, state):
+        self.__init__(state['archivePath'])
+
+    def load(self):
+        with self.lock:
+            if self.archive is not None:
+                return
+            archive, members = self.openArchive()
+            self.members = {}
+            self.children = {'': set()}
+            for name, member in members:
+                name = name.strip('/')
+                if not name:
+                    continue
+                self.members[name] = member
+                parts = name.split('/')
+                for i in range(len(parts)):
+                    parent = '/'.join(parts[:i])
+                    self.children.setdefault(parent, set()).add(parts[i])
+                    if i < len(parts) - 1:
+                        self.children.setdefault('/'.join(parts[:i+1]), set())
+            self.archive = archive
+
+    def listdir(self, path):
+        self.load()
+        path = path.strip('/')
+        if path not in self.children:
+            raise FileNotFoundError(self.archivePath + ':' + path)
+        return sorted(self.children[path])
+
+    def isdir(self, path):
+        self.load()
+        return path.strip('/') in self.children
+
+    def isfile(self, path):
+        self.load()
+        path = path.strip('/')
+        return path in self.members and path not in self.children
+
+    def join(self, *parts):
+        return posixpath.join(*[p for p in parts if p])
+
+    def key(self, path):
+        return os.path.abspath(self.archivePath) + '!' + path.strip('/')
+
+    def paramFile(self, path):
+        return paramFile.ParamFileMap.fromBytes(self.read(path), self.key(path))
+
+    def close(self):
+        with self.lock:
+            if self.archive is not None:
+                self.archive.close()
+                self.archive = None
+
+
+class ZipFS(ArchiveFS):
+    def openArchive(self):
+        archive = zipfile.ZipFile(self.archivePath)
+        return archive, [(info.filename, info) for info in archive.infolist()]
+
+    def read(self, path):
+        self.load()
+        with self.lock:
+            return self.archive.read(self.members[path.strip('/')])
+
+    def stamp(self, path):
+        self.load()
+        info = self.members[path.strip('/')]
+        return '%04d%02d%02d%02d%02d%02d:%d:%08x' % (info.date_time + (info.file_size, info.CRC))
+
+
+class TarFS(ArchiveFS):
+    def openArchive(self):
+        archive = tarfile.open(self.archivePath)
+        return archive, [(member.name, member) for member in archive.getmembers()]
+
+    def read(self, path):
+        self.load()
+        with self.lock:
+            f = self.archive.extractfile(self.members[path.strip('/')])
+            if f is None:
+                raise FileNotFoundError(self.key(path))
+            with f:
+                return f.read()
+
+    def stamp(self, path):
+        self.load()
+        member = self.members[path.strip('/')]
+        return '%d:%d' % (member.mtime, member.size)
+
+
+def isArchive(path):
+    lower = path.lower()
+    return os.path.isfile(path) and lower.endswith(zipSuffixes + tarSuffixes)
+
+
+# File system and Raw_Data location for a study given as a directory or an
+# archive. In an archive the Bruker folder may sit at the top level, under
+# Raw_Data, or under <study>/Raw_Data when the study folder itself was zipped.
+def openStudy(curDir):
+    if not isArchive(curDir):
+        return localFS, os.path.join(curDir, 'Raw_Data')
+    if curDir.lower().endswith(zipSuffixes):
+        fs = ZipFS(curDir)
+    else:
+        fs = TarFS(curDir)
+    if fs.isdir('Raw_Data'):
+        return fs, 'Raw_Data'
+    studyDirs = [d for d in fs.listdir('') if fs.isdir(fs.join(d, 'Raw_Data'))]
+    if len(studyDirs) == 1:
+        return fs, fs.join(studyDirs[0], 'Raw_Data')
+    return fs, ''
+
+
+# Base name for the output files of a study: <study>/<study>_acqp for a
+# directory, <archive file name>_acqp next to an archive. The archive suffix
+# is kept, so that st3.PVDatasets and st3.tar.gz in one directory do not
+# write the same files.
+def outputBase(curDir):
+    if isArchive(curDir):
+        return curDir + '_acqp'
+    return os.path.join(curDir, os.path.basename(os.path.normpath(curDir))+'_acqp')
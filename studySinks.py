@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""
+Output sinks for the study summary. Scans are handed to each sink one at a
+time as they are parsed, so rows appear as soon as a scan is read and no sink
+needs to hold the whole study in memory. When the study is done each sink
+receives the timing statistics (accumulated online by TimingStats) and the
+subject fields.
+
+Files are written to a temporary <name>.tmp next to their final name, which
+replaces the final file when the sink is closed. A study that fails part way
+is abort()ed instead, which removes the temporary file, so the output of an
+earlier run is never left half-overwritten.
+
+    CsvSink         the <study>_acqp.csv file: one row per scan followed by the
+                    start/finish/elapsed summary and the study information
+    JsonLinesSink   one JSON object per scan, then one for the study summary
+    stdoutSink      a CsvSink writing the scan rows and summary to sys.stdout
+
+The notes about missing subject fields go to sys.stderr, so that they never
+end up in CSV written to standard output.
+
+"""
+
+import os
+import sys
+import csv
+import json
+import datetime
+
+
+# Start, finish and elapsed time of a study, updated one scan at a time
+class TimingStats:
+    def __init__(self):
+        self.count = 0
+        self.start = None
+        self.finish = None
+
+    def add(self, saveTime):
+        if not isinstance(saveTime, datetime.datetime):
+            return
+        self.count += 1
+        if self.start is None or saveTime < self.start:
+            self.start = saveTime
+        if self.finish is None or saveTime > self.finish:
+            self.finish = saveTime
+
+    def elapsedMinutes(self):
+        if self.count == 0:
+            return None
+        return (self.finish-self.start).total_seconds()/60
+
+
+# A file written under a temporary name and moved into place by commit(), or
+# removed by discard(); whichever comes first wins
+class AtomicFile:
+    def __init__(self, path):
+        self.path = path
+        self.tempPath = path + '.tmp'
+        self.stream = open(self.tempPath, 'w')
+        self.done = False
+
+    def commit(self):
+        if not self.done:
+            self.stream.close()
+            os.replace(self.tempPath, self.path)
+            self.done = True
+
+    def discard(self):
+        if not self.done:
+            self.done = True
+            self.stream.close()
+            try:
+                os.remove(self.tempPath)
+            except FileNotFoundError:
+                pass
+
+
+class CsvSink:
+    def __init__(self, path, fieldnames, stream=None):
+        self.path = path
+        self.file = None
+        if stream is None:
+            self.file = AtomicFile(path)
+            stream = self.file.stream
+        self.csvfile = stream
+        self.writer = csv.DictWriter(self.csvfile, lineterminator='\n', fieldnames=fieldnames,
+                                     extrasaction='ignore')
+        self.writer.writeheader()
+
+    def writeScan(self, curAcqp):
+        self.writer.writerow(curAcqp.csvParameters)
+
+    def finish(self, stats, subject):
+        writer2 = csv.writer(self.csvfile, lineterminator='\n', delimiter=',')
+        writer2.writerow('')
+        if stats.count > 0:
+            minTime, maxTime = stats.start, stats.finish
+            writer2.writerow(['Start date:', minTime.date(), 'Start time:', minTime.strftime('%H:%M')])
+            writer2.writerow(['Finish date:', maxTime.date(), 'Finish time:', maxTime.strftime('%H:%M')])
+            writer2.writerow(['Elapsed time:', str.format("{0:.1f}", stats.elapsedMinutes()), 'min'])
+        else:
+            writer2.writerow(['Start date:', '', 'Start time:', ''])
+            writer2.writerow(['Finish date:', '', 'Finish time:', ''])
+            writer2.writerow(['Elapsed time:', '', 'min'])
+        writer2.writerow('')
+        writer2.writerow('')
+        writer2.writerow(['STUDY INFORMATION'])
+        writer2.writerow('')
+
+        writer2.writerow(['Subject ID:', '', subject['SUBJECT_id']])
+        writer2.writerow(['Study Name:', '', subject['SUBJECT_study_name']])
+
+        if subject['SUBJECT_sex'] is not None:
+            writer2.writerow(['Sex:', '', subject['SUBJECT_sex']])
+        else:
+            print('No sex specified\n', file=sys.stderr)
+            writer2.writerow('')
+
+        if subject['SUBJECT_weight'] is not None:
+            writer2.writerow(['Weight:', '', subject['SUBJECT_weight']])
+        else:
+            print('No weight specified\n', file=sys.stderr)
+
+        if subject['SUBJECT_remarks'] is not None:
+            writer2.writerow(['Subject Comments:', '', subject['SUBJECT_remarks']])
+        else:
+            print('No subject comments specified\n', file=sys.stderr)
+            writer2.writerow(['Subject Comments:'])
+
+        if subject['SUBJECT_comment'] is not None:
+            writer2.writerow(['Study Comments:', '', subject['SUBJECT_comment']])
+        else:
+            print('No study comments specified\n', file=sys.stderr)
+            writer2.writerow(['Study Comments:'])
+
+    def close(self):
+        if self.file is not None:
+            self.file.commit()
+        else:
+            self.csvfile.flush()
+
+    # Drop what was written for a study that failed
+    def abort(self):
+        if self.file is not None:
+            self.file.discard()
+
+
+def jsonDefault(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    return str(value)
+
+
+class JsonLinesSink:
+    def __init__(self, path, studyPath, stream=None):
+        self.path = path
+        self.studyPath = studyPath
+        self.file = None
+        if stream is None:
+            self.file = AtomicFile(path)
+            stream = self.file.stream
+        self.stream = stream
+
+    def writeLine(self, record):
+        self.stream.write(json.dumps(record, default=jsonDefault) + '\n')
+
+    def writeScan(self, curAcqp):
+        record = {'study': self.studyPath}
+        record.update(curAcqp.parameters)
+        self.writeLine(record)
+
+    def finish(self, stats, subject):
+        record = {'study': self.studyPath, 'scans': stats.count,
+                  'start': stats.start, 'finish': stats.finish,
+                  'elapsedMinutes': stats.elapsedMinutes()}
+        record.update(subject)
+        self.writeLine(record)
+
+    def close(self):
+        if self.file is not None:
+            self.file.commit()
+        else:
+            self.stream.flush()
+
+    def abort(self):
+        if self.file is not None:
+            self.file.discard()
+
+
+def stdoutSink(fieldnames):
+    return CsvSink(None, fieldnames, sys.stdout)
@@ -0,0 +1,330 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic Bruker ParaVision data for test driving and benchmarking the
+parser without access to scanner data.
+
+Writes acqp, method and subject files laid out as the scanner exports them,
+    <root>/<study>/Raw_Data/<date>_<study>.1/<scan>/{acqp,method}
+    <root>/<study>/Raw_Data/<date>_<study>.1/subject
+in the JCAMP-DX dialect of ParaVision 5, 6 or 360: size headers, <strings>,
+bare enums, arrays wrapped at 80 columns, the save time in the $$ line after
+##OWNER (PV5 uses the 'Wed Jan 24 10:44:26 2018 CET (UT+1h)' layout), and
+PV360's @n*(value) run-length encoding of repeated values. Each file is
+padded with filler records, so that the files have the size and record
+count of real ones and the parser has to skip over them.
+
+Scan kinds (see scanKinds):
+    rare         single TR/TE imaging scan
+    multiTR      several repetition times (e.g. T1 mapping)
+    multiTE      several echo times (e.g. MSME T2 mapping)
+    multiPack    several slice packages (e.g. tri-pilot)
+    singlepulse  non-imaging adjustment scan (no imaging fields)
+    large        hundreds of slices and large filler arrays
+
+Everything is derived from a seed, so the same arguments always give the
+same files (for the same generatorVersion). The protocol settings (TR, TE, slices, averages) of each kind come
+from one of two fixed variants, so protocols repeat across scans and studies
+as they do on a scanner, while reference power, receiver gain and frequency
+vary from scan to scan. writeStudy can also return the field values it
+wrote for each scan, keyed as in paramRE.scanFields, so that a parse of the
+files can be checked against them.
+
+Usage:
+    python synthBruker.py OUTDIR [--studies N] [--scans N] [--pv 5|6|360|mixed] [--seed N]
+
+"""
+
+import os
+import sys
+import random
+import argparse
+import datetime
+
+# Bump whenever the files written for the same arguments change, so that
+# benchmark results on different data are not compared
+generatorVersion = 1
+
+scanKinds = ('rare', 'multiTR', 'multiTE', 'multiPack', 'singlepulse', 'large')
+pvVersions = {'5': 'PV 5.1', '6': 'PV 6.0.1', '360': 'PV-360.3.0'}
+
+# Time zones used for the save times: UTC offset and PV5 zone name
+timeZones = [(datetime.timedelta(hours=1), 'CET'), (datetime.timedelta(hours=2), 'CEST'),
+             (datetime.timedelta(hours=-5), 'EST'), (datetime.timedelta(0), 'UTC')]
+
+
+# Save time as written in the $$ line after ##OWNER
+def formatSaveTime(saveTime, pv):
+    offset = saveTime.utcoffset()
+    if pv == '5':
+        hours = offset.total_seconds() / 3600
+        zone = next((name for o, name in timeZones if o == offset), 'UTC')
+        return saveTime.strftime('%a %b %d %H:%M:%S %Y ') + '%s (UT%+gh)' % (zone, hours)
+    return saveTime.strftime('%Y-%m-%d %H:%M:%S.') + '%03d' % (saveTime.microsecond // 1000) \
+        + saveTime.strftime(' %z')
+
+
+def formatNumber(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+# Value lines of an array, wrapped at 80 columns as ParaVision does. PV360
+# writes runs of equal values as @n*(value).
+def formatArray(values, pv):
+    words = []
+    i = 0
+    while i < len(values):
+        j = i
+        while j < len(values) and values[j] == values[i]:
+            j += 1
+        if pv == '360' and j - i > 1:
+            words.append('@%d*(%s)' % (j - i, formatNumber(values[i])))
+        else:
+            words.extend(formatNumber(v) for v in values[i:j])
+        i = j
+    lines = []
+    line = ''
+    for word in words:
+        if line and len(line) + 1 + len(word) > 80:
+            lines.append(line)
+            line = word
+        else:
+            line = line + ' ' + word if line else word
+    lines.append(line)
+    return '\n'.join(lines)
+
+
+# One ##$ record. value may be a string (written as <string>), an enum (a
+# string given with enum=True, written bare), a number, or a list of numbers
+# or enums with an optional shape (defaults to the list length).
+def formatRecord(name, value, pv, shape=None, enum=False):
+    if isinstance(value, str):
+        if enum:
+            return '##$%s=%s\n' % (name, value)
+        return '##$%s=( %d )\n<%s>\n' % (name, max(len(value) + 1, 64), value)
+    if isinstance(value, (list, tuple)):
+        shape = shape or (len(value),)
+        header = '( %s )' % ', '.join(str(n) for n in shape)
+        if value and isinstance(value[0], str):
+            return '##$%s=%s\n%s\n' % (name, header, ' '.join(value))
+        return '##$%s=%s\n%s\n' % (name, header, formatArray(list(value), pv))
+    return '##$%s=%s\n' % (name, formatNumber(value))
+
+
+# Filler records of the kinds found in real files: numbers, enums, strings,
+# arrays and structures. large adds a few arrays of thousands of values.
+def fillerRecords(rng, prefix, count, pv, large=False):
+    records = []
+    for i in range(count):
+        name = '%s_Filler%03d' % (prefix, i)
+        kind = i % 5
+        if kind == 0:
+            records.append(formatRecord(name, round(rng.uniform(-1000, 1000), 4), pv))
+        elif kind == 1:
+            records.append(formatRecord(name, rng.choice(['Yes', 'No', 'On', 'Off']), pv, enum=True))
+        elif kind == 2:
+            records.append(formatRecord(name, 'filler text %d' % rng.randrange(10**6), pv))
+        elif kind == 3:
+            n = rng.randrange(2, 40)
+            records.append(formatRecord(name, [round(rng.uniform(0, 100), 2) for _ in range(n)], pv))
+        else:
+            records.append('##$%s=(%d, <fill>, %g)\n' % (name, rng.randrange(100), rng.random()))
+    if large:
+        for i in range(4):
+            n = 16384
+            values = [0] * (n // 2) + [rng.randrange(1000) for _ in range(n // 2)]
+            records.append(formatRecord('%s_LargeArray%d' % (prefix, i), values, pv))
+    return records
+
+
+def header(pv, owner, saveTime, path):
+    return ('##TITLE=Parameter List, ParaVision %s\n##JCAMPDX=4.24\n##DATATYPE=Parameter Values\n'
+            '##ORIGIN=Bruker BioSpin MRI GmbH\n##OWNER=%s\n$$ %s  %s\n$$ %s\n'
+            % (pvVersions[pv].replace('PV', '').strip(' -'), owner,
+               formatSaveTime(saveTime, pv), owner, path))
+
+
+# acqp and method texts of one scan of the given kind. With expected (a
+# dict), the field values written are stored in it.
+def scanTexts(rng, scanNum, kind, pv, saveTime, owner='nmrsu', filler=300, expected=None):
+    large = kind == 'large'
+    variant = random.Random('%s/%d' % (kind, rng.randrange(2)))
+    nPacks = 3 if kind == 'multiPack' else 1
+    slicesPerPack = 512 if large else (1 if kind == 'multiPack' else variant.choice([1, 5, 10, 20]))
+    nSlices = nPacks * slicesPerPack
+    if kind == 'multiTR':
+        repTimes = [float(tr) for tr in (200, 400, 800, 1500, 3000, 5000)]
+    else:
+        repTimes = [float(variant.choice([250, 1500, 2500, 4000]))]
+    if kind == 'multiTE':
+        echoTimes = [round(10.0 * (i + 1), 3) for i in range(variant.choice([8, 16, 32]))]
+    else:
+        echoTimes = [round(variant.uniform(2, 40), 3)]
+    singlepulse = kind == 'singlepulse'
+    pulseProg = 'SINGLEPULSE.ppg' if singlepulse else \
+        {'multiTE': 'MSME.ppg', 'multiPack': 'FLASH.ppg'}.get(kind, 'RARE.ppg')
+    protocol = {'rare': 'T2_TurboRARE', 'multiTR': 'T1map_RARE', 'multiTE': 'T2map_MSME',
+                'multiPack': 'TriPilot', 'singlepulse': 'Adj_SinglePulse',
+                'large': 'T2_TurboRARE_highres'}[kind]
+    scanPath = '/opt/%s/data/%s/nmr/study/%s' % (pvVersions[pv].replace(' ', ''), owner, scanNum)
+    recovTimes = [round(tr - 10, 3) for tr in repTimes]
+    receiverGain = round(rng.uniform(10, 200), 1)
+    flipAngle = 30 if kind == 'multiPack' else 90
+    basicFreq = round(300.33 + rng.uniform(-0.0001, 0.0001), 6)
+
+    acqp = [header(pv, owner, saveTime, scanPath + '/acqp'),
+            formatRecord('ACQ_sw_version', pvVersions[pv], pv),
+            formatRecord('PULPROG', pulseProg, pv),
+            formatRecord('ACQ_protocol_name', protocol, pv),
+            formatRecord('ACQ_repetition_time', repTimes, pv),
+            formatRecord('ACQ_echo_time', echoTimes, pv),
+            formatRecord('ACQ_recov_time', recovTimes, pv),
+            formatRecord('NECHOES', len(echoTimes), pv),
+            formatRecord('RG', receiverGain, pv),
+            formatRecord('ACQ_flip_angle', flipAngle, pv),
+            formatRecord('BF1', basicFreq, pv),
+            formatRecord('SW_h', 50000, pv),
+            formatRecord('BYTORDA', 'little', pv, enum=True),
+            formatRecord('ACQ_station', 'Biospec 70/30', pv)]
+    acqp += fillerRecords(rng, 'ACQ', filler, pv, large)
+    acqp.append('##END=\n')
+
+    nAverages = variant.choice([1, 2, 4])
+    refPower = round(rng.uniform(2, 8), 4)
+    method = [header(pv, owner, saveTime, scanPath + '/method'),
+              '##$Method=<Bruker:%s>\n' % pulseProg.split('.')[0],
+              formatRecord('PVM_NAverages', nAverages, pv),
+              formatRecord('PVM_NRepetitions', 1, pv),
+              formatRecord('PVM_RefPowCh1', refPower, pv)]
+    if not singlepulse:
+        orients = ['axial', 'sagittal', 'coronal'][:nPacks]
+        offsets = [round((i - slicesPerPack / 2) * 1.5, 3) for i in range(slicesPerPack)] * nPacks
+        matrix = [256, 256] if not large else [512, 512]
+        sliceList = list(range(0, nSlices, 2)) + list(range(1, nSlices, 2))
+        rareFactor = 8 if pulseProg == 'RARE.ppg' else 1
+        method += [
+            formatRecord('PVM_SPackArrNSlices', [slicesPerPack] * nPacks, pv),
+            formatRecord('PVM_NSPacks', nPacks, pv),
+            formatRecord('PVM_Fov', [30, 30], pv),
+            formatRecord('PVM_Matrix', matrix, pv),
+            formatRecord('PVM_SliceThick', 1, pv),
+            formatRecord('PVM_SPackArrSliceGap', [0.5] * nPacks, pv),
+            formatRecord('PVM_ObjOrderList', sliceList, pv),
+            formatRecord('PVM_SliceOffset', offsets, pv),
+            formatRecord('PVM_SPackArrSliceOffset', [0] * nPacks, pv),
+            formatRecord('PVM_ReadOffset', [0] * nPacks, pv),
+            formatRecord('PVM_Phase1Offset', [0] * nPacks, pv),
+            formatRecord('PVM_SPackArrSliceOrient', orients, pv),
+            formatRecord('PVM_NEvolutionCycles', 1, pv),
+            '##$ExcPulse1Enum=<hermite>\n',
+            '##$RefPulse1Enum=<hermite>\n',
+            formatRecord('PVM_SPackArrReadOrient', ['L_R'] * nPacks, pv),
+            formatRecord('PVM_RareFactor', rareFactor, pv),
+            formatRecord('PVM_FatSupOnOff', 'On', pv, enum=True),
+            formatRecord('PVM_TriggerModule', 'Off', pv, enum=True),
+            formatRecord('PVM_SPackArrPhase1Offset', [0] * nPacks, pv),
+        ]
+    method += fillerRecords(rng, 'PVM', filler, pv, large)
+    method.append('##END=\n')
+
+    if expected is not None:
+        # PV5 save times are written to the second
+        expected.update({'PulseProg': pulseProg, 'acqProtocol': protocol, 'RepTime': repTimes,
+                         'EchoTime': echoTimes, 'RecovTime': recovTimes, 'nEchoes': len(echoTimes),
+                         'ReceiverGain': receiverGain, 'FlipAngle': flipAngle, 'BasicFreq': basicFreq,
+                         'SpecWidth': 50000, 'ByteOrder': 'little', 'nAverages': nAverages,
+                         'nRepetitions': 1, 'refPower': refPower, 'PVver': pvVersions[pv],
+                         'SaveTime': saveTime.replace(microsecond=0) if pv == '5' else saveTime})
+        if not singlepulse:
+            expected.update({'nSlices': [slicesPerPack] * nPacks, 'nSlicePacks': nPacks,
+                             'FOV': [30, 30], 'Matrix': matrix, 'SliceThick': 1,
+                             'SliceSep': [0.5] * nPacks, 'SliceList': sliceList,
+                             'SliceOffset': offsets, 'ImageOrient': ' '.join(orients),
+                             'ReadOutDir': ' '.join(['L_R'] * nPacks), 'RareFactor': rareFactor,
+                             'ExcitationPulse': 'hermite', 'FatSat': 'On', 'Gating': 'Off'})
+    return ''.join(acqp), ''.join(method)
+
+
+def subjectText(rng, pv, studyName, saveTime, owner='nmrsu'):
+    return ''.join([header(pv, owner, saveTime, '/opt/data/%s/subject' % studyName),
+                    formatRecord('SUBJECT_id', 'mouse_%03d' % rng.randrange(1000), pv),
+                    formatRecord('SUBJECT_study_name', studyName, pv),
+                    formatRecord('SUBJECT_sex', rng.choice(['MALE', 'FEMALE']), pv, enum=True),
+                    formatRecord('SUBJECT_weight', round(rng.uniform(0.02, 0.04), 3), pv),
+                    formatRecord('SUBJECT_remarks', 'synthetic subject', pv),
+                    formatRecord('SUBJECT_comment', '', pv),
+                    '##END=\n'])
+
+
+# Kinds of the scans of a study: a singlepulse adjustment first, as on the
+# scanner, then the other kinds in turn
+def studyKinds(nScans, includeLarge=True):
+    kinds = [k for k in scanKinds if k != 'singlepulse' and (includeLarge or k != 'large')]
+    return ['singlepulse'] + [kinds[i % len(kinds)] for i in range(nScans - 1)]
+
+
+# Write one study and return its directory. scans is a list of scan kinds;
+# scan numbers follow the list order and the save times run a few minutes
+# apart from start (a naive datetime, put in a time zone chosen from the seed).
+# With expected (a dict), the field values written for each scan are stored
+# in it by scan number (see scanTexts).
+def writeStudy(root, studyName, scans, pv='6', start=None, seed=0, filler=300, expected=None):
+    rng = random.Random('%s:%s' % (seed, studyName))
+    offset, _ = timeZones[rng.randrange(len(timeZones))]
+    start = (start or datetime.datetime(2018, 1, 24, 10, 0)).replace(tzinfo=datetime.timezone(offset))
+    studyDir = os.path.join(root, studyName, 'Raw_Data',
+                            start.strftime('%Y%m%d_') + studyName + '.1')
+    os.makedirs(studyDir, exist_ok=True)
+    with open(os.path.join(studyDir, 'subject'), 'w') as f:
+        f.write(subjectText(rng, pv, studyName, start))
+    saveTime = start
+    for i, kind in enumerate(scans):
+        scanNum = str(i + 1)
+        saveTime += datetime.timedelta(minutes=rng.randrange(1, 15), seconds=rng.randrange(60),
+                                       milliseconds=rng.randrange(1000))
+        scanExpected = None
+        if expected is not None:
+            scanExpected = expected[scanNum] = {}
+        acqpText, methodText = scanTexts(rng, scanNum, kind, pv, saveTime, filler=filler,
+                                         expected=scanExpected)
+        scanDir = os.path.join(studyDir, scanNum)
+        os.makedirs(scanDir, exist_ok=True)
+        with open(os.path.join(scanDir, 'acqp'), 'w') as f:
+            f.write(acqpText)
+        with open(os.path.join(scanDir, 'method'), 'w') as f:
+            f.write(methodText)
+    return os.path.join(root, studyName)
+
+
+# Write nStudies studies of nScans scans each under root and return their
+# directories. pv is '5', '6', '360' or 'mixed' (cycling through the three).
+def writeArchive(root, nStudies=4, nScans=12, pv='6', seed=0, includeLarge=True, filler=300):
+    studies = []
+    for i in range(nStudies):
+        studyPV = sorted(pvVersions)[i % len(pvVersions)] if pv == 'mixed' else pv
+        start = datetime.datetime(2018, 1, 24, 9, 0) + datetime.timedelta(days=i)
+        studies.append(writeStudy(root, 'synth%03d_PV%s' % (i + 1, studyPV),
+                                  studyKinds(nScans, includeLarge), studyPV, start, seed, filler))
+    return studies
+
+
+def main(argv=None):
+    argParser = argparse.ArgumentParser(description='Write synthetic Bruker ParaVision studies.')
+    argParser.add_argument('root', help='output directory')
+    argParser.add_argument('--studies', type=int, default=4, help='number of studies (default 4)')
+    argParser.add_argument('--scans', type=int, default=12, help='scans per study (default 12)')
+    argParser.add_argument('--pv', choices=['5', '6', '360', 'mixed'], default='mixed',
+                           help='ParaVision version of the files (default mixed)')
+    argParser.add_argument('--seed', type=int, default=0)
+    argParser.add_argument('--no-large', action='store_true', help='leave out the large scans')
+    args = argParser.parse_args(argv)
+
+    for path in writeArchive(args.root, args.studies, args.scans, args.pv, args.seed,
+                             not args.no_large):
+        print(path)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
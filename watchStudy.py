@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+"""
+Watch mode: keep the <study>_acqp.csv files of studies that are being
+acquired up to date while the scanner writes them, so that the protocol sheet
+of a running session is always at hand without rerunning the script.
+
+Each study's Raw_Data tree is watched with inotify on Linux (through ctypes,
+no extra packages), or polled every few seconds elsewhere or with --poll.
+Only new or changed scans are parsed. A scan is read once its acqp and method
+files both end with the ##END= record ParaVision writes last and their stamps
+(modification time and size) have not changed for --settle seconds, so files
+are never read half-written. The CSV file, with its summary trailer, is then
+rewritten from the scans already in memory and swapped in with os.replace,
+so a reader never sees a partial file.
+
+Usage:
+    python watchStudy.py [--settle SECONDS] [--interval SECONDS] [--poll] [--cache FILE] study ...
+
+Stop with Ctrl-C.
+
+"""
+
+import os
+import sys
+import time
+import glob
+import ctypes
+import ctypes.util
+import select
+import struct
+import argparse
+import paramRE as paRE
+import scanCache
+import runReport
+import py_acqp
+
+# inotify event masks (linux/inotify.h)
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+# Files that stay incomplete this long are no longer rechecked until they change
+stalledSeconds = 60
+
+watchMask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+eventHeader = struct.Struct('iIII')
+
+
+# Minimal inotify binding. Raises OSError where inotify is not available.
+class Inotify:
+    def __init__(self):
+        if not sys.platform.startswith('linux'):
+            raise OSError('inotify is only available on Linux')
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.paths = {}
+
+    # Watch a directory; returns its watch descriptor
+    def add(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), watchMask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed', path)
+        self.paths[wd] = path
+        return wd
+
+    # Paths of the directories that had events within timeout seconds. An
+    # overflowed event queue is reported as None, meaning "check everything".
+    def events(self, timeout):
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return []
+        paths = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = eventHeader.unpack_from(data, offset)
+            offset += eventHeader.size + length
+            if mask & IN_Q_OVERFLOW:
+                return None
+            if wd in self.paths:
+                paths.append(self.paths[wd])
+        return paths
+
+    def close(self):
+        os.close(self.fd)
+
+
+# True once the file ends with the ##END= record that ParaVision writes last
+def isComplete(path):
+    try:
+        with open(path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            f.seek(max(0, f.tell() - 64))
+            return b'##END=' in f.read()
+    except OSError:
+        return False
+
+
+# The scans of one study being acquired: the parsed scans with the stamps
+# they were parsed at, and the scans waiting for their files to settle
+class StudyWatcher:
+    def __init__(self, curDir, settle=2.0, cache=None):
+        self.curDir = curDir
+        self.settle = settle
+        self.cache = cache
+        self.studyDir = None
+        self.scans = {}
+        self.failed = {}
+        self.candidates = {}
+
+    # Directories to watch for this study: the study itself and its
+    # Raw_Data folder until the Bruker folder appears, then that folder and
+    # its scan directories
+    def watchDirs(self):
+        dirs = [self.curDir, os.path.join(self.curDir, 'Raw_Data')]
+        if self.studyDir is not None:
+            dirs.append(self.studyDir)
+            dirs.extend(os.path.join(self.studyDir, d) for d in self.scans)
+            dirs.extend(os.path.join(self.studyDir, d) for d in self.candidates)
+        return [d for d in dirs if os.path.isdir(d)]
+
+    def isComplete(self, scanNum):
+        return all(isComplete(os.path.join(self.studyDir, scanNum, name)) for name in scanCache.scanFiles)
+
+    # Parse the scans that are new or changed and have settled, and rewrite
+    # the CSV file if anything changed. Returns True while some scan is still
+    # waiting to settle, or the study folder has not appeared yet.
+    def check(self, now):
+        if self.studyDir is None:
+            try:
+                _, self.studyDir = py_acqp.findStudyDir(self.curDir)
+            except OSError:
+                return True
+        try:
+            scanNums = py_acqp.listScans(self.studyDir)
+        except OSError:
+            return True
+
+        changed = False
+        waiting = False
+        for d in list(self.scans):
+            if d not in scanNums:
+                del self.scans[d]
+                changed = True
+        for d in scanNums:
+            try:
+                stamp = scanCache.scanStamp(os.path.join(self.studyDir, d))
+            except OSError:
+                # acqp or method not there yet; an event in the scan
+                # directory (or the next poll) brings us back
+                self.candidates.setdefault(d, (None, now))
+                continue
+            if stamp == self.scans.get(d, (None,))[0] or stamp == self.failed.get(d):
+                self.candidates.pop(d, None)
+                continue
+            seen = self.candidates.get(d)
+            if seen is None or seen[0] != stamp:
+                self.candidates[d] = (stamp, now)
+                waiting = True
+                continue
+            if now - seen[1] < self.settle:
+                waiting = True
+                continue
+            if not self.isComplete(d):
+                # Still being written, unless it has not changed for long
+                # (e.g. an aborted scan); events bring it back if it does
+                waiting = waiting or now - seen[1] < stalledSeconds
+                continue
+            del self.candidates[d]
+            curAcqp = self.readScan(d, stamp)
+            if curAcqp is not None:
+                self.scans[d] = (stamp, curAcqp)
+                changed = True
+        if changed:
+            self.write()
+        return waiting
+
+    def readScan(self, scanNum, stamp):
+        scanKey = os.path.abspath(os.path.join(self.studyDir, scanNum))
+        if self.cache is not None:
+            entry = self.cache.lookup(scanKey, stamp)
+            if entry is not None:
+                return py_acqp.Acqp.fromParameters(scanNum, *entry)
+        try:
+            curAcqp = py_acqp.readScan(self.studyDir, scanNum)
+        except Exception as err:
+            print('Skipping scan ' + scanNum + ' of ' + self.curDir + ': ' + runReport.errorText(err),
+                  file=sys.stderr)
+            self.failed[scanNum] = stamp
+            return None
+        if self.cache is not None:
+            self.cache.store(scanKey, stamp, curAcqp.parameters, curAcqp.shapes)
+            self.cache.commit()
+        return curAcqp
+
+    # Write the CSV file for the scans parsed so far, in save time order
+    def write(self):
+        try:
+            subject = py_acqp.readSubject(self.studyDir)
+        except (OSError, KeyError):
+            subject = dict.fromkeys(paRE.subjectFields)
+        acqpList = sorted((curAcqp for _, curAcqp in self.scans.values()),
+                          key=lambda a: (paRE.toUTC(a.parameters['SaveTime']), int(a.parameters['ScanNumber'])))
+        path = py_acqp.writeStudyCsv(self.curDir, acqpList, subject)
+        print('%s: %d scans' % (path, len(acqpList)))
+
+
+# Watch the studies until interrupted. With inotify a study is only checked
+# after events in its tree, once they have been quiet for settle seconds, and
+# again every settle seconds while scans are still settling; without it every
+# study is checked every interval seconds.
+def watch(paths, settle=2.0, interval=5.0, poll=False, cache=None):
+    watchers = [StudyWatcher(curDir, settle, cache) for curDir in paths]
+    notifier = None
+    if not poll:
+        try:
+            notifier = Inotify()
+        except OSError as err:
+            print('Polling every %g s (%s)' % (interval, err), file=sys.stderr)
+    owners = {}
+    # Time of the next check of each study; None waits for an event
+    due = dict.fromkeys(watchers, 0.0)
+
+    try:
+        while True:
+            now = time.monotonic()
+            for watcher in watchers:
+                if due[watcher] is None or now < due[watcher]:
+                    continue
+                if watcher.check(now):
+                    due[watcher] = now + settle
+                elif notifier is None:
+                    due[watcher] = now + interval
+                else:
+                    due[watcher] = None
+                if notifier is not None:
+                    for path in watcher.watchDirs():
+                        if path not in owners:
+                            notifier.add(path)
+                            owners[path] = watcher
+                            # Catch anything written before the watch was in place
+                            if due[watcher] is None:
+                                due[watcher] = now + settle
+
+            pending = [t for t in due.values() if t is not None]
+            timeout = max(0.0, min(pending) - time.monotonic()) if pending else None
+            if notifier is None:
+                time.sleep(timeout)
+                continue
+            events = notifier.events(timeout)
+            now = time.monotonic()
+            if events is None:
+                events = list(owners)
+            for path in events:
+                due[owners[path]] = now + settle
+    finally:
+        if notifier is not None:
+            notifier.close()
+
+
+def main(argv=None):
+    argParser = argparse.ArgumentParser(
+        description='Keep the <study>_acqp.csv files of studies up to date as scans are written.')
+    argParser.add_argument('paths', nargs='+', help='study directories, or glob patterns')
+    argParser.add_argument('--settle', type=float, default=2.0,
+                           help='seconds the scan files must stay unchanged before they are read (default 2)')
+    argParser.add_argument('--interval', type=float, default=5.0,
+                           help='seconds between checks when polling (default 5)')
+    argParser.add_argument('--poll', action='store_true', help='poll even where inotify is available')
+    argParser.add_argument('--cache', metavar='FILE', help='SQLite cache of parsed scans (see scanCache)')
+    args = argParser.parse_args(argv)
+
+    paths = [m for p in args.paths for m in (sorted(glob.glob(p)) or [p])]
+    cache = scanCache.ScanCache(args.cache) if args.cache else None
+    try:
+        watch(paths, args.settle, args.interval, args.poll, cache)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if cache is not None:
+            cache.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())